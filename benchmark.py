@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+
+'''
+    Throughput and latency benchmark of the chat service.
+
+    The replicas of a replica_config.json are started on this machine, one
+    process group each, so that single replicas can be killed and restarted.
+    Synthetic clients of paxos_client.py then send messages, either in a
+    closed loop (every client keeps a fixed number of messages in flight) or
+    at a fixed total rate, and the results are printed as JSON:
+
+        throughput of acknowledged messages per second
+        p50 / p99 / p999 commit latency, from sending to the first ack
+        failover time, from killing the leader to the first ack of a message
+            sent after that
+        catch-up time, from restarting a killed follower to it having applied
+            every slot acknowledged before the restart
+        the timelines of the slowest traced messages, if some are traced
+'''
+
+import os
+import sys
+import json
+import time
+import click
+import shutil
+import signal
+import asyncio
+import tempfile
+import subprocess
+from paxos_util import u_get_id
+from paxos_client import AsyncChatClient, CLIENT_TIMEOUT
+from paxos_trace import u_collect_traces, u_add_client_traces, u_timelines,\
+                        u_slowest_traces, u_relative_timeline
+
+
+# Port of the first synthetic client, the others follow
+BENCH_PORT_BASE = 9000
+# Seconds the replicas get to start up, the leader alone waits for 1
+STARTUP_TIME = 1.5
+# Number of slowest traced messages reported
+SLOWEST_TRACES = 5
+# Seconds profiled replicas get to write their profiles when stopped
+PROFILE_STOP_TIME = 10
+
+
+# The replicas of a config, each run in its own process group
+# They are run from a copy of the scripts in a temporary directory, so a run
+#   starts from empty replicas and leaves wal/ and log/ of the checkout alone
+class Cluster(object):
+    def __init__(self, config_data, use_asyncio, profile):
+        self.replica_num = len(config_data['replica_list'])
+        self.use_asyncio = use_asyncio
+        self.profile = profile
+        self.base_dir = os.path.dirname(os.path.realpath(__file__))
+
+        self.run_dir = tempfile.mkdtemp(prefix='paxos_bench_')
+        for file_name in os.listdir(self.base_dir):
+            if file_name.endswith('.py'):
+                shutil.copy(os.path.join(self.base_dir, file_name), self.run_dir)
+        self.replica_script = os.path.join(self.run_dir, 'replica.py')
+
+        # Every replica is started on its own, as in manual mode
+        self.config_file = os.path.join(self.run_dir, 'replica_config.json')
+        with open(self.config_file, 'w') as config_handle:
+            config_handle.write(json.dumps(dict(config_data, mode='manual'), indent=4))
+
+        # { replica_id : Popen }
+        self.processes = {}
+
+    def start(self, replica_id):
+        command = [sys.executable, self.replica_script, self.config_file,
+                   '-i', str(replica_id)]
+        if self.use_asyncio:
+            command.append('-a')
+        if self.profile:
+            command.append('-pr')
+
+        self.processes[replica_id] = subprocess.Popen(command, stdout=subprocess.DEVNULL,
+                                                      stderr=subprocess.DEVNULL,
+                                                      start_new_session=True)
+
+    # A killed replica crashes, and does not write its profile
+    def kill(self, replica_id, sig=signal.SIGKILL):
+        process = self.processes.pop(replica_id, None)
+        if process is None:
+            return
+
+        # replica.py runs the replica in a child process of its own
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            pass
+
+        try:
+            process.wait(PROFILE_STOP_TIME if sig != signal.SIGKILL else None)
+        except subprocess.TimeoutExpired:
+            self.processes[replica_id] = process
+            self.kill(replica_id)
+
+    def stop(self):
+        # Profiled replicas are stopped, so that they write their profiles
+        for replica_id in list(self.processes):
+            self.kill(replica_id, signal.SIGTERM if self.profile else signal.SIGKILL)
+
+        # The profiles are kept in profile/ of the checkout
+        profile_dir = os.path.join(self.run_dir, 'profile')
+        if os.path.isdir(profile_dir):
+            shutil.copytree(profile_dir, os.path.join(self.base_dir, 'profile'),
+                            dirs_exist_ok=True)
+
+        shutil.rmtree(self.run_dir)
+
+
+# The measurements of one run
+class Results(object):
+    def __init__(self):
+        # Messages sent before measure_from or acknowledged after measure_until
+        #   are not counted
+        self.measure_from = None
+        self.measure_until = None
+        self.latencies = []
+        self.sent = 0
+        self.acked = 0
+        # The highest slot a message was acknowledged in
+        self.max_slot = -1
+        # The time the leader was killed and the failover time in seconds
+        self.kill_time = None
+        self.failover = None
+        # The time the follower was restarted and the catch-up time in seconds
+        self.restart_time = None
+        self.catchup = None
+        # The hops of traced messages, see paxos_trace
+        self.trace_events = []
+
+    def record_ack(self, now, sent, slot):
+        self.max_slot = max(self.max_slot, slot)
+
+        if self.kill_time is not None and self.failover is None and sent >= self.kill_time:
+            self.failover = now - self.kill_time
+
+        if self.measure_from is not None and sent >= self.measure_from and\
+                now <= self.measure_until:
+            self.acked += 1
+            self.latencies.append(now - sent)
+
+
+# Sends one synthetic message, the latency is counted from when it is sent
+#   to the client, including the time it waits for the window
+def send_message(client, results, value_size):
+    value = 'bench_{}_{}_'.format(client.client_id, results.sent)
+    value = value + 'x' * max(value_size - len(value), 0)
+    results.sent += 1
+
+    sent = time.time()
+    future = client.send(value)
+
+    def on_done(future):
+        if not future.cancelled() and future.exception() is None:
+            results.record_ack(time.time(), sent, future.result())
+
+    future.add_done_callback(on_done)
+    return future
+
+
+# Sends one message after another, each once the previous is acknowledged
+async def closed_loop(client, results, value_size, until):
+    while time.time() < until:
+        future = send_message(client, results, value_size)
+        await asyncio.wait([future], timeout=max(until - time.time(), 0))
+
+
+# Sends a message every interval seconds whether or not they are acknowledged
+async def open_loop(client, results, value_size, until, interval):
+    next_send = time.time()
+    while next_send < until:
+        send_message(client, results, value_size)
+        next_send += interval
+        await asyncio.sleep(max(next_send - time.time(), 0))
+
+
+# Kills a follower at stop_at, starts it again at restart_at, and waits
+#   until it has applied every slot acknowledged before the restart
+async def measure_catchup(cluster, probe, results, stop_at, restart_at, until):
+    await asyncio.sleep(max(stop_at - time.time(), 0))
+    follower_id = (u_get_id(probe.leader_propose_no, cluster.replica_num) + 1) %\
+        cluster.replica_num
+    cluster.kill(follower_id)
+
+    await asyncio.sleep(max(restart_at - time.time(), 0))
+    cluster.start(follower_id)
+    results.restart_time = time.time()
+    min_slot = results.max_slot + 1
+
+    # The replica answers once it has applied min_slot, the read is sent
+    #   again in case it was lost or the replica was not up yet
+    caught_up = probe.read_any(min_slot, min_slot, follower_id)
+    await asyncio.wait([caught_up], timeout=max(until - time.time(), 0))
+
+    if caught_up.done() and caught_up.exception() is None:
+        results.catchup = time.time() - results.restart_time
+    else:
+        # Closing the probe would fail the read, which nobody awaits any more
+        caught_up.cancel()
+
+
+async def measure_failover(cluster, clients, results, kill_at):
+    await asyncio.sleep(max(kill_at - time.time(), 0))
+    leader_propose_no = max(client.leader_propose_no for client in clients)
+    cluster.kill(u_get_id(leader_propose_no, cluster.replica_num))
+    results.kill_time = time.time()
+
+
+async def run_benchmark(cluster, replica_config, client_num, duration, warmup, rate,
+                        value_size, outstanding, failover, catchup, trace_rate):
+    results = Results()
+    clients = [await AsyncChatClient.connect(client_id, 'localhost',
+                                             BENCH_PORT_BASE + client_id, replica_config,
+                                             max_outstanding=outstanding,
+                                             trace_rate=trace_rate)
+               for client_id in range(client_num)]
+
+    start = time.time()
+    until = start + duration
+    results.measure_from = start + warmup
+    results.measure_until = until
+
+    tasks = []
+    for client in clients:
+        if rate > 0:
+            tasks.append(open_loop(client, results, value_size, until, client_num / rate))
+        else:
+            tasks += [closed_loop(client, results, value_size, until)
+                      for _ in range(outstanding)]
+
+    # The follower is back well before the leader is killed
+    if catchup:
+        probe = await AsyncChatClient.connect(client_num, 'localhost',
+                                              BENCH_PORT_BASE + client_num, replica_config)
+        clients.append(probe)
+        tasks.append(measure_catchup(cluster, probe, results, start + duration * 0.2,
+                                     start + duration * 0.4, until))
+    if failover:
+        tasks.append(measure_failover(cluster, clients, results, start + duration * 0.6))
+
+    await asyncio.gather(*tasks)
+
+    # Let the messages in flight be acknowledged, which are not counted but
+    #   complete the traces
+    await asyncio.sleep(CLIENT_TIMEOUT)
+    for client in clients:
+        client.close()
+
+    if trace_rate > 0:
+        results.trace_events, _ = u_collect_traces(replica_config, 'localhost',
+                                                   BENCH_PORT_BASE + client_num + 1)
+        for client in clients:
+            if client.traces is not None:
+                u_add_client_traces(results.trace_events, client.traces, client.client_id)
+
+    return results
+
+
+# Returns the p-th percentile of the sorted values by nearest rank
+def u_percentile(values, p):
+    if values == []:
+        return None
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def to_ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+@click.command()
+@click.argument('config_file')
+@click.option('--clients', '-c', type=int, default=4,
+              help='Specify the number of synthetic clients by --clients n')
+@click.option('--duration', '-t', type=float, default=10,
+              help='Specify the seconds messages are sent for by --duration t')
+@click.option('--warmup', '-wu', type=float, default=1,
+              help='Specify the seconds at the start which are not measured by --warmup t')
+@click.option('--rate', '-r', type=float, default=0,
+              help='Specify the messages per second of all clients together by --rate n '
+                   '(0 sends in a closed loop)')
+@click.option('--size', '-s', type=int, default=16,
+              help='Specify the bytes of every message by --size n')
+@click.option('--outstanding', '-w', type=int, default=1,
+              help='Specify the messages every client has in flight at once by --outstanding n')
+@click.option('--failover', '-f', is_flag=True,
+              help='Set this flag to kill the leader and measure the failover time')
+@click.option('--catchup', '-cu', is_flag=True,
+              help='Set this flag to restart a follower and measure its catch-up time')
+@click.option('--trace', '-tr', type=float, default=0,
+              help='Specify the share of messages traced by --trace r, which reports the '
+                   'timelines of the slowest ones')
+@click.option('--use_asyncio', '-a', is_flag=True,
+              help='run replicas on an asyncio event loop')
+@click.option('--profile', '-pr', is_flag=True,
+              help='Set this flag to profile the replicas into profile/, see replica.py -pr')
+@click.option('--output', '-o', type=click.Path(),
+              help='Specify a file to write the JSON results to as well')
+def main(config_file, clients, duration, warmup, rate, size, outstanding, failover, catchup,
+         trace, use_asyncio, profile, output):
+    """Benchmark the replicas of CONFIG_FILE with synthetic clients"""
+    with open(config_file, 'r') as config_handle:
+        config_data = json.loads(config_handle.read())
+
+    # { replica_id : { 'ip' : '', 'port' : '' } }
+    replica_config = {}
+    for raw_config in config_data['replica_list']:
+        replica_config[raw_config['id']] = {
+            'ip' : raw_config['ip'],
+            'port' : raw_config['port']
+        }
+
+    cluster = Cluster(config_data, use_asyncio, profile)
+    try:
+        for replica_id in range(cluster.replica_num):
+            cluster.start(replica_id)
+        time.sleep(STARTUP_TIME)
+
+        results = asyncio.run(run_benchmark(cluster, replica_config, clients, duration,
+                                            warmup, rate, size, outstanding, failover, catchup,
+                                            trace))
+
+    finally:
+        cluster.stop()
+
+    latencies = sorted(results.latencies)
+    measured = duration - warmup
+    report = {
+        'replicas' : cluster.replica_num,
+        'clients' : clients,
+        'duration' : duration,
+        'warmup' : warmup,
+        'rate' : rate,
+        'size' : size,
+        'outstanding' : outstanding,
+        'sent' : results.sent,
+        'acked' : results.acked,
+        'throughput' : round(results.acked / measured, 3) if measured > 0 else None,
+        'latency_ms' : {
+            'mean' : to_ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50' : to_ms(u_percentile(latencies, 50)),
+            'p99' : to_ms(u_percentile(latencies, 99)),
+            'p999' : to_ms(u_percentile(latencies, 99.9)),
+            'max' : to_ms(latencies[-1]) if latencies else None
+        },
+        'failover_ms' : to_ms(results.failover),
+        'catchup_ms' : to_ms(results.catchup)
+    }
+
+    if trace > 0:
+        timelines = u_timelines(results.trace_events)
+        report['traced'] = len(timelines)
+        report['slowest_traces'] = [{
+            'trace_id' : trace_id,
+            'latency_ms' : to_ms(latency),
+            'timeline' : u_relative_timeline(timelines[trace_id])
+        } for latency, trace_id in u_slowest_traces(timelines, SLOWEST_TRACES)]
+
+    report_str = json.dumps(report, indent=4)
+    print(report_str)
+    if output:
+        with open(output, 'w') as output_handle:
+            output_handle.write(report_str + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,26 @@
 #!/usr/env/bin python3
 
 import json
-import time
 import click
-import socket
-from paxos_util import paxos_client_request, paxos_client_timeout, u_get_id,\
-                       paxos_print_log
+from paxos_client import ChatClient
 
 
-def send_client_request(my_id, my_ip, my_port, replica_config, my_drop_rate):
+def send_client_request(my_id, my_ip, my_port, replica_config, my_drop_rate,
+                        wire_format='binary', read_your_writes=False, trace_rate=0):
     '''The actual client request execution interface.'''
 
-    # { replica_id : { 'ip' : '', 'port' : '' } }
-    s_replica_config = replica_config
-    # Number of replicas
-    c_replica_num = len(s_replica_config)
-    # Every client retains its own request sequence number
-    s_request_no = 0
-    # The id of the leader who I believe is the leader
-    s_leader_propose_no = 0
-    # Initial timeout time
-    time_gap = 1
-    time_gap_interval = 0.1
-
-    # Build the socket to receive external messages
-    my_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    my_socket.bind((my_ip, my_port))
-
-    # TODO: Client timeout should be dynamic or increasing
-    my_socket.settimeout(time_gap)
+    # Sends the messages and reads, finding the leader on timeouts
+    c_client = ChatClient(my_id, my_ip, my_port, replica_config, drop_rate=my_drop_rate,
+                          wire_format=wire_format, trace_rate=trace_rate)
+    # The next read starts at s_read_slot
+    s_read_slot = 0
+    # The slot after the one my last acknowledged request was chosen in
+    s_write_slot = 0
 
     while True:
         command_str = 'Enter your command' + '\n' +\
-                      '(s) send message, (p) print log, (e) end client: '
+                      '(s) send message, (r) read messages, (f) read from any replica,\n' +\
+                      '(p) print log, (e) end client: '
         # Let client choose what to do
         user_command = input(command_str)
 
@@ -41,98 +28,42 @@ def send_client_request(my_id, my_ip, my_port, replica_config, my_drop_rate):
             # Get user's message from command line
             value = input('Enter your message: ')
 
-            # Send parsed message to assumed leader
-            paxos_client_request(my_id, my_ip, my_port, s_request_no,
-                                 s_leader_propose_no, value,
-                                 s_replica_config, my_drop_rate)
-
-            # Start recording the time for timeout
-            time_recorder = time.time()
-
-            while True:
-                data = None
-
-                try:
-                    # Accept message from replicas
-                    # This is a blocking call, but the client has set timeout
-                    data = my_socket.recvfrom(1024)[0]
-
-                except socket.timeout:
-                    print('Client {} send timeout message to all'.format(my_id))
-                    # print('Client {} increases its timeout time'.format(my_id))
-
-                    # Increase the timeout gap
-                    time_gap += time_gap_interval
-                    my_socket.settimeout(time_gap)
-
-                    # when timeout, send timeout messages to all
-                    paxos_client_timeout(my_id, my_ip, my_port, s_request_no,
-                                         s_leader_propose_no, s_replica_config,
-                                         my_drop_rate)
-
-                    # Reinitialize the timer
-                    time_recorder = time.time()
-                    continue
-
-                reply_message = json.loads(data.decode('utf-8'))
-
-                message_type = reply_message['message_type']
-
-                if message_type == 'ack_client':
-                    if reply_message['request_no'] == s_request_no:
-                        print ('Message Recorded!')
-                        # Increment request_no for next request
-                        s_request_no += 1
-                        break
-
-                elif message_type == 'new_leader_to_client':
-                    # This is the propose_no of new leader
-                    new_leader_propose_no = reply_message['propose_no']
-
-                    # It is possible that I have sent multiple same timeout messages
-                    #   if the destination is on Mars
-                    if new_leader_propose_no > s_leader_propose_no:
-                        print('Change client {}\'s leader to {}'.\
-                              format(my_id, u_get_id(new_leader_propose_no,
-                                                     c_replica_num)))
-                        # prepare message and destination to be resent
-                        s_leader_propose_no = new_leader_propose_no
-
-                        # Resend the client request
-                        paxos_client_request(my_id, my_ip, my_port, s_request_no,
-                                             s_leader_propose_no, value,
-                                             s_replica_config, my_drop_rate)
-
-                        # Reinitialize the timer
-                        time_recorder = time.time()
-                        continue
-
-                if (time.time() - time_recorder) >= time_gap:
-                    print('Client {} send timout message to all'.format(my_id))
-                    # print('Client {} increases its timeout time'.format(my_id))
-
-                    # Increase the timeout gap
-                    time_gap += time_gap_interval
-                    my_socket.settimeout(time_gap)
-
-                    # when timeout, send timeout messages to all
-                    paxos_client_timeout(my_id, my_ip, my_port, s_request_no,
-                                         s_leader_propose_no, s_replica_config,
-                                         my_drop_rate)
-
-                    # Reinitialize the timer
-                    time_recorder = time.time()
+            # Wait until the message is chosen
+            slot = c_client.send(value).result()
+            print ('Message Recorded!')
+            s_write_slot = max(s_write_slot, slot + 1)
+
+
+        elif user_command in ('r', 'f'):
+            # Read the messages chosen since the last read
+            if user_command == 'r':
+                read = c_client.read(s_read_slot)
+            else:
+                # Read-your-writes needs every slot up to my last write and read
+                min_slot = max(s_write_slot, s_read_slot) if read_your_writes else 0
+                read = c_client.read_any(s_read_slot, min_slot)
+
+            values, start_slot, end_slot = read.result()
+            # The messages of compacted slots are only kept in the chat log files
+            if start_slot > s_read_slot:
+                print('Slots {} to {} compacted, read from slot {}'.format(
+                    s_read_slot, start_slot - 1, start_slot))
+            for value in values:
+                print(value)
+            print('Read up to slot {}'.format(end_slot))
+            # A lagging follower may be behind my last read
+            s_read_slot = max(s_read_slot, end_slot)
 
 
         elif user_command == 'p':
-            paxos_print_log(my_id, replica_config)
+            c_client.print_log()
 
 
         elif user_command == 'e':
             break
 
     # Close the socket for completeness
-    my_socket.close()
+    c_client.close()
 
 
 @click.command()
@@ -141,7 +72,14 @@ def send_client_request(my_id, my_ip, my_port, replica_config, my_drop_rate):
 @click.argument('my_port')
 @click.argument('replica_config_file')
 @click.argument('client_drop_rate')
-def main(client_id, my_ip, my_port, replica_config_file, client_drop_rate):
+@click.option('--json', '-j', 'use_json', is_flag=True,
+              help='Set this flag to send messages as JSON for debugging')
+@click.option('--read_your_writes', '-y', is_flag=True,
+              help='Set this flag to make reads from any replica include my own messages')
+@click.option('--trace', '-tr', type=float, default=0,
+              help='Specify the share of messages traced by --trace r, see trace_dump.py')
+def main(client_id, my_ip, my_port, replica_config_file, client_drop_rate, use_json,
+         read_your_writes, trace):
     '''Main function is used for data preprocessing.'''
 
     # Convert to int which is required by repica_config
@@ -166,7 +104,8 @@ def main(client_id, my_ip, my_port, replica_config_file, client_drop_rate):
         }
 
     # Call the actual client request execution
-    send_client_request(my_id, my_ip, my_port, replica_config, my_drop_rate) 
+    send_client_request(my_id, my_ip, my_port, replica_config, my_drop_rate,
+                        'json' if use_json else 'binary', read_your_writes, trace)
 
 
 if __name__ == '__main__':
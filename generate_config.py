@@ -4,6 +4,7 @@ import os
 import json
 import click
 import shutil
+from paxos_log import LOG_LEVELS
 
 @click.command()
 @click.argument('f', nargs=1, type=int)
@@ -15,7 +16,60 @@ import shutil
               help='Specify the replica i drop j% message by --prob i j')
 @click.option('--proball', '-pa', type=int,
               help='Specify all replicas drop j% message by --proball j')
-def generate_config(f, manual, skip, prob, proball):
+@click.option('--batch', '-b', type=int, default=1,
+              help='Specify the max number of client requests in one slot by --batch n')
+@click.option('--batchbytes', '-bb', type=int, default=512,
+              help='Specify the max bytes of values in one slot by --batchbytes n')
+@click.option('--linger', '-l', type=int, default=0,
+              help='Specify the ms the leader waits to fill a batch by --linger t')
+@click.option('--window', '-w', type=int, default=16,
+              help='Specify the max number of slots in flight by --window n (0 is unbounded)')
+@click.option('--queuelimit', '-q', type=int, default=1024,
+              help='Specify the max number of queued client requests by --queuelimit n')
+@click.option('--json', '-j', 'use_json', is_flag=True,
+              help='Set this flag to send messages as JSON for debugging')
+@click.option('--durable', '-d', is_flag=True,
+              help='Set this flag to keep the acceptor state in a write-ahead log')
+@click.option('--commitwindow', '-cw', type=int, default=2,
+              help='Specify the ms log records wait to share one fsync by --commitwindow t')
+@click.option('--logflush', '-lf', type=int, default=0,
+              help='Specify the ms chat log lines may stay buffered by --logflush t')
+@click.option('--snapshot', '-ss', type=int, default=0,
+              help='Specify the number of chosen slots between snapshots by --snapshot n')
+@click.option('--sessionexpiry', '-se', type=int, default=100000,
+              help='Specify the number of chosen slots an idle client is remembered '
+                   'by --sessionexpiry n (0 is forever)')
+@click.option('--lease', '-le', type=int, default=500,
+              help='Specify the ms a lease granted to the leader lasts by --lease t '
+                   '(0 turns leases off)')
+@click.option('--catchupchunk', '-cc', type=int, default=16,
+              help='Specify the max number of chosen slots sent to a lagging replica '
+                   'at once by --catchupchunk n')
+@click.option('--catchuprate', '-cr', type=int, default=5000,
+              help='Specify the max number of chosen slots sent to lagging replicas '
+                   'per second by --catchuprate n (0 is unlimited)')
+@click.option('--heartbeat', '-hb', type=int, default=100,
+              help='Specify the ms between two heartbeats of the leader by --heartbeat t '
+                   '(0 turns heartbeats and elections off)')
+@click.option('--election', '-el', type=int, default=300,
+              help='Specify the ms without heartbeats after which a replica runs for '
+                   'leader by --election t')
+@click.option('--metrics', '-me', type=int, default=0,
+              help='Specify the port replica 0 serves its metrics on over HTTP by '
+                   '--metrics port, the others follow (0 serves none)')
+@click.option('--loglevel', '-ll', type=click.Choice(LOG_LEVELS), default='info',
+              help='Specify the level of the log records replicas print by --loglevel level '
+                   '(debug prints every message)')
+@click.option('--logsample', '-ls', type=int, default=1,
+              help='Specify that one in n debug records of messages is printed by '
+                   '--logsample n')
+@click.option('--tracebuffer', '-tb', type=int, default=4096,
+              help='Specify the number of hops of traced requests every replica keeps '
+                   'by --tracebuffer n (0 turns tracing off)')
+def generate_config(f, manual, skip, prob, proball, batch, batchbytes, linger,
+                    window, queuelimit, use_json, durable, commitwindow, logflush,
+                    snapshot, sessionexpiry, lease, catchupchunk, catchuprate,
+                    heartbeat, election, metrics, loglevel, logsample, tracebuffer):
     """Generate config file for Paxos replicas tolerating F benign failures"""
     config_data = {}
     config_data['f'] = f
@@ -31,7 +85,27 @@ def generate_config(f, manual, skip, prob, proball):
             'ip' : 'localhost',
             'port' : port_base + replica_id,
             'skip_slot' : [],
-            'drop_rate' : 0
+            'drop_rate' : 0,
+            'batch_size' : max(batch, 1),
+            'batch_bytes' : batchbytes,
+            'batch_linger' : max(linger, 0),
+            'pipeline_window' : max(window, 0),
+            'queue_limit' : max(queuelimit, 0),
+            'wire_format' : 'json' if use_json else 'binary',
+            'durable' : durable,
+            'commit_window' : max(commitwindow, 0),
+            'log_flush_interval' : max(logflush, 0),
+            'snapshot_interval' : max(snapshot, 0),
+            'session_expiry' : max(sessionexpiry, 0),
+            'lease_duration' : max(lease, 0),
+            'catchup_chunk' : max(catchupchunk, 1),
+            'catchup_rate' : max(catchuprate, 0),
+            'heartbeat_interval' : max(heartbeat, 0),
+            'election_timeout' : max(election, 1),
+            'metrics_port' : (metrics + replica_id) if metrics > 0 else 0,
+            'log_level' : loglevel,
+            'log_sample' : max(logsample, 1),
+            'trace_buffer' : max(tracebuffer, 0)
         }
         # Specify all replica as same drop_rate
         if proball:
@@ -74,6 +148,11 @@ def generate_config(f, manual, skip, prob, proball):
         shutil.rmtree(log_dir)
     os.makedirs(log_dir)
 
+    # A new configuration starts without write-ahead logs to replay
+    wal_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'wal')
+    if os.path.isdir(wal_dir):
+        shutil.rmtree(wal_dir)
+
 
 if __name__ == '__main__':
     generate_config()
@@ -0,0 +1,404 @@
+#!/usr/env/bin python3
+
+'''
+    The programmatic client of the chat service.
+
+    AsyncChatClient runs on the asyncio event loop of the caller, and
+    ChatClient runs one on a thread of its own for blocking code. Both send
+    up to max_outstanding messages at once, told apart by their request
+    numbers, and queue the rest until earlier ones are acknowledged. The
+    oldest message outstanding also holds back the ones SESSION_WINDOW request
+    numbers after it. Every send returns a future of the slot the message was
+    chosen in.
+
+    A leader whose queue is full answers a message with busy_to_client, and
+    the message is sent again after BUSY_RETRY, without timing out. As in
+    TCP congestion control, this also halves the number of messages the
+    client keeps outstanding, which grows back by one for every window of
+    acknowledged messages, so that the retries are not crowded out by new
+    messages. A message
+    or read not answered within the timeout makes the client send
+    client_timeout to every replica, and whatever is waiting for the leader
+    is sent again to the new leader it is told about. The timeout follows the
+    measured round trips as TCP does (RFC 6298): it is the smoothed round
+    trip plus four times its variation, doubled after every timeout until
+    the next answer, with some jitter so that clients do not time out in step.
+
+    A trace_rate above 0 gives that share of the messages a trace id, whose
+    hops are recorded by the replicas and by the client in its TraceBuffer
+    traces, see paxos_trace.
+'''
+
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from paxos_util import paxos_client_request, paxos_client_timeout, paxos_client_read,\
+                       paxos_follower_read, paxos_print_log, u_bind_socket, UdpSender,\
+                       SESSION_WINDOW
+from paxos_wire import u_decode_message, FrameAssembler
+from paxos_trace import TraceBuffer
+
+
+# Seconds after which an unanswered message or read times out, before any
+#   round trip is measured
+CLIENT_TIMEOUT = 1
+# Bounds of the timeout in seconds, it does not go below the time a busy
+#   leader may take, as every timeout can make the replicas elect a new one
+MIN_TIMEOUT = 0.2
+MAX_TIMEOUT = 8
+# Timeouts are stretched by a random factor of up to 1 + TIMEOUT_JITTER
+TIMEOUT_JITTER = 0.25
+# Seconds between two checks for timeouts
+TIMEOUT_CHECK = 0.02
+# Seconds after which a message the leader was too busy to queue is sent
+#   again, stretched by a random factor of up to 2
+BUSY_RETRY = 0.05
+
+
+# Estimates the timeout from the measured round trips
+class RttEstimator(object):
+    def __init__(self, initial=CLIENT_TIMEOUT, min_timeout=MIN_TIMEOUT,
+                 max_timeout=MAX_TIMEOUT):
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        # The smoothed round trip and its variation, None until the first one
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial
+        # Doubled after every timeout, reset by the next round trip
+        self.backoff = 1
+
+    # Adds a round trip of rtt seconds, which must not include any resend
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_timeout), self.max_timeout)
+        self.backoff = 1
+
+    def timed_out(self):
+        self.backoff = min(self.backoff * 2, self.max_timeout / self.min_timeout)
+
+    # Returns the seconds to wait for an answer, with jitter
+    def timeout(self):
+        return min(self.rto * self.backoff, self.max_timeout) *\
+            random.uniform(1, 1 + TIMEOUT_JITTER)
+
+
+class AsyncChatClient(asyncio.DatagramProtocol):
+    # replica_config is { replica_id : { 'ip' : '', 'port' : num } }
+    # The outstanding messages span fewer than SESSION_WINDOW request numbers,
+    #   as the replicas give up the requests skipped for longer than that
+    def __init__(self, client_id, ip, port, replica_config, max_outstanding=1,
+                 timeout=CLIENT_TIMEOUT, drop_rate=0, wire_format='binary', trace_rate=0):
+        self.client_id = client_id
+        self.ip = ip
+        self.port = port
+        self.replica_config = replica_config
+        self.max_outstanding = min(max(max_outstanding, 1), SESSION_WINDOW)
+        # The number of messages sent at once, shrunk while the leader is busy,
+        #   and the first request_no whose busy reply shrinks it again
+        self.window = float(self.max_outstanding)
+        self.window_since = 0
+        self.rtt = RttEstimator(timeout)
+        self.drop_rate = drop_rate
+        self.wire_format = wire_format
+        # The share of messages traced, and the hops of them seen by me
+        self.trace_rate = trace_rate
+        self.traces = TraceBuffer() if trace_rate > 0 else None
+
+        self.sender = None
+        self.transport = None
+        # Reassembles the messages which do not fit in one datagram
+        self.assembler = FrameAssembler()
+        # The scheduled check for timeouts
+        self.timer = None
+
+        # The propose_no of who I believe is the leader
+        self.leader_propose_no = 0
+        # [value, future] of the messages waiting for the window
+        self.queued = deque()
+        # { request_no : [value, future, first_sent, deadline, resent, trace_id,
+        #   retry_at] }, retry_at is None unless the leader was busy
+        self.outstanding = {}
+        self.next_request_no = 0
+        # { read_no : [future, start_slot, min_slot, replica_id, first_sent, deadline,
+        #   resent] }, min_slot is None for reads at the leader
+        self.reads = {}
+        self.next_read_no = 0
+
+    # Returns a client bound to (ip, port) on the running event loop
+    @classmethod
+    async def connect(cls, client_id, ip, port, replica_config, **options):
+        loop = asyncio.get_running_loop()
+        client = cls(client_id, ip, port, replica_config, **options)
+        await loop.create_datagram_endpoint(lambda: client, sock=u_bind_socket(ip, port))
+        return client
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.sender = UdpSender(self.client_id, transport, self.replica_config,
+                                self.drop_rate, self.wire_format)
+        self.timer = asyncio.get_running_loop().call_later(TIMEOUT_CHECK, self.check_timeouts)
+
+    # Sends value to be logged, returns a future of the slot it is chosen in
+    def send(self, value):
+        future = asyncio.get_running_loop().create_future()
+        self.queued.append([value, future])
+        self.fill_window()
+        return future
+
+    # Reads the messages chosen from start_slot on at the leader
+    # Returns a future of ([value], start_slot, end_slot), the slots read from
+    #   and up to, where start_slot is later than asked for if the slots
+    #   before it have been compacted into a snapshot
+    def read(self, start_slot=0):
+        return self.start_read(start_slot, None, None)
+
+    # Reads the messages chosen from start_slot on at replica_id, or a random
+    #   replica if None, once it has applied every slot below min_slot
+    # Returns a future of ([value], start_slot, end_slot)
+    def read_any(self, start_slot=0, min_slot=0, replica_id=None):
+        return self.start_read(start_slot, min_slot, replica_id)
+
+    # Lets replicas write their logs to actual log file
+    def print_log(self):
+        paxos_print_log(self.sender)
+
+    # Stops the client, failing everything still waiting
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.transport is not None:
+            self.transport.close()
+
+        futures = [request[1] for request in self.queued] +\
+                  [request[1] for request in self.outstanding.values()] +\
+                  [read[0] for read in self.reads.values()]
+        for future in futures:
+            if not future.done():
+                future.set_exception(ConnectionError('chat client closed'))
+
+        self.queued.clear()
+        self.outstanding.clear()
+        self.reads.clear()
+
+    # Sends the queued messages as long as the window is open
+    # A message which is stuck, e.g. lost, holds back the ones SESSION_WINDOW
+    #   request numbers after it, so that the replicas never give it up
+    def fill_window(self):
+        # The messages the leader was too busy to queue go first
+        if any(request[6] is not None for request in self.outstanding.values()):
+            return
+
+        while self.queued and len(self.outstanding) < self.window and\
+                (not self.outstanding or
+                 self.next_request_no - min(self.outstanding) < SESSION_WINDOW):
+            value, future = self.queued.popleft()
+            if future.cancelled():
+                continue
+
+            request_no = self.next_request_no
+            self.next_request_no += 1
+
+            trace_id = 0
+            if self.traces is not None and random.random() < self.trace_rate:
+                trace_id = random.getrandbits(62) + 1
+                self.traces.record(trace_id, 'send')
+
+            now = time.time()
+            self.outstanding[request_no] = [value, future, now, now + self.rtt.timeout(), False,
+                                            trace_id, None]
+            paxos_client_request(self.sender, self.ip, self.port, request_no,
+                                 self.leader_propose_no, value, trace_id)
+
+    def start_read(self, start_slot, min_slot, replica_id):
+        future = asyncio.get_running_loop().create_future()
+
+        read_no = self.next_read_no
+        self.next_read_no += 1
+
+        now = time.time()
+        self.reads[read_no] = [future, start_slot, min_slot, replica_id, now,
+                               now + self.rtt.timeout(), False]
+        self.send_read(read_no)
+        return future
+
+    def send_read(self, read_no):
+        _, start_slot, min_slot, replica_id = self.reads[read_no][:4]
+
+        if min_slot is None:
+            paxos_client_read(self.sender, self.ip, self.port, read_no,
+                              self.leader_propose_no, start_slot)
+        else:
+            if replica_id is None:
+                replica_id = random.choice(list(self.replica_config))
+            paxos_follower_read(self.sender, self.ip, self.port, read_no,
+                                min_slot, start_slot, replica_id)
+
+    # Sends what waits for the leader again, e.g. to a new leader
+    def resend_to_leader(self, now):
+        for request_no, request in self.outstanding.items():
+            request[3] = now + self.rtt.timeout()
+            request[4] = True
+            request[6] = None
+            if request[5]:
+                self.traces.record(request[5], 'resend')
+            paxos_client_request(self.sender, self.ip, self.port, request_no,
+                                 self.leader_propose_no, request[0], request[5])
+
+        for read_no, read in self.reads.items():
+            if read[2] is None:
+                read[5] = now + self.rtt.timeout()
+                read[6] = True
+                self.send_read(read_no)
+
+    def check_timeouts(self):
+        now = time.time()
+
+        # Send again what the leader was too busy to queue
+        for request_no, request in self.outstanding.items():
+            if request[6] is not None and now >= request[6]:
+                request[3] = now + self.rtt.timeout()
+                request[6] = None
+                if request[5]:
+                    self.traces.record(request[5], 'resend')
+                paxos_client_request(self.sender, self.ip, self.port, request_no,
+                                     self.leader_propose_no, request[0], request[5])
+
+        # Look for a new leader, waiting twice as long for the next timeout
+        if any(now >= request[3] for request in self.outstanding.values()) or\
+                any(read[2] is None and now >= read[5] for read in self.reads.values()):
+            self.rtt.timed_out()
+            paxos_client_timeout(self.sender, self.ip, self.port, self.next_request_no,
+                                 self.leader_propose_no)
+
+            for request in self.outstanding.values():
+                request[3] = now + self.rtt.timeout()
+                request[4] = True
+                if request[5]:
+                    self.traces.record(request[5], 'timeout')
+
+            # Reads can be resent safely
+            for read_no, read in self.reads.items():
+                if read[2] is None:
+                    read[5] = now + self.rtt.timeout()
+                    read[6] = True
+                    self.send_read(read_no)
+
+        # Any other replica can answer a follower read, which is only answered
+        #   once the replica has applied min_slot, so every resend of it waits
+        #   as long as the read has waited so far
+        for read_no, read in self.reads.items():
+            if read[2] is not None and now >= read[5]:
+                read[5] = now + min(now - read[4], MAX_TIMEOUT)
+                read[6] = True
+                self.send_read(read_no)
+
+        self.timer = asyncio.get_running_loop().call_later(TIMEOUT_CHECK, self.check_timeouts)
+
+    def datagram_received(self, data, addr):
+        # Frames of a large message only yield it once all have arrived
+        data = self.assembler.feed(data, addr)
+        if data is None:
+            return
+
+        message = u_decode_message(data)
+        message_type = message['message_type']
+
+        if message_type == 'ack_client':
+            request = self.outstanding.pop(message['request_no'], None)
+            if request is None:
+                return
+
+            # Resent requests may be answered for an earlier send (Karn)
+            if not request[4]:
+                self.rtt.sample(time.time() - request[2])
+            if request[5]:
+                self.traces.record(request[5], 'ack', message['slot'])
+
+            if not request[1].done():
+                request[1].set_result(message['slot'])
+            self.window = min(self.window + 1 / self.window, self.max_outstanding)
+            self.fill_window()
+
+        elif message_type == 'busy_to_client':
+            request = self.outstanding.get(message['request_no'], None)
+            if request is None:
+                return
+
+            # The requests sent before the window was last shrunk do not shrink it again
+            if message['request_no'] >= self.window_since:
+                self.window = max(self.window / 2, 1)
+                self.window_since = self.next_request_no
+
+            # The leader is alive, so the request waits rather than timing out
+            request[4] = True
+            request[6] = time.time() + BUSY_RETRY * random.uniform(1, 2)
+            request[3] = request[6] + self.rtt.timeout()
+            if request[5]:
+                self.traces.record(request[5], 'busy')
+
+        elif message_type == 'new_leader_to_client':
+            # It is possible that I have sent multiple same timeout messages
+            if message['propose_no'] > self.leader_propose_no:
+                self.leader_propose_no = message['propose_no']
+                self.resend_to_leader(time.time())
+
+        elif message_type == 'read_reply':
+            read = self.reads.pop(message['read_no'], None)
+            if read is None:
+                return
+
+            # A follower read waits for min_slot, which is not a round trip
+            if read[2] is None and not read[6]:
+                self.rtt.sample(time.time() - read[4])
+
+            if not read[0].done():
+                read[0].set_result((message['values'], message['start_slot'],
+                                    message['end_slot']))
+
+
+# Awaits the future returned by func(*args), which has to be called on the loop
+async def u_await(func, *args):
+    return await func(*args)
+
+
+# The blocking flavor of AsyncChatClient, whose methods return
+#   concurrent.futures.Future instead
+class ChatClient(object):
+    def __init__(self, client_id, ip, port, replica_config, **options):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        self.client = asyncio.run_coroutine_threadsafe(
+            AsyncChatClient.connect(client_id, ip, port, replica_config, **options),
+            self.loop).result()
+
+    def send(self, value):
+        return asyncio.run_coroutine_threadsafe(u_await(self.client.send, value), self.loop)
+
+    def read(self, start_slot=0):
+        return asyncio.run_coroutine_threadsafe(u_await(self.client.read, start_slot),
+                                                self.loop)
+
+    def read_any(self, start_slot=0, min_slot=0, replica_id=None):
+        return asyncio.run_coroutine_threadsafe(
+            u_await(self.client.read_any, start_slot, min_slot, replica_id), self.loop)
+
+    def print_log(self):
+        self.loop.call_soon_threadsafe(self.client.print_log)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.client.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -0,0 +1,62 @@
+#!/usr/env/bin python3
+
+'''
+    Leveled logging of a replica, written by a thread of its own.
+
+    A replica only puts log records on a queue, and a QueueListener thread
+    formats them and writes them to stdout, so a slow terminal or a full pipe
+    never blocks the message path. The records of single messages are logged
+    at the debug level, and only one in every sample of them is kept. Unless
+    the level is debug, they cost one check for None per message.
+'''
+
+import sys
+import queue
+import logging
+import logging.handlers
+
+
+# The levels a replica can be configured with, from the most verbose
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+
+
+# Logs one in every sample of the records of single messages
+class MessageLog(object):
+    def __init__(self, logger, sample):
+        self.logger = logger
+        self.sample = max(sample, 1)
+        self.count = 0
+
+    def debug(self, msg, *args):
+        self.count += 1
+        if self.count >= self.sample:
+            self.count = 0
+            self.logger.debug(msg, *args)
+
+
+# Returns the logger of the replica and the QueueListener which writes its
+#   records to stdout, as 'time level replica=id key=value ...'
+# Stopping the listener writes the records still queued, which is up to the
+#   caller, as atexit handlers do not run in multiprocessing children
+def u_replica_logger(replica_id, level='info'):
+    logger = logging.getLogger('paxos.replica.{}'.format(replica_id))
+    logger.setLevel(getattr(logging, level.upper(), logging.INFO))
+    logger.propagate = False
+
+    # The records are formatted by the listener thread
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(levelname)s replica={} %(message)s'.format(replica_id)))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+
+    logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    return logger, listener
+
+
+# Returns the MessageLog of logger, None if its records would not be kept
+def u_message_log(logger, sample):
+    if not logger.isEnabledFor(logging.DEBUG):
+        return None
+    return MessageLog(logger, sample)
@@ -0,0 +1,136 @@
+#!/usr/env/bin python3
+
+'''
+    The counters, gauges and histograms of a replica, served in the
+    Prometheus text format.
+
+    Every metric is registered once with its help text and at most one label,
+    e.g. the message type, so that counting on the message path is a single
+    dict update. Gauges are read from the replica only when they are scraped.
+    The metrics are served over HTTP by a thread of their own, which reads
+    them while the replica keeps changing them.
+'''
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Upper bounds in seconds of the buckets of a latency histogram
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+
+# Counts observations into buckets by their upper bounds
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        # The count of every bucket, the last one is above every bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Returns [(upper bound, cumulative count)], ending with '+Inf'
+    def cumulative(self):
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), list(self.counts)):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics(object):
+    # const_labels is [(name, value)] added to every sample, e.g. the replica id
+    def __init__(self, const_labels):
+        self.const_labels = ','.join('{}="{}"'.format(name, value)
+                                     for name, value in const_labels)
+        # { name : (type, help, label) } in the order registered
+        self.meta = {}
+        # { name : { label_value : value } }
+        self.counters = {}
+        # { name : function returning the value }
+        self.gauges = {}
+        # { name : Histogram }
+        self.histograms = {}
+
+    def counter(self, name, help_text, label=None):
+        self.meta[name] = ('counter', help_text, label)
+        # A counter without a label is shown as 0 until it is counted
+        self.counters[name] = {} if label is not None else { None : 0 }
+
+    def gauge(self, name, help_text, func):
+        self.meta[name] = ('gauge', help_text, None)
+        self.gauges[name] = func
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.meta[name] = ('histogram', help_text, None)
+        self.histograms[name] = Histogram(buckets)
+
+    def inc(self, name, label_value=None, value=1):
+        samples = self.counters[name]
+        samples[label_value] = samples.get(label_value, 0) + value
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def labels(self, extra=''):
+        labels = ','.join(part for part in (self.const_labels, extra) if part)
+        return '{' + labels + '}' if labels else ''
+
+    # Returns every metric in the Prometheus text format
+    # The dicts are copied by list(), which does not let the replica thread in
+    def render(self):
+        lines = []
+        for name, (metric_type, help_text, label) in list(self.meta.items()):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+
+            if metric_type == 'counter':
+                for label_value, value in sorted(list(self.counters[name].items()),
+                                                 key=lambda item: str(item[0])):
+                    extra = '' if label is None else '{}="{}"'.format(label, label_value)
+                    lines.append('{}{} {}'.format(name, self.labels(extra), value))
+
+            elif metric_type == 'gauge':
+                lines.append('{}{} {}'.format(name, self.labels(), self.gauges[name]()))
+
+            else:
+                histogram = self.histograms[name]
+                for bound, count in histogram.cumulative():
+                    lines.append('{}_bucket{} {}'.format(
+                        name, self.labels('le="{}"'.format(bound)), count))
+                lines.append('{}_sum{} {}'.format(name, self.labels(), histogram.sum))
+                lines.append('{}_count{} {}'.format(name, self.labels(), histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+
+# Serves metrics at http://ip:port/metrics on a daemon thread
+# Returns the server, which stops with the process
+def u_serve_metrics(metrics, ip, port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Scrapes are not printed
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((ip, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,81 @@
+#!/usr/env/bin python3
+
+'''
+    CPU and allocation profiling of a replica process.
+
+    u_run_profiled runs a replica under cProfile with tracemalloc tracing
+    every allocation, and writes what they have seen so far
+
+        [prefix].prof   the cProfile stats, to be read by pstats or snakeviz
+        [prefix].txt    the top functions by cumulative and own time, and the
+                        source lines holding the most allocated memory
+
+    whenever the process gets SIGUSR1, and once more when it stops on SIGTERM
+    or SIGINT. Only the thread running the replica is profiled, not the
+    threads writing logs or serving metrics.
+'''
+
+import os
+import io
+import time
+import pstats
+import signal
+import cProfile
+import tracemalloc
+
+
+# Number of frames tracemalloc keeps of every allocation
+PROFILE_FRAMES = 1
+
+
+# Writes the stats of profiler and the allocations traced so far
+def u_write_profile(profiler, file_prefix, top):
+    os.makedirs(os.path.dirname(file_prefix), exist_ok=True)
+    profiler.dump_stats(file_prefix + '.prof')
+
+    report = io.StringIO()
+    report.write('Profile of pid {} at {}\n\n'.format(
+        os.getpid(), time.strftime('%Y-%m-%d %H:%M:%S')))
+
+    stats = pstats.Stats(profiler, stream=report)
+    stats.sort_stats('cumulative').print_stats(top)
+    stats.sort_stats('tottime').print_stats(top)
+
+    report.write('Top {} allocations by source line\n\n'.format(top))
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        report.write('traced memory: {} KiB now, {} KiB at peak\n'.format(
+            current // 1024, peak // 1024))
+        for stat in tracemalloc.take_snapshot().statistics('lineno')[:top]:
+            report.write('{}\n'.format(stat))
+
+    with open(file_prefix + '.txt', 'w') as report_handle:
+        report_handle.write(report.getvalue())
+
+
+# Runs target(*args) under cProfile and tracemalloc, writing the profile to
+#   file_prefix on SIGUSR1 and when stopped by SIGTERM or SIGINT
+def u_run_profiled(file_prefix, top, target, *args):
+    profiler = cProfile.Profile()
+
+    # The stats can only be taken while the profiler is off
+    def dump(signum, frame):
+        profiler.disable()
+        u_write_profile(profiler, file_prefix, top)
+        profiler.enable()
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGUSR1, dump)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    tracemalloc.start(PROFILE_FRAMES)
+    profiler.enable()
+    try:
+        target(*args)
+    finally:
+        profiler.disable()
+        u_write_profile(profiler, file_prefix, top)
+        tracemalloc.stop()
@@ -0,0 +1,103 @@
+#!/usr/env/bin python3
+
+'''
+    The per-slot state of a replica.
+
+    Slots are kept in one contiguous list of SlotRecord, indexed by the slot
+    number minus base_slot. Every slot below base_slot has been chosen and
+    compacted into a snapshot, so no state is left for it. The list grows on
+    demand when a slot past its end is accessed, and slots nobody has
+    touched hold the default values of SlotRecord.
+'''
+
+
+class SlotRecord(object):
+    __slots__ = ('value', 'proposer', 'client_request', 'client_addr',
+                 'accept_count', 'ack_count', 'learned')
+
+    def __init__(self):
+        # The accepted batch of values, None if nothing is accepted
+        # An empty batch is a no-op the leader filled a hole with
+        self.value = None
+        # The propose_no of the accepted value
+        self.proposer = 0
+        # [(client_id, request_id)] and [(client_ip, client_port)] of the values
+        self.client_request = None
+        self.client_addr = None
+        # Count of accept message from replicas
+        self.accept_count = 0
+        # Count of ack message from replicas, only used by the leader
+        self.ack_count = 0
+        self.learned = False
+
+    def accept(self, value, proposer, client_request, client_addr):
+        self.value = value
+        self.proposer = proposer
+        self.client_request = client_request
+        self.client_addr = client_addr
+
+
+class SlotLog(object):
+    def __init__(self):
+        self.base_slot = 0
+        self.records = []
+
+    # Returns the record of slot, which must not have been compacted
+    def __getitem__(self, slot):
+        assert ( slot >= self.base_slot )
+
+        idx = slot - self.base_slot
+        while idx >= len(self.records):
+            self.records.append(SlotRecord())
+        return self.records[idx]
+
+    # The slot right after the last one with a record
+    def end_slot(self):
+        return self.base_slot + len(self.records)
+
+    # Compacted slots count as learned
+    def is_learned(self, slot):
+        if slot < self.base_slot:
+            return True
+        idx = slot - self.base_slot
+        return idx < len(self.records) and self.records[idx].learned
+
+    # Yields (slot, record) of every slot from start_slot on which has a record
+    def items(self, start_slot=None):
+        start_slot = self.base_slot if start_slot is None else max(start_slot, self.base_slot)
+        for idx in range(start_slot - self.base_slot, len(self.records)):
+            yield self.base_slot + idx, self.records[idx]
+
+    # Collects every value accepted from start_slot on
+    # Returns { slot_no : [value, propose_no, client_request, client_addr] }
+    def accepted_since(self, start_slot):
+        return { slot : [record.value, record.proposer,
+                         record.client_request, record.client_addr]
+                 for slot, record in self.items(start_slot)
+                 if record.value is not None }
+
+    # Returns the parallel lists [value], [propose_no], [client_request], [client_addr]
+    #   of the slots from start_slot to end_slot (exclusive)
+    def read_range(self, start_slot, end_slot):
+        assert ( start_slot >= self.base_slot and end_slot <= self.end_slot() )
+
+        records = self.records[start_slot - self.base_slot:end_slot - self.base_slot]
+        return ([record.value for record in records],
+                [record.proposer for record in records],
+                [record.client_request for record in records],
+                [record.client_addr for record in records])
+
+    # Accepts the parallel lists of values into the slots from start_slot on,
+    #   skipping the compacted ones
+    def write_range(self, start_slot, value, proposer, client_request, client_addr):
+        for idx in range(max(self.base_slot - start_slot, 0), len(value)):
+            self[start_slot + idx].accept(value[idx], proposer[idx],
+                                          client_request[idx], client_addr[idx])
+
+    # Drops the records of every slot below base_slot
+    def compact(self, base_slot):
+        if base_slot <= self.base_slot:
+            return
+
+        del self.records[:base_slot - self.base_slot]
+        self.base_slot = base_slot
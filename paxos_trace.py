@@ -0,0 +1,180 @@
+#!/usr/env/bin python3
+
+'''
+    Tracing of single client requests through the replicas.
+
+    A client may give a request a trace id, which is carried by its
+    client_request, by the propose and accept messages of the slot it is
+    packed in, and by its ack_client. Every replica records the hops of the
+    traced requests it sees in a TraceBuffer, a ring buffer of
+
+        [time, trace_id, hop, slot]
+
+    and sends it back on trace_dump messages, a chunk at a time so that the
+    datagrams do not overflow the receive buffer. u_collect_traces gathers
+    the buffers of every replica, and u_timelines puts the hops of every request
+    in time order across all of them. Hops are timed by the clock of each
+    process, so timelines across machines are only as good as their clocks.
+
+    The hops recorded by replicas are
+        request         a client_request arrived, again for every resend
+        propose         the leader proposed the slot
+        propose_recv    a follower accepted the propose of the slot
+        accept_recv     an accept of the slot arrived
+        chosen          a majority accepted the slot
+    and the ones recorded by paxos_client are send, timeout, busy, resend and ack.
+'''
+
+import time
+import socket
+from collections import deque
+from paxos_util import paxos_trace_dump, u_bind_socket, UdpSender
+from paxos_wire import u_decode_message, FrameAssembler, RECV_BUFFER
+
+
+# Number of hops a TraceBuffer keeps by default
+TRACE_BUFFER = 4096
+# Max number of hops sent in one trace_events message
+TRACE_CHUNK = 256
+# Times a chunk is asked for before the replica is given up
+TRACE_RETRIES = 3
+
+
+# Keeps the latest hops of traced requests, the oldest ones are overwritten
+class TraceBuffer(object):
+    def __init__(self, size=TRACE_BUFFER):
+        self.events = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.events)
+
+    def record(self, trace_id, hop, slot=-1):
+        self.events.append([time.time(), trace_id, hop, slot])
+
+    # Records hop for every trace id in traces, 0 is not traced
+    def record_all(self, traces, hop, slot=-1):
+        now = time.time()
+        for trace_id in traces:
+            if trace_id:
+                self.events.append([now, trace_id, hop, slot])
+
+    # Returns [[time, trace_id, hop, slot]] of trace_id, or of every trace if 0
+    def dump(self, trace_id=0):
+        return [list(event) for event in self.events
+                if trace_id == 0 or event[1] == trace_id]
+
+
+# Asks every replica in turn for its hops of trace_id, or of every trace if 0,
+#   from a socket bound to (ip, port), waiting up to timeout seconds for every
+#   chunk and asking for it again up to TRACE_RETRIES times
+# Returns [[time, trace_id, source, hop, slot]], source being e.g. 'replica 0',
+#   and the ids of the replicas which did not send every chunk
+def u_collect_traces(replica_config, ip, port, trace_id=0, timeout=0.5):
+    my_socket = u_bind_socket(ip, port)
+    sender = UdpSender(-1, my_socket, replica_config, 0)
+    assembler = FrameAssembler()
+
+    events = []
+    missing = []
+    try:
+        for replica_id in sorted(replica_config):
+            replica_events = u_collect_replica_traces(my_socket, sender, assembler,
+                                                      replica_id, trace_id, timeout)
+            if replica_events is None:
+                missing.append(replica_id)
+                continue
+
+            source = 'replica {}'.format(replica_id)
+            events += [[event[0], event[1], source, event[2], event[3]]
+                       for event in replica_events]
+    finally:
+        my_socket.close()
+
+    return events, missing
+
+
+# Returns the hops of replica_id chunk by chunk, None if a chunk never arrives
+def u_collect_replica_traces(my_socket, sender, assembler, replica_id, trace_id, timeout):
+    ip, port = my_socket.getsockname()
+    events = []
+    total = None
+    retries = 0
+
+    while total is None or len(events) < total:
+        if retries == TRACE_RETRIES:
+            return None
+        retries += 1
+
+        # Asking for the first chunk again would take the hops anew
+        start = len(events)
+        paxos_trace_dump(sender, ip, port, trace_id, start, replica_id)
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            my_socket.settimeout(max(deadline - time.time(), 0.001))
+            try:
+                data, addr = my_socket.recvfrom(RECV_BUFFER)
+            except socket.timeout:
+                break
+
+            # Chunks may still be sent in a few frames
+            data = assembler.feed(data, addr)
+            if data is None:
+                continue
+
+            message = u_decode_message(data)
+            if message['message_type'] != 'trace_events' or\
+                    message['replica_id'] != replica_id or message['start'] != start:
+                continue
+
+            total = message['total']
+            events += message['events']
+            retries = 0
+            break
+
+    return events
+
+
+# Adds the hops of a TraceBuffer of a client to events of u_collect_traces
+def u_add_client_traces(events, trace_buffer, client_id):
+    source = 'client {}'.format(client_id)
+    events += [[event[0], event[1], source, event[2], event[3]]
+               for event in trace_buffer.dump()]
+
+
+# Returns { trace_id : [[time, source, hop, slot]] } in time order
+def u_timelines(events):
+    timelines = {}
+    for event_time, trace_id, source, hop, slot in events:
+        timelines.setdefault(trace_id, []).append([event_time, source, hop, slot])
+
+    for timeline in timelines.values():
+        timeline.sort(key=lambda event: event[0])
+    return timelines
+
+
+# Returns the seconds from the first hop of timeline to its last ack, or to its
+#   last chosen hop if no ack was recorded, None if it was not chosen
+def u_trace_latency(timeline):
+    for hops in (('ack',), ('chosen',)):
+        ends = [event[0] for event in timeline if event[2] in hops]
+        if ends:
+            return max(ends) - timeline[0][0]
+    return None
+
+
+# Returns [(latency, trace_id)] of the count slowest timelines, the requests
+#   never chosen first
+def u_slowest_traces(timelines, count):
+    latencies = [(u_trace_latency(timeline), trace_id)
+                 for trace_id, timeline in timelines.items()]
+    latencies.sort(key=lambda item: float('inf') if item[0] is None else item[0],
+                   reverse=True)
+    return latencies[:count]
+
+
+# Returns the timeline as [[ms since its first hop, source, hop, slot]]
+def u_relative_timeline(timeline):
+    start = timeline[0][0]
+    return [[round((event_time - start) * 1000, 3), source, hop, slot]
+            for event_time, source, hop, slot in timeline]
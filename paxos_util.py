@@ -3,19 +3,20 @@
 '''
     The functions prepended by paxos_ are the ones involving message delivery
     during the protocol. The functions prepended by u_ are general utilities.
+    All messages go through a UdpSender owned by the replica or client.
 '''
 
-import json
 import socket
 import random
+from collections import OrderedDict, deque
+from paxos_wire import u_encode_message, u_split_frames
  
 
 # This function is used in Paxos prepare stage (leader -> replicas)
-def paxos_prepare(my_id,
+# The prepare covers every slot from slot on
+def paxos_prepare(sender,
                   propose_no,
-                  slot,
-                  replica_config,
-                  drop_rate):
+                  slot):
     # Send 'propose' message to every other replica
     message = {
         'message_type' : 'prepare',
@@ -23,49 +24,45 @@ def paxos_prepare(my_id,
         'slot' : slot
     }
 
-    for replica_addr in replica_config.values():
-        u_send_message(message, replica_addr['ip'],
-                                replica_addr['port'], my_id, drop_rate)  
+    sender.broadcast(message)
 
 
 # This function is used in Paxos prepare ack stage (replica -> leader)
-def paxos_ack_prepare(my_id,
-                      value,
-                      propose_no,
-                      client_request,
-                      client_addr,
-                      no_more_accepted,
+# accepted_since is { slot_no : [value, propose_no, client_request, client_addr] }
+#   holding every value accepted from the prepared slot on
+def paxos_ack_prepare(sender,
+                      accepted_since,
                       slot,
                       leader_propose_no,
-                      leader_id,
-                      replica_config,
-                      drop_rate):
+                      leader_id):
+    slots = sorted(accepted_since)
+
     # Send acknowledge to 'propose' message to the leader
     message = {
         'message_type' : 'ack_prepare',
-        'accepted' : value,
-        'value_proposer' : propose_no,
-        'client_request' : client_request,
-        'client_addr' : client_addr,
-        'no_more_accepted' : no_more_accepted,
+        'slots' : slots,
+        'accepted' : [accepted_since[i][0] for i in slots],
+        'value_proposer' : [accepted_since[i][1] for i in slots],
+        'client_request' : [accepted_since[i][2] for i in slots],
+        'client_addr' : [accepted_since[i][3] for i in slots],
         'proposer' : leader_propose_no,
         'slot' : slot
     }
 
-    u_send_message(message, replica_config[leader_id]['ip'], 
-                            replica_config[leader_id]['port'], my_id, drop_rate)
+    sender.send_to_replica(message, leader_id)
 
 
 # This function is used in Paxos propose stage (leader -> replicas)
-def paxos_propose(my_id,
+# retry is set when the slot is proposed again, as its messages may have been lost
+def paxos_propose(sender,
                   value,
                   propose_no,
                   client_request,
                   client_addr,
                   first_unchosen,
                   slot,
-                  replica_config,
-                  drop_rate):
+                  traces,
+                  retry=False):
     message = {
         'message_type' : 'propose',
         'to_accept' : value,
@@ -73,170 +70,169 @@ def paxos_propose(my_id,
         'client_request' : client_request,
         'client_addr' : client_addr,
         'first_unchosen' : first_unchosen,
-        'slot' : slot
+        'slot' : slot,
+        'traces' : traces,
+        'retry' : int(retry)
     }
 
-    for replica_addr in replica_config.values():
-        u_send_message(message, replica_addr['ip'],
-                                replica_addr['port'], my_id, drop_rate) 
+    sender.broadcast(message)
 
 
 # This function is used in Paxos accept stage (replica -> replicas)
-def paxos_accept(my_id,
+# traces are the trace ids of the client requests in the slot, see paxos_trace,
+#   or [] if none of them is traced
+# The accept only goes to receiver_id if it is set
+def paxos_accept(sender,
                  value,
                  propose_no,
                  client_request,
                  client_addr,
                  slot,
-                 replica_config,
-                 drop_rate):
+                 traces,
+                 receiver_id=None):
     message = {
         'message_type' : 'accept',
         'accepted' : value,
         'proposer' : propose_no,
         'client_request' : client_request,
         'client_addr' : client_addr,
-        'slot' : slot
+        'slot' : slot,
+        'traces' : traces
     }
 
-    for replica_addr in replica_config.values():
-        u_send_message(message, replica_addr['ip'],
-                                replica_addr['port'], my_id, drop_rate)
+    if receiver_id is None:
+        sender.broadcast(message)
+    else:
+        sender.send_to_replica(message, receiver_id)
 
 
 # This function is used by replicas to send ack to the client when the value is learned
 # client_addr[0]: ip, client_addr[1]: port
-def paxos_ack_client(my_id,
+# slot is the slot the value was chosen in, or any later chosen slot
+def paxos_ack_client(sender,
                      request_no,
                      client_addr,
-                     drop_rate):
+                     slot,
+                     trace_id=0):
     message = {
         'message_type' : 'ack_client',
-        'request_no' : request_no
+        'request_no' : request_no,
+        'slot' : slot,
+        'trace_id' : trace_id
     }
 
-    u_send_message(message, client_addr[0], 
-                            client_addr[1], my_id, drop_rate)
+    sender.send(message, client_addr[0], client_addr[1])
 
 
 # This function is used by replicas to tell the client the new leader
-def paxos_tell_client_new_leader(my_id,
+def paxos_tell_client_new_leader(sender,
                                  propose_no,
                                  client_ip,
-                                 client_port,
-                                 drop_rate):
+                                 client_port):
     message = {
         'message_type' : 'new_leader_to_client',
         'propose_no' : propose_no
     }
 
-    u_send_message(message, client_ip,
-                            client_port, my_id, drop_rate)
+    sender.send(message, client_ip, client_port)
+
+
+# This function is used by the leader to tell the client that its request was
+#   not queued, and is to be sent again later
+def paxos_tell_client_busy(sender,
+                           request_no,
+                           client_ip,
+                           client_port):
+    message = {
+        'message_type' : 'busy_to_client',
+        'request_no' : request_no
+    }
+
+    sender.send(message, client_ip, client_port)
 
 
 # This function is used by client to send request to replicas 
-def paxos_client_request(my_id,
+def paxos_client_request(sender,
                          my_ip,
                          my_port,
                          request_no,
                          leader_propose_no,
                          value,
-                         replica_config,
-                         drop_rate):
+                         trace_id=0):
 
     message = {
         'message_type' : 'client_request',
-        'client_id' : my_id,
+        'client_id' : sender.my_id,
         'client_ip' : my_ip,
         'client_port' : my_port,
         'client_request_no' : request_no,
         'propose_no' : leader_propose_no,
-        'value' : value
+        'value' : value,
+        'trace_id' : trace_id
     }
 
     # Get the leader id
-    replica_num = len(replica_config)
-    leader_id = u_get_id(leader_propose_no, replica_num)
+    leader_id = u_get_id(leader_propose_no, sender.replica_num)
 
-    u_send_message(message, replica_config[leader_id]['ip'],
-                            replica_config[leader_id]['port'], my_id, drop_rate)
+    sender.send_to_replica(message, leader_id)
 
 
 # This function is used by client to send timeout to replicas
-def paxos_client_timeout(my_id,
+def paxos_client_timeout(sender,
                          my_ip,
                          my_port,
                          request_no,
-                         leader_propose_no,
-                         replica_config,
-                         drop_rate):
+                         leader_propose_no):
     message = {
         'message_type' : 'client_timeout',
-        'client_id' : my_id,
+        'client_id' : sender.my_id,
         'client_ip' : my_ip,
         'client_port' : my_port,
         'client_request_no' : request_no,
         'propose_no' : leader_propose_no
     }
 
-    for replica_addr in replica_config.values():
-        u_send_message(message, replica_addr['ip'],
-                                replica_addr['port'], my_id, drop_rate)
+    sender.broadcast(message)
 
 
 # This function is used by client to trigger log printing
-def paxos_print_log(my_id,
-                    replica_config):
+def paxos_print_log(sender):
     message = {
         'message_type' : 'print_log'
     }
 
-    for replica_addr in replica_config.values():
-        u_send_message(message, replica_addr['ip'],
-                                replica_addr['port'], my_id, 0)
+    sender.broadcast(message, drop_rate=0)
 
 
 # This function is used by replicas to catch up with chosen values
-def paxos_help_me_choose(my_id,
+# my_line_count is the chat log line the next chunk of a snapshot starts at,
+#   in case the slots asked for have been compacted
+def paxos_help_me_choose(sender,
                          my_first_unchosen,
-                         leader_id,
-                         replica_config,
-                         drop_rate):
+                         my_line_count,
+                         leader_id):
     message = {
         'message_type' : 'help_me_choose',
-        'replica_id' : my_id,
-        'first_unchosen' : my_first_unchosen
+        'replica_id' : sender.my_id,
+        'first_unchosen' : my_first_unchosen,
+        'line_count' : my_line_count
     }
 
 
-    u_send_message(message, replica_config[leader_id]['ip'],
-                            replica_config[leader_id]['port'], my_id, drop_rate)
+    sender.send_to_replica(message, leader_id)
 
 
 # This function is sent to help others catch up with chosen values
-# start_slot is inclusive, end_slot is exclusive
-def paxos_you_can_choose(my_id,
+# start_slot is inclusive, end_slot is exclusive, and the lists hold the
+#   values of every slot in between (see SlotLog.read_range)
+def paxos_you_can_choose(sender,
                          start_slot,
                          end_slot,
-                         s_accepted,
-                         s_proposer,
-                         s_client_request,
-                         s_client_addr,
-                         receiver_ip,
-                         receiver_port,
-                         drop_rate):
-    
-    accepted = []
-    proposer = []
-    client_request = [] 
-    client_addr = []
-
-    for i in range(start_slot, end_slot):
-        accepted.append(s_accepted[i])
-        proposer.append(s_proposer[i])
-        client_request.append(s_client_request[i])
-        client_addr.append(s_client_addr[i])
-
+                         accepted,
+                         proposer,
+                         client_request,
+                         client_addr,
+                         receiver_id):
     message = {
         'message_type' : 'you_can_choose',
         'start_slot' : start_slot,
@@ -247,36 +243,464 @@ def paxos_you_can_choose(my_id,
         'client_addr' : client_addr
     }
 
-    u_send_message(message, receiver_ip,
-                            receiver_port, my_id, drop_rate)
+    sender.send_to_replica(message, receiver_id)
+
+
+# This function is sent instead of you_can_choose for the slots which have
+#   been compacted into a snapshot, one chunk at a time
+# The chat log of the slots below snapshot_slot has line_count lines, of which
+#   lines are the ones from start_line on. The last chunk also holds the
+#   client sessions (see ClientSessions.to_list) at snapshot_slot
+def paxos_install_snapshot(sender,
+                           snapshot_slot,
+                           line_count,
+                           start_line,
+                           lines,
+                           sessions,
+                           receiver_id):
+    message = {
+        'message_type' : 'install_snapshot',
+        'replica_id' : sender.my_id,
+        'snapshot_slot' : snapshot_slot,
+        'line_count' : line_count,
+        'start_line' : start_line,
+        'lines' : lines,
+        'sessions' : sessions
+    }
+
+    sender.send_to_replica(message, receiver_id)
+
+
+# This function is used by the leader to ask for a lease (leader -> replicas)
+def paxos_lease_request(sender,
+                        propose_no,
+                        lease_no):
+    message = {
+        'message_type' : 'lease_request',
+        'proposer' : propose_no,
+        'lease_no' : lease_no
+    }
+
+    sender.broadcast(message)
+
+
+# This function is used by replicas to grant the leader its lease (replica -> leader)
+def paxos_lease_grant(sender,
+                      propose_no,
+                      lease_no,
+                      leader_id):
+    message = {
+        'message_type' : 'lease_grant',
+        'proposer' : propose_no,
+        'lease_no' : lease_no,
+        'replica_id' : sender.my_id
+    }
+
+    sender.send_to_replica(message, leader_id)
+
+
+# This function is used by the leader to tell every replica it is alive and
+#   how far it has chosen (leader -> replica)
+def paxos_heartbeat(sender,
+                    propose_no,
+                    first_unchosen):
+    message = {
+        'message_type' : 'heartbeat',
+        'proposer' : propose_no,
+        'first_unchosen' : first_unchosen
+    }
+
+    sender.broadcast(message)
+
+
+# This function is used by client to read the messages chosen from start_slot on
+def paxos_client_read(sender,
+                      my_ip,
+                      my_port,
+                      read_no,
+                      leader_propose_no,
+                      start_slot):
+    message = {
+        'message_type' : 'client_read',
+        'client_id' : sender.my_id,
+        'client_ip' : my_ip,
+        'client_port' : my_port,
+        'read_no' : read_no,
+        'propose_no' : leader_propose_no,
+        'start_slot' : start_slot
+    }
+
+    # Get the leader id
+    leader_id = u_get_id(leader_propose_no, sender.replica_num)
+
+    sender.send_to_replica(message, leader_id)
+
+
+# This function is used by client to read the messages chosen from start_slot on
+#   from any replica which has applied every slot below min_slot
+def paxos_follower_read(sender,
+                        my_ip,
+                        my_port,
+                        read_no,
+                        min_slot,
+                        start_slot,
+                        replica_id):
+    message = {
+        'message_type' : 'follower_read',
+        'client_id' : sender.my_id,
+        'client_ip' : my_ip,
+        'client_port' : my_port,
+        'read_no' : read_no,
+        'min_slot' : min_slot,
+        'start_slot' : start_slot
+    }
+
+    sender.send_to_replica(message, replica_id)
 
 
-# General routine for sending message to the receiver
-def u_send_message(message_body,
-                   receiver_ip,
-                   receiver_port,
-                   my_id,
-                   drop_rate):
+# This function is used by replicas to answer a client read
+# values are the messages chosen from start_slot up to end_slot (exclusive),
+#   start_slot being later than the requested one if that has been compacted
+def paxos_read_reply(sender,
+                     read_no,
+                     start_slot,
+                     end_slot,
+                     values,
+                     client_addr):
+    message = {
+        'message_type' : 'read_reply',
+        'read_no' : read_no,
+        'start_slot' : start_slot,
+        'end_slot' : end_slot,
+        'values' : values
+    }
 
-    random_num = random.randint(1, 100)
+    sender.send(message, client_addr[0], client_addr[1])
 
-    if random_num <= drop_rate:
-        print('Replica {} dropped message {}'.format(my_id,
-                                                     message_body['message_type']))
-        return
 
-    print('Replica {} send message {} to {}'.format(my_id, message_body['message_type'], receiver_port))
+# This function is used to ask a replica for the hops of trace_id it has
+#   recorded, or of every trace if 0, from the start-th one on
+# The hops are taken as of the dump with start 0
+def paxos_trace_dump(sender,
+                     my_ip,
+                     my_port,
+                     trace_id,
+                     start,
+                     replica_id):
+    message = {
+        'message_type' : 'trace_dump',
+        'client_ip' : my_ip,
+        'client_port' : my_port,
+        'trace_id' : trace_id,
+        'start' : start
+    }
 
-    # Serialize message_body to proper format
-    data = json.dumps(message_body).encode('utf-8')
+    sender.send_to_replica(message, replica_id, drop_rate=0)
 
-    # Send the message using UDP socket for non-blocking
-    receiver_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    receiver_socket.sendto(data, (receiver_ip, receiver_port))
-    receiver_socket.close()
+
+# This function is used by replicas to answer trace_dump
+# events are [[time, trace_id, hop, slot]] from the start-th of total hops,
+#   which is always sent as JSON
+def paxos_trace_events(sender,
+                       start,
+                       total,
+                       events,
+                       client_addr):
+    message = {
+        'message_type' : 'trace_events',
+        'replica_id' : sender.my_id,
+        'start' : start,
+        'total' : total,
+        'events' : events
+    }
+
+    sender.send(message, client_addr[0], client_addr[1], drop_rate=0)
+
+
+# General routine for sending messages to the receivers
+# One bound socket is reused for every message, and receiver addresses are
+#   resolved only once
+class UdpSender(object):
+    def __init__(self,
+                 my_id,
+                 my_socket,
+                 replica_config,
+                 drop_rate,
+                 wire_format='binary'):
+        self.my_id = my_id
+        self.my_socket = my_socket
+        self.drop_rate = drop_rate
+        # Either 'binary' or 'json', see paxos_wire
+        self.wire_format = wire_format
+        # Tells apart my messages split into frames
+        self.message_id = 0
+        # { (host, port) : (ip, port) }
+        self.addr_cache = {}
+        # { replica_id : (ip, port) }
+        self.replica_addr = {}
+        for replica_id, replica_data in replica_config.items():
+            self.replica_addr[replica_id] = self.resolve(replica_data['ip'],
+                                                         replica_data['port'])
+        # Number of replicas in replica_config
+        self.replica_num = len(replica_config)
+        # The messages held back by hold() until release(), None if not holding
+        self.held = None
+        # Counts the messages sent and dropped if set, see paxos_metrics
+        self.metrics = None
+        # Logs the messages sent and dropped if set, see paxos_log
+        self.message_log = None
+
+    def resolve(self, host, port):
+        addr = self.addr_cache.get((host, port), None)
+        if addr is None:
+            addr = (socket.gethostbyname(host), port)
+            self.addr_cache[(host, port)] = addr
+        return addr
+
+    def send(self, message_body, receiver_ip, receiver_port, drop_rate=None):
+        # Serialize message_body to proper format
+        data = u_encode_message(message_body, self.wire_format)
+        self.send_data(data, message_body['message_type'],
+                       self.resolve(receiver_ip, receiver_port), drop_rate)
+
+    def send_to_replica(self, message_body, replica_id, drop_rate=None):
+        data = u_encode_message(message_body, self.wire_format)
+        self.send_data(data, message_body['message_type'],
+                       self.replica_addr[replica_id], drop_rate)
+
+    # Sends message_body to every replica, serializing it only once
+    def broadcast(self, message_body, drop_rate=None):
+        data = u_encode_message(message_body, self.wire_format)
+        for addr in self.replica_addr.values():
+            self.send_data(data, message_body['message_type'], addr, drop_rate)
+
+    # Holds back every message sent from now on, e.g. until the state
+    #   they depend on is durable
+    def hold(self):
+        if self.held is None:
+            self.held = []
+
+    # Sends the held messages in order and stops holding
+    def release(self):
+        held, self.held = self.held, None
+        for args in (held or []):
+            self.send_data(*args)
+
+    # Takes the messages held so far, e.g. to send them once the state they
+    #   depend on is durable, and keeps holding the ones sent from now on
+    def take_held(self):
+        held, self.held = (self.held or []), []
+        return held
+
+    # Sends the messages taken by take_held, ahead of the ones held since
+    def send_held(self, held):
+        holding, self.held = self.held, None
+        for args in held:
+            self.send_data(*args)
+        self.held = holding
+
+    # Large messages are split into frames, which are dropped all together
+    def send_data(self, data, message_type, addr, drop_rate=None):
+        if self.held is not None:
+            self.held.append((data, message_type, addr, drop_rate))
+            return
+
+        if drop_rate is None:
+            drop_rate = self.drop_rate
+
+        random_num = random.randint(1, 100)
+
+        if random_num <= drop_rate:
+            if self.metrics is not None:
+                self.metrics.inc('paxos_messages_dropped_total', message_type)
+            if self.message_log is not None:
+                self.message_log.debug('drop type=%s to=%s', message_type, addr[1])
+            return
+
+        if self.metrics is not None:
+            self.metrics.inc('paxos_messages_sent_total', message_type)
+        if self.message_log is not None:
+            self.message_log.debug('send type=%s to=%s', message_type, addr[1])
+
+        self.message_id += 1
+
+        # Send the message using UDP socket for non-blocking
+        for frame in u_split_frames(data, self.message_id):
+            self.my_socket.sendto(frame, addr)
+
+
+# Builds the UDP socket bound to (ip, port) to receive external messages
+def u_bind_socket(ip, port):
+    my_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    my_socket.bind((ip, port))
+    return my_socket
+
+
+# The client requests waiting at the leader, in the order they arrived
+# Requests are keyed by (client_id, client_request_no), so a request resent
+#   by its client while still waiting is merged with the queued one
+class RequestQueue(object):
+    def __init__(self):
+        # deque([(client_id, client_request_no)]) in arrival order
+        self.order = deque()
+        # { (client_id, client_request_no) : client request message }
+        self.requests = {}
+
+    def __len__(self):
+        return len(self.order)
+
+    # key is (client_id, client_request_no)
+    def __contains__(self, key):
+        return key in self.requests
+
+    # Queues the client request message, returns False if it was already waiting
+    def push(self, message):
+        key = (message['client_id'], message['client_request_no'])
+        queued = key in self.requests
+        # The latest copy is kept, in the place of the first one
+        self.requests[key] = message
+        if not queued:
+            self.order.append(key)
+        return not queued
+
+    def clear(self):
+        self.order.clear()
+        self.requests.clear()
+
+    # Pops client requests off the head to be packed into one slot
+    # At most batch_size requests are taken, and further requests are only added
+    #   while the total size of the values stays within batch_bytes
+    # Returns the parallel lists [value], [client_request], [client_addr] and
+    #   [trace_id], the last one being [] if no request is traced
+    def pop_batch(self, batch_size, batch_bytes):
+        value = []
+        client_request = []
+        client_addr = []
+        traces = []
+        value_bytes = 0
+
+        while self.order and len(value) < batch_size:
+            client_message = self.requests[self.order[0]]
+            message_bytes = len(client_message['value'].encode('utf-8'))
+
+            # A single request is always taken, however large it is
+            if value != [] and value_bytes + message_bytes > batch_bytes:
+                break
+
+            del self.requests[self.order.popleft()]
+            value_bytes += message_bytes
+
+            value.append(client_message['value'])
+            client_request.append([client_message['client_id'],
+                                   client_message['client_request_no']])
+            client_addr.append([client_message['client_ip'],
+                                client_message['client_port']])
+            traces.append(client_message.get('trace_id', 0))
+
+        if not any(traces):
+            traces = []
+        return value, client_request, client_addr, traces
+
+
+# Returns whether the leader may propose another slot
+# window is the max number of slots in flight, 0 means unbounded
+def u_window_open(in_flight, window):
+    return (window == 0) or (len(in_flight) < window)
 
 
 # Returns the leader id of the replica
 # propose_no is a monotically increasing number containing the round info
 def u_get_id(propose_no, replica_num):
     return (propose_no % replica_num)
+
+
+
+# Max number of applied request numbers a session keeps above the first one
+#   not applied yet, i.e. how far out of order a client's requests may be chosen
+SESSION_WINDOW = 64
+
+
+# The requests applied for every client, kept as part of the chosen state
+# Clients number their requests 0, 1, 2, ..., so a session only needs the
+#   first request number not applied yet, plus the few applied above it
+# A request skipped for longer than SESSION_WINDOW is given up, i.e. it no
+#   longer holds back the first request number, but it is neither applied
+#   nor acknowledged until it is chosen after all
+# Sessions are applied in slot order and expire after expiry slots without
+#   a request (0 never expires), so every replica holds the same table
+class ClientSessions(object):
+    def __init__(self, expiry):
+        self.expiry = expiry
+        # { client_id : [next_request_no, [request_no applied above it], last_slot,
+        #   [request_no given up below it]] } ordered from the least recently active
+        self.sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def applied(self, client_id, request_no):
+        session = self.sessions.get(client_id, None)
+        if session is None:
+            return False
+        return (request_no < session[0] and request_no not in session[3]) or\
+            request_no in session[1]
+
+    # The slot of the latest request applied for client_id, which must have a session
+    def last_slot(self, client_id):
+        return self.sessions[client_id][2]
+
+    # Applies the request chosen in slot, returns False if it was a duplicate
+    def apply(self, client_id, request_no, slot):
+        self.expire(slot)
+
+        session = self.sessions.get(client_id, None)
+        if session is None:
+            session = [0, [], slot, []]
+            self.sessions[client_id] = session
+
+        if request_no in session[3]:
+            session[3].remove(request_no)
+        elif request_no < session[0] or request_no in session[1]:
+            return False
+        elif request_no == session[0]:
+            session[0] += 1
+        else:
+            session[1].append(request_no)
+
+        # The requests skipped for longer than the window are given up
+        if len(session[1]) > SESSION_WINDOW:
+            first = min(session[1])
+            session[3].extend(range(session[0], first))
+            session[0] = first
+        while session[0] in session[1]:
+            session[1].remove(session[0])
+            session[0] += 1
+
+        session[2] = slot
+        self.sessions.move_to_end(client_id)
+        return True
+
+    def expire(self, slot):
+        if self.expiry == 0:
+            return
+
+        while self.sessions:
+            client_id, session = next(iter(self.sessions.items()))
+            if slot - session[2] <= self.expiry:
+                break
+            del self.sessions[client_id]
+
+    # Returns the sessions as [[client_id, next_request_no, [request_no applied
+    #   above it], last_slot, [request_no given up below it]]]
+    def to_list(self):
+        return [[client_id, session[0], list(session[1]), session[2], list(session[3])]
+                for client_id, session in self.sessions.items()]
+
+    @staticmethod
+    def from_list(session_list, expiry):
+        client_sessions = ClientSessions(expiry)
+        for client_id, next_request_no, above, last_slot, given_up in session_list:
+            client_sessions.sessions[client_id] = [next_request_no, list(above), last_slot,
+                                                   list(given_up)]
+        return client_sessions
@@ -0,0 +1,158 @@
+#!/usr/env/bin python3
+
+'''
+    The write-ahead log of the acceptor state of a replica.
+
+    Every record is appended as
+
+        length (4B) | crc32 (4B) | record
+
+    where record is a list encoded with u_encode_value of paxos_wire. The
+    records are
+
+        ['promise', propose_no]
+        ['accept', slot, value, propose_no, client_request, client_addr]
+        ['learn', slot]
+
+    Records are buffered in memory and made durable together by one fsync
+    (group commit). The replica holds back the messages depending on them
+    until then. A torn record at the end of the file, left by a crash in the
+    middle of a write, is ignored on replay.
+
+    A snapshot covers every slot below its snapshot slot. It is kept in a
+    file of its own holding the single record
+
+        ['snapshot', snapshot_slot, chat_log_line_count, client_sessions]
+
+    after which the log is rewritten with the records of later slots only.
+    The chat log lines of the slots in the snapshot are only kept in the chat
+    log, which is made durable up to the snapshot slot before the snapshot.
+'''
+
+import os
+import time
+import zlib
+import struct
+from paxos_wire import u_encode_value, u_decode_value
+
+
+RECORD_HEADER = struct.Struct('!II')
+
+
+# Returns record encoded with its header
+def u_encode_record(record):
+    parts = []
+    u_encode_value(record, parts)
+    data = b''.join(parts)
+    return RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+
+
+# Writes data to file_name and fsyncs it, replacing the old file at once
+def u_replace_file(file_name, data):
+    temp_file_name = file_name + '.tmp'
+    with open(temp_file_name, 'wb') as file_handle:
+        file_handle.write(data)
+        file_handle.flush()
+        os.fsync(file_handle.fileno())
+    os.replace(temp_file_name, file_name)
+
+
+class WriteAheadLog(object):
+    def __init__(self, file_name, commit_window):
+        base_dir = os.path.dirname(file_name)
+        # The replicas of one config may create it at the same time
+        os.makedirs(base_dir, exist_ok=True)
+
+        self.file_handle = open(file_name, 'ab')
+        # Seconds the first buffered record may wait for others to join its fsync
+        self.commit_window = commit_window
+        # Encoded records not written yet
+        self.buffer = []
+        # The time at which the buffered records have to be committed
+        self.deadline = None
+
+    def append(self, record):
+        self.buffer.append(u_encode_record(record))
+
+        if self.deadline is None:
+            self.deadline = time.time() + self.commit_window
+
+    def pending(self):
+        return self.buffer != []
+
+    # Returns every buffered record encoded, which are not buffered any more
+    # The buffer is only touched by the caller, so that write and rewrite
+    #   can run on another thread meanwhile
+    def take(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.deadline = None
+        return data
+
+    # Writes and fsyncs data taken from the buffer at once
+    def write(self, data):
+        if data == b'':
+            return
+
+        self.file_handle.write(data)
+        self.file_handle.flush()
+        os.fsync(self.file_handle.fileno())
+
+    # Writes and fsyncs every buffered record at once
+    def commit(self):
+        self.write(self.take())
+
+    # Replaces the whole log with records, which have to include the
+    #   buffered ones still needed before the caller takes them
+    def rewrite(self, records):
+        self.file_handle.close()
+        u_replace_file(self.file_handle.name,
+                       b''.join(u_encode_record(record) for record in records))
+        self.file_handle = open(self.file_handle.name, 'ab')
+
+    def close(self):
+        self.commit()
+        self.file_handle.close()
+
+
+# Returns every intact record in file_name, in the order they were appended
+# A torn tail is removed from the file
+def u_replay_wal(file_name):
+    records = []
+    if not os.path.isfile(file_name):
+        return records
+
+    with open(file_name, 'rb') as file_handle:
+        data = file_handle.read()
+
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        record_data = data[start:start + length]
+
+        # Stop at the torn tail
+        if len(record_data) < length or zlib.crc32(record_data) != crc:
+            break
+
+        record, _ = u_decode_value(record_data, 0)
+        records.append(record)
+        offset = start + length
+
+    # Cut off the torn tail so that new records follow the intact ones
+    if offset < len(data):
+        with open(file_name, 'r+b') as file_handle:
+            file_handle.truncate(offset)
+
+    return records
+
+
+# Returns the snapshot record in file_name, None if there is none
+def u_read_snapshot(file_name):
+    records = u_replay_wal(file_name)
+    return records[0] if records else None
+
+
+# Makes snapshot (see above) durable in file_name
+def u_write_snapshot(file_name, snapshot):
+    u_replace_file(file_name, u_encode_record(snapshot))
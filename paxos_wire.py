@@ -0,0 +1,279 @@
+#!/usr/env/bin python3
+
+'''
+    The wire format of messages exchanged by replicas and clients.
+
+    A binary message is laid out as
+
+        version (1B) | message_type (1B) | slot (8B) | proposer (8B) |
+        client_id (8B) | request_no (8B) | payload length (4B) | payload
+
+    The four header fields hold whichever integer fields the message type
+    has (see MESSAGE_LAYOUT), and the payload holds its remaining fields in
+    a fixed order, each encoded as a tagged value. Field names never go on
+    the wire.
+
+    Messages can also be sent as JSON for debugging. u_decode_message tells
+    the two apart by the first byte, so both formats can be mixed freely.
+
+    An encoded message larger than MAX_DATAGRAM is split into frames
+
+        FRAME_MARKER (1B) | message_id (4B) | index (2B) | count (2B) | chunk
+
+    which FrameAssembler puts back together on the receiving side. Smaller
+    messages are sent as they are.
+'''
+
+import json
+import time
+import struct
+
+
+WIRE_VERSION = 1
+
+# The header fields of every binary message, in order
+HEADER_FIELDS = ('slot', 'proposer', 'client_id', 'request_no')
+HEADER = struct.Struct('!BBqqqqI')
+
+# { message_type : ({ header_field : message_field }, [payload_field]) }
+MESSAGE_LAYOUT = {
+    'prepare' : ({ 'slot' : 'slot', 'proposer' : 'proposer' }, []),
+    'ack_prepare' : ({ 'slot' : 'slot', 'proposer' : 'proposer' },
+                     ['slots', 'accepted', 'value_proposer',
+                      'client_request', 'client_addr']),
+    'propose' : ({ 'slot' : 'slot', 'proposer' : 'proposer', 'request_no' : 'retry' },
+                 ['to_accept', 'client_request', 'client_addr', 'first_unchosen', 'traces']),
+    'accept' : ({ 'slot' : 'slot', 'proposer' : 'proposer' },
+                ['accepted', 'client_request', 'client_addr', 'traces']),
+    'ack_client' : ({ 'slot' : 'slot', 'proposer' : 'trace_id',
+                      'request_no' : 'request_no' }, []),
+    'new_leader_to_client' : ({ 'proposer' : 'propose_no' }, []),
+    'busy_to_client' : ({ 'request_no' : 'request_no' }, []),
+    'client_request' : ({ 'slot' : 'trace_id', 'proposer' : 'propose_no',
+                          'client_id' : 'client_id', 'request_no' : 'client_request_no' },
+                        ['client_ip', 'client_port', 'value']),
+    'client_timeout' : ({ 'proposer' : 'propose_no', 'client_id' : 'client_id',
+                          'request_no' : 'client_request_no' },
+                        ['client_ip', 'client_port']),
+    'print_log' : ({}, []),
+    'help_me_choose' : ({ 'slot' : 'first_unchosen', 'proposer' : 'line_count',
+                          'client_id' : 'replica_id' }, []),
+    'you_can_choose' : ({ 'slot' : 'start_slot' },
+                        ['end_slot', 'accepted', 'proposer',
+                         'client_request', 'client_addr']),
+    'install_snapshot' : ({ 'slot' : 'snapshot_slot', 'proposer' : 'line_count',
+                            'client_id' : 'replica_id', 'request_no' : 'start_line' },
+                          ['lines', 'sessions']),
+    'lease_request' : ({ 'slot' : 'lease_no', 'proposer' : 'proposer' }, []),
+    'lease_grant' : ({ 'slot' : 'lease_no', 'proposer' : 'proposer',
+                       'client_id' : 'replica_id' }, []),
+    'client_read' : ({ 'slot' : 'start_slot', 'proposer' : 'propose_no',
+                       'client_id' : 'client_id', 'request_no' : 'read_no' },
+                     ['client_ip', 'client_port']),
+    'follower_read' : ({ 'slot' : 'start_slot', 'proposer' : 'min_slot',
+                         'client_id' : 'client_id', 'request_no' : 'read_no' },
+                       ['client_ip', 'client_port']),
+    'read_reply' : ({ 'slot' : 'end_slot', 'proposer' : 'start_slot',
+                      'request_no' : 'read_no' }, ['values']),
+    'heartbeat' : ({ 'slot' : 'first_unchosen', 'proposer' : 'proposer' }, []),
+    'trace_dump' : ({ 'slot' : 'trace_id', 'proposer' : 'start' },
+                    ['client_ip', 'client_port'])
+}
+
+# The message type enum, 0 is reserved
+MESSAGE_TYPES = sorted(MESSAGE_LAYOUT)
+MESSAGE_CODE = { message_type : code + 1
+                 for code, message_type in enumerate(MESSAGE_TYPES) }
+
+# Tags of the values in the payload
+INT = struct.Struct('!i')
+LONG = struct.Struct('!q')
+LEN = struct.Struct('!I')
+TAG_NONE = 0x4e
+TAG_TRUE = 0x54
+TAG_FALSE = 0x46
+TAG_INT = 0x69
+TAG_LONG = 0x71
+TAG_STR = 0x73
+TAG_LIST = 0x6c
+
+
+# Datagrams are kept below a typical Ethernet MTU
+MAX_DATAGRAM = 1400
+# Size of the receive buffer, large enough for any UDP datagram
+RECV_BUFFER = 65535
+
+FRAME_MARKER = 0x02
+FRAME_HEADER = struct.Struct('!BIHH')
+FRAME_CHUNK = MAX_DATAGRAM - FRAME_HEADER.size
+# Seconds after which an incomplete message is given up
+FRAME_TIMEOUT = 5
+# Max number of incomplete messages kept by a FrameAssembler
+FRAME_MAX_PENDING = 1024
+
+
+# Serializes message_body as 'binary' or 'json'
+# Message types without a binary layout are always sent as JSON
+def u_encode_message(message_body, wire_format='binary'):
+    message_type = message_body['message_type']
+
+    if wire_format == 'json' or message_type not in MESSAGE_LAYOUT:
+        return json.dumps(message_body).encode('utf-8')
+
+    header_map, payload_fields = MESSAGE_LAYOUT[message_type]
+
+    parts = []
+    for field in payload_fields:
+        u_encode_value(message_body[field], parts)
+    payload = b''.join(parts)
+
+    header = [message_body.get(header_map[field], 0) if field in header_map else 0
+              for field in HEADER_FIELDS]
+
+    return HEADER.pack(WIRE_VERSION, MESSAGE_CODE[message_type],
+                       header[0], header[1], header[2], header[3],
+                       len(payload)) + payload
+
+
+# Deserializes data in either format back into the message dict
+def u_decode_message(data):
+    # JSON always starts with '{', which is never a valid version
+    if data[0] != WIRE_VERSION:
+        return json.loads(data.decode('utf-8'))
+
+    version, code, slot, proposer, client_id, request_no, payload_len =\
+        HEADER.unpack_from(data, 0)
+
+    message_type = MESSAGE_TYPES[code - 1]
+    header_map, payload_fields = MESSAGE_LAYOUT[message_type]
+
+    message = { 'message_type' : message_type }
+
+    header = (slot, proposer, client_id, request_no)
+    for idx, field in enumerate(HEADER_FIELDS):
+        if field in header_map:
+            message[header_map[field]] = header[idx]
+
+    offset = HEADER.size
+    end = offset + payload_len
+    for field in payload_fields:
+        message[field], offset = u_decode_value(data, offset)
+
+    assert ( offset == end )
+
+    return message
+
+
+# Appends the tagged encoding of value to parts
+def u_encode_value(value, parts):
+    if value is None:
+        parts.append(bytes((TAG_NONE,)))
+    elif value is True:
+        parts.append(bytes((TAG_TRUE,)))
+    elif value is False:
+        parts.append(bytes((TAG_FALSE,)))
+    elif isinstance(value, int):
+        # Most integers (slots, ports, request numbers) fit in 4 bytes
+        if -0x80000000 <= value < 0x80000000:
+            parts.append(bytes((TAG_INT,)) + INT.pack(value))
+        else:
+            parts.append(bytes((TAG_LONG,)) + LONG.pack(value))
+    elif isinstance(value, str):
+        encoded = value.encode('utf-8')
+        parts.append(bytes((TAG_STR,)) + LEN.pack(len(encoded)) + encoded)
+    elif isinstance(value, (list, tuple)):
+        parts.append(bytes((TAG_LIST,)) + LEN.pack(len(value)))
+        for item in value:
+            u_encode_value(item, parts)
+    else:
+        raise TypeError('Cannot encode {} on the wire'.format(type(value)))
+
+
+# Returns the value starting at offset and the offset right after it
+def u_decode_value(data, offset):
+    tag = data[offset]
+    offset += 1
+
+    if tag == TAG_NONE:
+        return None, offset
+    elif tag == TAG_TRUE:
+        return True, offset
+    elif tag == TAG_FALSE:
+        return False, offset
+    elif tag == TAG_INT:
+        return INT.unpack_from(data, offset)[0], offset + INT.size
+    elif tag == TAG_LONG:
+        return LONG.unpack_from(data, offset)[0], offset + LONG.size
+    elif tag == TAG_STR:
+        length = LEN.unpack_from(data, offset)[0]
+        offset += LEN.size
+        return data[offset:offset + length].decode('utf-8'), offset + length
+    elif tag == TAG_LIST:
+        count = LEN.unpack_from(data, offset)[0]
+        offset += LEN.size
+        value = []
+        for _ in range(count):
+            item, offset = u_decode_value(data, offset)
+            value.append(item)
+        return value, offset
+    else:
+        raise ValueError('Unknown value tag {}'.format(tag))
+
+
+# Splits encoded data into the datagrams to be sent
+# message_id tells apart the messages of one sender while they are reassembled
+def u_split_frames(data, message_id):
+    if len(data) <= MAX_DATAGRAM:
+        return [data]
+
+    count = (len(data) + FRAME_CHUNK - 1) // FRAME_CHUNK
+    if count > 0xffff:
+        raise ValueError('Message of {} bytes is too large'.format(len(data)))
+
+    frames = []
+    for index in range(count):
+        chunk = data[index * FRAME_CHUNK:(index + 1) * FRAME_CHUNK]
+        frames.append(FRAME_HEADER.pack(FRAME_MARKER, message_id & 0xffffffff,
+                                        index, count) + chunk)
+
+    return frames
+
+
+# Puts the frames of large messages back together
+class FrameAssembler(object):
+    def __init__(self):
+        # { (sender_addr, message_id) : [deadline, count, { index : chunk }] }
+        self.pending = {}
+
+    # Returns the whole message once datagram completes it, otherwise None
+    # Datagrams which are not frames are returned as they are
+    def feed(self, datagram, sender_addr):
+        if datagram[0] != FRAME_MARKER:
+            return datagram
+
+        marker, message_id, index, count = FRAME_HEADER.unpack_from(datagram, 0)
+        key = (sender_addr, message_id)
+
+        entry = self.pending.get(key, None)
+        if entry is None:
+            self.expire()
+            entry = [time.time() + FRAME_TIMEOUT, count, {}]
+            self.pending[key] = entry
+
+        entry[2][index] = datagram[FRAME_HEADER.size:]
+
+        if len(entry[2]) < entry[1]:
+            return None
+
+        del self.pending[key]
+        return b''.join(entry[2][i] for i in range(entry[1]))
+
+    # Drops the messages whose frames stopped arriving, and the oldest ones
+    #   if too many are pending
+    def expire(self):
+        now = time.time()
+        for key in [key for key, entry in self.pending.items() if entry[0] < now]:
+            del self.pending[key]
+
+        while len(self.pending) >= FRAME_MAX_PENDING:
+            del self.pending[next(iter(self.pending))]
@@ -6,1063 +6,2111 @@ import copy
 import json
 import time
 import click
+import random
+import shutil
 import socket
+import signal
+import asyncio
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
 from multiprocessing import Process
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from paxos_util import paxos_prepare, paxos_ack_prepare, paxos_propose,\
                        paxos_accept, paxos_ack_client, u_get_id,\
-                       paxos_tell_client_new_leader, paxos_help_me_choose,\
-                       paxos_you_can_choose
-
-
-def handle_replica(replica_id, replica_config_list):
-    # Propose No. used to see who is the current leader
-    s_leader_propose_no = 0
-    # Used by the leader. Possible states are 'prepare', 'established', 'dictated'
-    s_leader_state = 'prepare'
-    # { slot_no : count of ack message from other replicas }
-    s_ack_msg_count = {}
-    # { slot_no : count of accept message from other replicas }
-    s_accept_msg_count = {}
-    # { slot_no : value }
-    s_accepted = {}
-    # { slot_no : propose_no }
-    s_proposer = {}
-    # { slot_no : (client_id, request_id) }
-    s_client_request = {}
-    # { slot_no : (client_ip, client_port) }
-    s_client_addr = {}
-    # Check which slot has been learned
-    s_learned = set()
-    # The next slot used to propose if I am leader
-    s_next_slot = 0
-    # The last slot that I am sure has been accepted
-    s_last_accepted = 0
-    # The first slot that I am sure hasn't been chosen
-    s_first_unchosen = 0
-    # set(tuple(client_id, newest_request_id))
-    # Updated only when the client request has been chosen
-    s_chosen_client_request = set()
-    # The queue that buffers client request message
-    s_request_queue = []
-    # The queue that buffers empty slot message in the prepare phase of leader
-    s_slot_buffer_queue = []
-
-    # { replica_id : { 'ip': '', 'port': num } }
-    s_replica_config = {}
-    # repica_data e.g. {'id': 0, 'ip': 'localhost', 'port': 6000}
-    for replica_data in replica_config_list:
-        s_replica_config[replica_data['id']] = {
-            'ip' : replica_data['ip'],
-            'port' : replica_data['port'],
-            'skip_slot' : replica_data['skip_slot'],
-            'drop_rate' : replica_data['drop_rate']
+                       paxos_tell_client_new_leader, paxos_tell_client_busy,\
+                       paxos_help_me_choose,\
+                       paxos_you_can_choose, RequestQueue,\
+                       u_window_open, UdpSender,\
+                       u_bind_socket, paxos_install_snapshot, ClientSessions,\
+                       paxos_lease_request, paxos_lease_grant, paxos_read_reply,\
+                       paxos_heartbeat, paxos_trace_events
+from paxos_wire import u_decode_message, FrameAssembler, RECV_BUFFER
+from paxos_slot_log import SlotLog
+from paxos_metrics import Metrics, u_serve_metrics
+from paxos_log import u_replica_logger, u_message_log
+from paxos_trace import TraceBuffer, TRACE_CHUNK
+from paxos_profile import u_run_profiled
+from paxos_wal import WriteAheadLog, u_replay_wal, u_read_snapshot, u_write_snapshot
+
+
+# Fraction of its lease the leader gives up to cover the clock drift between replicas
+LEASE_DRIFT = 0.1
+# Seconds after which a lost catch-up chunk is asked for again, from another replica
+CATCHUP_RETRY = 0.2
+# Catch-up chunks sent for one request, the next ones are asked for once half arrived
+CATCHUP_WINDOW = 8
+# Seconds the first leader waits for the other replicas to start up
+LEADER_STARTUP = 1
+# Bytes of chat log lines sent in one chunk of a snapshot, at least one line is sent
+SNAPSHOT_CHUNK = 65536
+
+
+# The state of one replica and the handler of every message type
+class Replica(object):
+    def __init__(self, replica_id, replica_config_list):
+        self.replica_id = replica_id
+
+        # Propose No. used to see who is the current leader
+        self.s_leader_propose_no = 0
+        # Used by the leader. Possible states are 'prepare', 'dictated'
+        self.s_leader_state = 'prepare'
+        # The accepted value, propose_no, client requests and addresses, ack and
+        #   accept counts and whether it is learned, of every slot
+        # Every slot holds a batch of client requests, kept as parallel lists
+        # Its base_slot is the first slot not compacted into a snapshot
+        self.s_slots = SlotLog()
+        # The next slot used to propose if I am leader
+        self.s_next_slot = 0
+        # The last slot that I am sure has been accepted
+        self.s_last_accepted = 0
+        # The first slot that I am sure hasn't been chosen
+        self.s_first_unchosen = 0
+        # The client request messages waiting to be proposed, see RequestQueue
+        self.s_request_queue = RequestQueue()
+        # The time at which a partially filled batch has to be proposed anyway
+        self.s_batch_deadline = None
+        # set(slot_no) proposed by me as the leader but not chosen yet
+        self.s_in_flight = set()
+        # The first slot not applied to the client sessions and chat log lines yet
+        self.s_applied_slot = 0
+        # The number of chat log lines of the slots compacted into a snapshot,
+        #   which are only kept in the chat log file
+        self.s_log_line_base = 0
+        # The chat log lines of every slot from the base_slot of s_slots up to
+        #   s_applied_slot
+        self.s_log_lines = []
+        # The line number in the chat log of the first line of every slot from
+        #   the base_slot of s_slots up to s_applied_slot
+        self.s_log_slot_start = array('q')
+        # The first slot not handed to the chat log yet, and the number of
+        #   lines handed to it
+        self.s_log_high_water = 0
+        self.s_log_written = 0
+        # The future of the snapshot file being written, after which the
+        #   write-ahead log is cut down, None if there is none
+        self.s_snapshot_written = None
+        # The future of the write-ahead log commit or rewrite being written, and
+        #   the messages held back until it is done, None if there is none
+        self.s_wal_written = None
+        self.s_wal_held = None
+        # The time at which the chat log has to be flushed, None if nothing is buffered
+        self.s_log_flush_deadline = None
+
+        # Used by the leader. The number of its latest lease request, the time it
+        #   was sent and the replicas which have granted it
+        self.s_lease_no = 0
+        self.s_lease_sent = 0
+        self.s_lease_grants = set()
+        # Used by the leader. The propose_no its lease was granted to and the
+        #   time the lease ends
+        self.s_lease_propose_no = 0
+        self.s_lease_expiry = 0
+        # Used by the leader. The time at which the lease has to be renewed
+        self.s_lease_renew_deadline = None
+        # The propose_no I have granted a lease to and the time until which I
+        #   promise not to follow anyone else
+        self.s_lease_holder = 0
+        self.s_lease_granted_until = 0
+        # The prepare of another proposer held back until the lease I granted ends
+        self.s_deferred_prepare = None
+        # The propose_no whose lease I no longer renew after a client timed out on it
+        self.s_lease_withheld = -1
+        # [read_index, client_read message] of the reads waiting at the leader
+        #   read_index is None until the leader holds a lease
+        self.s_pending_reads = deque()
+        # The follower_read messages waiting for their min_slot to be applied
+        self.s_waiting_reads = []
+
+        # The first unchosen slot of the most advanced replica I have heard of
+        self.s_catchup_target = 0
+        # The replica I ask for the next chunk of chosen slots, None if I am not behind
+        self.s_catchup_helper = None
+        # The slot up to which chunks have been asked for
+        self.s_catchup_asked = 0
+        # The time at which the chunks asked for are given up
+        self.s_catchup_deadline = None
+        # The snapshot being installed, as [the number of chat log lines it
+        #   starts after, the number of lines staged up to], None if there is none
+        self.s_install_lines = None
+        # The slots I may still send to lagging replicas right now, and the time
+        #   they were last refilled
+        self.s_catchup_tokens = 0
+        self.s_catchup_refill = 0
+        # { replica_id : [start_slot, end_slot] } of the chunks sent to lagging
+        #   replicas once the rate limit allows, and the time at which that is
+        self.s_deferred_help = {}
+        self.s_deferred_help_deadline = None
+
+        # Used by the leader. The time at which the next heartbeat is sent, and
+        #   my first unchosen slot when the last one was sent
+        self.s_heartbeat_deadline = None
+        self.s_heartbeat_unchosen = -1
+        # The time at which I run for leader unless I hear from the leader before
+        self.s_election_deadline = None
+        # { slot_no : time } at which I proposed the slots in flight as the leader
+        self.s_propose_time = {}
+        # The hops of traced requests being sent to trace_dump.py, see paxos_trace
+        self.s_trace_dump = []
+
+        # { replica_id : { 'ip': '', 'port': num } }
+        self.s_replica_config = {}
+        # repica_data e.g. {'id': 0, 'ip': 'localhost', 'port': 6000}
+        for replica_data in replica_config_list:
+            self.s_replica_config[replica_data['id']] = {
+                'ip' : replica_data['ip'],
+                'port' : replica_data['port'],
+                'skip_slot' : replica_data['skip_slot'],
+                'drop_rate' : replica_data['drop_rate'],
+                'batch_size' : replica_data.get('batch_size', 1),
+                'batch_bytes' : replica_data.get('batch_bytes', 512),
+                'batch_linger' : replica_data.get('batch_linger', 0),
+                'pipeline_window' : replica_data.get('pipeline_window', 16),
+                'queue_limit' : replica_data.get('queue_limit', 1024),
+                'wire_format' : replica_data.get('wire_format', 'binary'),
+                'durable' : replica_data.get('durable', False),
+                'commit_window' : replica_data.get('commit_window', 2),
+                'log_flush_interval' : replica_data.get('log_flush_interval', 0),
+                'snapshot_interval' : replica_data.get('snapshot_interval', 0),
+                'session_expiry' : replica_data.get('session_expiry', 100000),
+                'lease_duration' : replica_data.get('lease_duration', 500),
+                'catchup_chunk' : replica_data.get('catchup_chunk', 16),
+                'catchup_rate' : replica_data.get('catchup_rate', 5000),
+                'heartbeat_interval' : replica_data.get('heartbeat_interval', 100),
+                'election_timeout' : replica_data.get('election_timeout', 300),
+                'metrics_port' : replica_data.get('metrics_port', 0),
+                'log_level' : replica_data.get('log_level', 'info'),
+                'log_sample' : replica_data.get('log_sample', 1),
+                'trace_buffer' : replica_data.get('trace_buffer', 4096)
+            }
+
+        # Boolean variable denoting whether client request should be immediately applied
+        self.s_waiting_client = False
+
+        # Number of replicas
+        self.c_replica_num = len(replica_config_list)
+
+        # Majority number of replicas
+        self.c_majority_num = (self.c_replica_num + 1) / 2
+
+        # The ip address and port information
+        self.c_my_ip = self.s_replica_config[self.replica_id]['ip']
+        self.c_my_port = self.s_replica_config[self.replica_id]['port']
+        self.c_my_skip_slot = self.s_replica_config[self.replica_id]['skip_slot']
+        self.c_my_drop_rate = self.s_replica_config[self.replica_id]['drop_rate']
+        self.c_my_wire_format = self.s_replica_config[self.replica_id]['wire_format']
+
+        # Max number of client requests and total value bytes packed in one slot
+        self.c_batch_size = self.s_replica_config[self.replica_id]['batch_size']
+        self.c_batch_bytes = self.s_replica_config[self.replica_id]['batch_bytes']
+        # How long (in seconds) the leader waits for a partial batch to fill up
+        self.c_batch_linger = self.s_replica_config[self.replica_id]['batch_linger'] / 1000
+
+        # Max number of slots in flight between propose and majority accept
+        self.c_pipeline_window = self.s_replica_config[self.replica_id]['pipeline_window']
+        # Max number of client requests buffered while the window is full
+        self.c_queue_limit = self.s_replica_config[self.replica_id]['queue_limit']
+
+        # Whether the acceptor state is kept in a write-ahead log
+        self.c_durable = self.s_replica_config[self.replica_id]['durable']
+        # How long (in seconds) a log record waits for others to share its fsync
+        self.c_commit_window = self.s_replica_config[self.replica_id]['commit_window'] / 1000
+
+        # How long (in seconds) appended chat log lines may stay buffered, 0 flushes
+        #   them on every print_log
+        self.c_log_flush_interval =\
+            self.s_replica_config[self.replica_id]['log_flush_interval'] / 1000
+
+        # Number of chosen slots after which a snapshot is taken, 0 never takes one
+        self.c_snapshot_interval = self.s_replica_config[self.replica_id]['snapshot_interval']
+
+        # Number of chosen slots after which an idle client session expires
+        self.c_session_expiry = self.s_replica_config[self.replica_id]['session_expiry']
+        # The requests applied for every client, which tells duplicates apart
+        self.s_sessions = ClientSessions(self.c_session_expiry)
+
+        # How long (in seconds) a lease granted to the leader lasts, 0 turns leases off
+        self.c_lease_duration = self.s_replica_config[self.replica_id]['lease_duration'] / 1000
+
+        # Max number of chosen slots sent to a lagging replica in one chunk
+        self.c_catchup_chunk = max(self.s_replica_config[self.replica_id]['catchup_chunk'], 1)
+        # Max number of chosen slots per second sent to lagging replicas, 0 is unlimited
+        self.c_catchup_rate = self.s_replica_config[self.replica_id]['catchup_rate']
+
+        # How long (in seconds) the leader waits between two heartbeats, 0 turns
+        #   heartbeats off and leaves leader changes to client timeouts
+        self.c_heartbeat_interval =\
+            self.s_replica_config[self.replica_id]['heartbeat_interval'] / 1000
+        # How long (in seconds) a replica waits for the leader before running for
+        #   leader itself, at random between once and twice that
+        self.c_election_timeout =\
+            self.s_replica_config[self.replica_id]['election_timeout'] / 1000
+
+        # The port metrics are served on over HTTP, 0 does not serve them
+        self.c_metrics_port = self.s_replica_config[self.replica_id]['metrics_port']
+
+        # The level of the log records kept, and one in how many records of
+        #   single messages is kept at the debug level
+        self.c_log_level = self.s_replica_config[self.replica_id]['log_level']
+        self.c_log_sample = self.s_replica_config[self.replica_id]['log_sample']
+
+        # The hops of traced client requests, see paxos_trace, None if the
+        #   trace_buffer of 0 turns tracing off
+        trace_buffer = self.s_replica_config[self.replica_id]['trace_buffer']
+        self.c_traces = TraceBuffer(trace_buffer) if trace_buffer > 0 else None
+
+        # My own information is no longer needed
+        del self.s_replica_config[self.replica_id]
+
+        # Used to store the temporarily most recent value, propose_no, 
+        #   (client_id, request_id) pair and client address of every slot
+        #   in the prepared range, used in ack_prepare
+        # { slot_no : [value, propose_no, client_request, client_addr] }
+        self.t_prepared = {}
+
+        # Every message is sent through c_sender, which is built by start()
+        self.c_sender = None
+        # Runs blocking file I/O off the message path if set
+        self.c_io_executor = None
+        # Called once the deadline of a timer has changed outside of handle and
+        #   handle_timeout, None if the caller does not need to know
+        self.c_timers_changed = None
+        # The write-ahead log, which is opened by start() if c_durable
+        self.c_wal = None
+        # The chat log file, which is opened by start()
+        self.c_chat_log = None
+        # The log of the replica and of its single messages, see paxos_log,
+        #   which are built by start(). c_message_log is None unless debugging
+        self.c_logger = None
+        self.c_log_listener = None
+        self.c_message_log = None
+
+        # { message_type : handler }
+        self.c_handlers = {
+            'prepare' : self.handle_prepare,
+            'ack_prepare' : self.handle_ack_prepare,
+            'propose' : self.handle_propose,
+            'accept' : self.handle_accept,
+            'client_request' : self.handle_client_request,
+            'client_timeout' : self.handle_client_timeout,
+            'print_log' : self.handle_print_log,
+            'help_me_choose' : self.handle_help_me_choose,
+            'you_can_choose' : self.handle_you_can_choose,
+            'install_snapshot' : self.handle_install_snapshot,
+            'lease_request' : self.handle_lease_request,
+            'lease_grant' : self.handle_lease_grant,
+            'client_read' : self.handle_client_read,
+            'follower_read' : self.handle_follower_read,
+            'heartbeat' : self.handle_heartbeat,
+            'trace_dump' : self.handle_trace_dump
         }
 
-    # Boolean variable denoting whether client request should be immediately applied
-    s_waiting_client = False
+        # Counted on the message path and read by the metrics server
+        self.c_metrics = Metrics([('replica', self.replica_id)])
+        self.register_metrics()
+
+
+    # Registers the metrics served by the metrics server, see paxos_metrics
+    def register_metrics(self):
+        metrics = self.c_metrics
+        metrics.counter('paxos_messages_received_total',
+                        'Messages received, by message type', 'type')
+        metrics.counter('paxos_messages_sent_total',
+                        'Messages sent to every receiver, by message type', 'type')
+        metrics.counter('paxos_messages_dropped_total',
+                        'Messages dropped by the simulated drop rate, by message type', 'type')
+        metrics.counter('paxos_leader_changes_total',
+                        'Times the propose_no of the leader I follow changed')
+        metrics.histogram('paxos_commit_latency_seconds',
+                          'Seconds from my propose of a slot to its majority accept, '
+                          'as the leader')
+        metrics.gauge('paxos_request_queue_depth',
+                      'Client requests waiting at the leader',
+                      lambda: len(self.s_request_queue))
+        metrics.gauge('paxos_slots_in_flight',
+                      'Slots proposed by the leader and not chosen yet',
+                      lambda: len(self.s_in_flight))
+        metrics.gauge('paxos_pending_reads',
+                      'Client reads waiting at the leader or for a slot to be applied',
+                      lambda: len(self.s_pending_reads) + len(self.s_waiting_reads))
+        metrics.gauge('paxos_first_unchosen_slot',
+                      'The first slot I have not learned to be chosen',
+                      lambda: self.s_first_unchosen)
+        metrics.gauge('paxos_unchosen_lag_slots',
+                      'Slots the most advanced replica I heard of has chosen beyond me',
+                      lambda: max(self.s_catchup_target - self.s_first_unchosen, 0))
+        metrics.gauge('paxos_leader_propose_no',
+                      'The propose_no of the leader I follow',
+                      lambda: self.s_leader_propose_no)
+        metrics.gauge('paxos_is_leader',
+                      '1 if I am the leader, 0 otherwise',
+                      lambda: int(self.is_leader()))
+
+
+    # Restores the acceptor state from the snapshot and the records of the
+    #   write-ahead log
+    def recover(self, snapshot, records):
+        if snapshot is not None:
+            _, snapshot_slot, line_count, sessions = snapshot
+            self.s_slots.compact(snapshot_slot)
+            self.s_first_unchosen = snapshot_slot
+            self.s_last_accepted = max(snapshot_slot - 1, 0)
+            self.s_applied_slot = snapshot_slot
+            self.s_log_line_base = line_count
+            self.s_sessions = ClientSessions.from_list(sessions, self.c_session_expiry)
+
+        for record in records:
+            if record[0] == 'promise':
+                self.s_leader_propose_no = max(self.s_leader_propose_no, record[1])
+
+            elif record[0] == 'accept':
+                slot, value, propose_no, client_request, client_addr = record[1:]
+                if slot < self.s_slots.base_slot:
+                    continue
+                self.s_slots[slot].accept(value, propose_no, client_request, client_addr)
+                self.s_leader_propose_no = max(self.s_leader_propose_no, propose_no)
+                if slot > self.s_last_accepted:
+                    self.s_last_accepted = slot
+
+            elif record[0] == 'learn':
+                slot = record[1]
+                if slot < self.s_slots.base_slot:
+                    continue
+                self.s_slots[slot].accept_count = self.c_majority_num
+                self.s_slots[slot].learned = True
+
+        while self.s_slots.is_learned(self.s_first_unchosen):
+            self.s_first_unchosen += 1
+        self.s_next_slot = self.s_first_unchosen
+
+
+    # my_socket is anything with sendto, e.g. a bound socket or an asyncio transport
+    def start(self, my_socket):
+        self.c_logger, self.c_log_listener = u_replica_logger(self.replica_id,
+                                                             self.c_log_level)
+        self.c_message_log = u_message_log(self.c_logger, self.c_log_sample)
+
+        # Every message is sent through my_socket to the other replicas
+        self.c_sender = UdpSender(self.replica_id, my_socket, self.s_replica_config,
+                                  self.c_my_drop_rate, self.c_my_wire_format)
+        self.c_sender.metrics = self.c_metrics
+        self.c_sender.message_log = self.c_message_log
+
+        if self.c_metrics_port > 0:
+            u_serve_metrics(self.c_metrics, self.c_my_ip, self.c_metrics_port)
+
+        if self.c_durable:
+            self.c_wal = WriteAheadLog(wal_file_name(self.replica_id), self.c_commit_window)
+
+        # Continue the chat log from where it was left, as long as it agrees
+        #   with the recovered state. Otherwise it is written again after the
+        #   lines of the snapshot, which it holds already
+        self.c_chat_log = ChatLog(log_file_name(self.replica_id))
+        high_water = min(max(self.c_chat_log.high_water, self.s_slots.base_slot),
+                         self.s_first_unchosen)
+        self.apply_chosen(high_water)
+        if self.c_chat_log.high_water != high_water or\
+                self.c_chat_log.line_count != self.log_line_count():
+            self.c_chat_log.rewrite(self.s_log_line_base, self.s_log_lines, high_water)
+        self.s_log_high_water = high_water
+        self.s_log_written = self.log_line_count()
+
+        self.apply_chosen(self.s_first_unchosen)
+
+        # A lease I granted before a restart may still be running, so follow
+        #   nobody else for a whole lease
+        self.s_lease_holder = -1
+        self.s_lease_granted_until = time.time() + self.c_lease_duration
+
+        # The first leader gets to start up before anyone else runs for leader
+        if self.c_heartbeat_interval > 0:
+            self.s_heartbeat_deadline = time.time() + self.c_heartbeat_interval
+            self.reset_election_timer()
+            self.s_election_deadline += LEADER_STARTUP
+
+        # If I am the leader at the very beginning
+        if self.is_leader():
+            assert( len(self.s_request_queue) == 0 )
+
+            self.prepare()
+
+
+    # Writes the log records still queued once the replica is done, which
+    #   may be before it has started
+    def stop(self):
+        if self.c_log_listener is not None:
+            self.c_log_listener.stop()
+            self.c_log_listener = None
+
+
+    # Prepares every slot from s_next_slot on with my current propose_no
+    def prepare(self):
+        # Initialize temp variables with leader's own accepted values
+        self.t_prepared = self.s_slots.accepted_since(self.s_next_slot)
 
-    # Number of replicas
-    c_replica_num = len(replica_config_list)
+        # Before sending prepare msg, the leader already has one ack (itself)
+        self.s_slots[self.s_next_slot].ack_count = 1
 
-    # Majority number of replicas
-    c_majority_num = (c_replica_num + 1) / 2
+        # Propose to every other replica
+        paxos_prepare(self.c_sender, self.s_leader_propose_no, self.s_next_slot)
 
-    # The ip address and port information
-    c_my_ip = s_replica_config[replica_id]['ip']
-    c_my_port = s_replica_config[replica_id]['port']
-    c_my_skip_slot = s_replica_config[replica_id]['skip_slot']
-    c_my_drop_rate = s_replica_config[replica_id]['drop_rate']
 
-    # Build the socket to receive external message
-    # UDP socket also has buffer to store incoming messages
-    my_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    my_socket.bind((c_my_ip, c_my_port))
-
-    # My own information is no longer needed
-    del s_replica_config[replica_id]
-
-    # Used to store the temporarily most recent value, propose_no, 
-    #   (client_id, request_id) pair and no_more_accepted, used in ack_prepare
-    t_value = None
-    t_propose_no = 0
-    t_client_request = None
-    t_client_addr = None
-    t_no_more_accepted = True
-
-    # If I am the leader at the very beginning
-    if u_get_id(s_leader_propose_no, c_replica_num) == replica_id:
-        # TODO: This is to ensure every other process is up (not safe)
-        time.sleep(1)
-        # sys.exit(1)
+    # Takes propose_no, which must be mine, and prepares every slot from
+    #   s_first_unchosen on
+    def become_leader(self, propose_no):
+        self.s_leader_propose_no = propose_no
+        self.log_promise()
 
-        # Initialize temp variables with leader's own slot
-        # It is guaranteed to be default valur though, just for consistency
-        t_value = s_accepted.get(s_next_slot, None)
-        t_propose_no = s_proposer.get(s_next_slot, 0)
-        t_client_request = s_client_request.get(s_next_slot, None)
-        t_client_addr = s_client_addr.get(s_next_slot, None)
+        # Change s_next_slot back to s_first_unchosen
+        self.s_next_slot = self.s_first_unchosen
+
+        # Just an initialization for safety
+        self.s_leader_state = 'prepare'
+        self.s_slots[self.s_next_slot].accept_count = 0
+        self.s_waiting_client = False
 
-        # Before sending prepare msg, the leader already has one ack (itself)
-        s_ack_msg_count[s_next_slot] = 1
+        # Empty the request queue
+        self.s_request_queue.clear()
+        self.s_in_flight.clear()
+        self.s_propose_time.clear()
 
-        assert( s_request_queue == [] )
-        assert( s_slot_buffer_queue == [] )
+        self.prepare()
 
-        # Propose to every other replica
-        paxos_prepare(replica_id, s_leader_propose_no, s_next_slot,
-                      s_replica_config, c_my_drop_rate)
+
+    # Gives up proposing as the leader once another proposer has taken over
+    # The queued client requests are dropped, the clients resend them to the
+    #   new leader after their timeouts
+    def step_down(self):
+        self.s_leader_state = 'prepare'
+        self.s_waiting_client = False
+        self.s_batch_deadline = None
+        self.s_request_queue.clear()
+
+
+    # Sets the election timer off again, at random so that replicas rarely run
+    #   for leader at the same time
+    def reset_election_timer(self):
+        if self.c_heartbeat_interval == 0:
+            return
+
+        self.s_election_deadline = time.time() + self.c_election_timeout * random.uniform(1, 2)
+
+
+    # Runs for leader unless I am the leader already
+    # A prepare of mine which did not get through is sent again with a higher propose_no
+    def handle_election_timeout(self):
+        self.reset_election_timer()
+
+        if self.is_leader() and self.s_leader_state != 'prepare':
+            return
+
+        # Nobody else may become leader while the lease I granted lasts
+        if self.lease_granted():
+            self.s_election_deadline = max(self.s_election_deadline, self.s_lease_granted_until)
+            return
+
+        # A replica lagging behind would have to propose every slot it misses,
+        #   so it leaves this election to the others
+        # Its catch-up target came from the leader which has timed out, so it
+        #   stops catching up and runs at the next timeout unless a new leader
+        #   has been heard from by then
+        if self.s_catchup_helper is not None:
+            self.s_catchup_target = self.s_first_unchosen
+            self.request_chunk()
+            return
+
+        # The lowest propose_no of mine above every one I have seen
+        propose_no = self.s_leader_propose_no + 1
+        propose_no += (self.replica_id - propose_no) % self.c_replica_num
+        self.c_logger.info('election propose_no=%s', propose_no)
+        self.become_leader(propose_no)
 
 
-    # This basically constantly fetched the next message in the socket
-    #   buffer and take action according to the message type
-    while True:
-        # This is a blocking call
-        data = my_socket.recvfrom(1024)[0]
+    # Tells the followers I am alive and how far I have chosen
+    # My first unchosen slot staying in flight for a whole heartbeat means that
+    #   accepts to me were lost, so I ask the followers whether they have chosen it
+    def send_heartbeat(self):
+        paxos_heartbeat(self.c_sender, self.s_leader_propose_no, self.s_first_unchosen)
+        self.fill_holes()
 
-        message = json.loads(data.decode('utf-8'))
+        if self.s_first_unchosen in self.s_in_flight and\
+                self.s_first_unchosen == self.s_heartbeat_unchosen:
+            self.catch_up(self.s_first_unchosen + 1, min(self.s_replica_config))
+        self.s_heartbeat_unchosen = self.s_first_unchosen
+
+        # The slots chosen that way open up the pipeline window
+        self.drain_requests()
+
+
+    # Only an established leader sends heartbeats, so a majority has promised
+    #   its propose_no and every lease of an older leader has run out
+    def handle_heartbeat(self, message):
+        propose_no = message['proposer']
+        first_unchosen = message['first_unchosen']
+
+        # A prepare of mine held back by the leases granted to a leader which is
+        #   still alive is given up, and I follow that leader again
+        if propose_no < self.s_leader_propose_no and\
+                not (self.is_leader() and self.s_leader_state == 'prepare'):
+            return
+
+        if propose_no != self.s_leader_propose_no:
+            self.s_leader_propose_no = propose_no
+            self.log_promise()
+            self.step_down()
+
+        self.reset_election_timer()
+
+        # Catch up with the leader based on received first_unchosen
+        if first_unchosen > self.s_first_unchosen:
+            self.catch_up(first_unchosen, u_get_id(propose_no, self.c_replica_num))
+
+
+    def is_leader(self):
+        return u_get_id(self.s_leader_propose_no, self.c_replica_num) == self.replica_id
+
+
+    # Takes action according to the message type
+    def handle(self, message):
         message_type = message['message_type']
 
-        # Debugging message
-        # print('Replica {} received message {}'.format(replica_id, message_type))
+        if self.c_message_log is not None:
+            self.c_message_log.debug('receive type=%s', message_type)
+
+        handler = self.c_handlers.get(message_type, None)
+        if handler is None:
+            self.c_logger.warning('erroneous message type=%s', message_type)
+            return
+
+        self.c_metrics.inc('paxos_messages_received_total', message_type)
+        propose_no = self.s_leader_propose_no
+
+        handler(message)
 
-        if message_type == 'prepare':
-            proposed_no = message['proposer']
-            proposed_slot = message['slot']
+        if self.s_leader_propose_no != propose_no:
+            self.c_metrics.inc('paxos_leader_changes_total')
+
+        self.apply_chosen(self.s_first_unchosen)
+        self.serve_reads()
+
+        if self.c_snapshot_interval > 0 and\
+                self.s_first_unchosen - self.s_slots.base_slot >= self.c_snapshot_interval:
+            self.take_snapshot()
+        self.rewrite_wal()
 
-            # If the proposal is old, just ignore it
-            if proposed_no < s_leader_propose_no:
-                continue
+        # A commit window of 0 makes every message pay its own fsync
+        if self.c_wal is not None and self.c_wal.pending() and\
+                time.time() >= self.c_wal.deadline:
+            self.commit_wal()
 
-            # Update the leader proposal number
-            s_leader_propose_no = proposed_no
 
-            # Clear the variables that are specific for leaders (in case it was leader)
-            # if s_leader_propose_no (prev) == s_my_propose_no:
-            s_leader_state = 'prepare'
-            s_ack_msg_count[proposed_slot] = 0
-            s_accept_msg_count[proposed_slot] = 0
-
-            # If I haven't used this slot before, initialize with None
-            if proposed_slot not in s_accepted:
-                s_accepted[proposed_slot] = None
-                s_proposer[proposed_slot] = 0
-                s_client_request[proposed_slot] = None
-                s_client_addr[proposed_slot] = None
-
-            no_more_accepted = (proposed_slot >= s_last_accepted)
-            
-            # Send ack_propose message back to the leader
-            paxos_ack_prepare(replica_id,
-                              s_accepted[proposed_slot],
-                              s_proposer[proposed_slot],
-                              s_client_request[proposed_slot],
-                              s_client_addr[proposed_slot],
-                              no_more_accepted,
-                              proposed_slot,
-                              s_leader_propose_no,
-                              u_get_id(s_leader_propose_no, c_replica_num),
-                              s_replica_config,
-                              c_my_drop_rate)
-
-
-        elif message_type == 'ack_prepare':
-            acked_value = message['accepted']
-            acked_propose_no = message['value_proposer']
-            acked_client_request = message['client_request']
-            acked_client_addr = message['client_addr']
-            acked_no_more_accepted = message['no_more_accepted']
-            acked_slot = message['slot']
-            acked_leader_propose_no = message['proposer']
-
-            # If I am not the leader or the round number is old, ignore the message
-            if u_get_id(acked_leader_propose_no, c_replica_num) != replica_id:
-                continue
+    # Returns the time at which handle_timeout should be called, None if no timer is set
+    def next_deadline(self):
+        deadlines = [self.s_batch_deadline, self.s_log_flush_deadline,
+                     self.s_lease_renew_deadline, self.s_catchup_deadline,
+                     self.s_heartbeat_deadline, self.s_election_deadline,
+                     self.s_deferred_help_deadline]
+        if self.s_deferred_prepare is not None:
+            deadlines.append(self.s_lease_granted_until)
+        # The records buffered during a commit wait for it instead
+        if self.c_wal is not None and self.s_wal_written is None:
+            deadlines.append(self.c_wal.deadline)
 
-            assert ( acked_leader_propose_no <= s_leader_propose_no )
-            if acked_leader_propose_no < s_leader_propose_no:
-                continue
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        return min(deadlines) if deadlines else None
 
-            # If this is the remaining  possible ack from previous prepare, or
-            # If the slot is already proposed, ignore further ack_prepare
-            if acked_slot != s_next_slot or\
-                    (s_ack_msg_count.get(acked_slot, None) == c_majority_num):
-                continue
 
-            assert ( s_leader_state == 'prepare' )
-            assert ( s_ack_msg_count[acked_slot] > 0 ) 
+    # Fires the timers which are due
+    def handle_timeout(self):
+        propose_no = self.s_leader_propose_no
+
+        self.fire_timers()
+
+        # An election may have made me the leader
+        if self.s_leader_propose_no != propose_no:
+            self.c_metrics.inc('paxos_leader_changes_total')
 
-            # Always retain the most recent value
-            if acked_propose_no is not None and acked_propose_no > t_propose_no:
-                t_value = acked_value
-                t_propose_no = acked_propose_no
-                t_client_request = copy.deepcopy(acked_client_request)
-                t_client_addr = copy.deepcopy(acked_client_addr)
 
-            # Check the no_more_accepted flag
-            t_no_more_accepted = t_no_more_accepted & acked_no_more_accepted
+    def fire_timers(self):
+        if self.s_batch_deadline is not None and time.time() >= self.s_batch_deadline:
+            # Flush the lingering batch
+            self.drain_requests()
 
-            # Increment the acknowledge count
-            s_ack_msg_count[acked_slot] += 1
-            if s_ack_msg_count[acked_slot] == c_majority_num:
-                # If all replicas reply with no_more_accepted, then 'established'
-                if t_no_more_accepted:
-                    s_leader_state = 'established'
+        if self.s_lease_renew_deadline is not None and\
+                time.time() >= self.s_lease_renew_deadline:
+            self.s_lease_renew_deadline = None
+            if self.is_leader() and self.s_leader_state != 'prepare' and\
+                    self.s_lease_withheld != self.s_leader_propose_no:
+                self.request_lease()
+
+        # The lease I granted is over, so the held back prepare can be answered
+        if self.s_deferred_prepare is not None and\
+                time.time() >= self.s_lease_granted_until:
+            message, self.s_deferred_prepare = self.s_deferred_prepare, None
+            self.handle_prepare(message)
+
+        if self.s_heartbeat_deadline is not None and time.time() >= self.s_heartbeat_deadline:
+            self.s_heartbeat_deadline = time.time() + self.c_heartbeat_interval
+            if self.is_leader() and self.s_leader_state != 'prepare':
+                self.send_heartbeat()
+
+        # Nothing has been heard from the leader for a whole election timeout
+        if self.s_election_deadline is not None and time.time() >= self.s_election_deadline:
+            self.handle_election_timeout()
+
+        # Ask the next replica for the chunk which did not arrive
+        if self.s_catchup_deadline is not None and time.time() >= self.s_catchup_deadline:
+            replica_ids = sorted(self.s_replica_config)
+            self.s_catchup_helper = replica_ids[(replica_ids.index(self.s_catchup_helper) + 1) %
+                                                len(replica_ids)]
+            self.request_chunk()
+
+        # The rate limit allows to send lagging replicas more chunks
+        if self.s_deferred_help_deadline is not None and\
+                time.time() >= self.s_deferred_help_deadline:
+            self.s_deferred_help_deadline = None
+            deferred, self.s_deferred_help = self.s_deferred_help, {}
+            for receiver_id, (start_slot, end_slot) in deferred.items():
+                # Otherwise the slots have been compacted, and the receiver asks again
+                if start_slot >= self.s_slots.base_slot:
+                    self.send_chunks(receiver_id, start_slot, end_slot)
+
+        if self.c_wal is not None and self.c_wal.pending() and\
+                time.time() >= self.c_wal.deadline:
+            self.commit_wal()
+
+        if self.s_log_flush_deadline is not None and time.time() >= self.s_log_flush_deadline:
+            self.s_log_flush_deadline = None
+            self.run_io(self.c_chat_log.flush)
+
+        self.rewrite_wal()
+
+
+    # Every message sent after a record is appended is held back until the
+    #   record is durable, so no promise or accept is visible before that
+    def log_record(self, record):
+        if self.c_wal is None:
+            return
+
+        self.c_wal.append(record)
+        self.c_sender.hold()
+
+
+    def log_promise(self):
+        self.log_record(['promise', self.s_leader_propose_no])
+
+
+    def log_accept(self, slot):
+        record = self.s_slots[slot]
+        self.log_record(['accept', slot, record.value, record.proposer,
+                         record.client_request, record.client_addr])
+
+
+    def log_learn(self, slot):
+        self.log_record(['learn', slot])
+
+
+    # Makes the buffered records durable with one fsync, which may be offloaded,
+    #   and sends what they held back once it is done
+    # The records buffered meanwhile wait for it, and then for their own deadline
+    def commit_wal(self):
+        if self.s_wal_written is None:
+            self.write_wal(self.c_wal.write, self.c_wal.take())
+
+
+    # Runs func(*args) writing the write-ahead log, holding back the messages
+    #   sent so far until it is done
+    def write_wal(self, func, *args):
+        self.s_wal_held = self.c_sender.take_held()
+        self.s_wal_written = self.run_io(func, *args)
+        self.s_wal_written.add_done_callback(self.wal_written)
+
+
+    def wal_written(self, written):
+        held, self.s_wal_held = self.s_wal_held, None
+        self.s_wal_written = None
+        # The state the held messages report is not durable, so they are dropped
+        if written.exception() is not None:
+            self.c_logger.error('write-ahead log failed error=%s', written.exception())
+            return
+
+        self.c_sender.send_held(held)
+        if not self.c_wal.pending():
+            self.c_sender.release()
+        elif time.time() >= self.c_wal.deadline:
+            self.commit_wal()
+        elif self.c_timers_changed is not None:
+            self.c_timers_changed()
+
+
+    # Compacts every applied slot into a snapshot
+    def take_snapshot(self):
+        self.compact(self.s_applied_slot)
+
+
+    # Drops the per-slot state and the chat log lines of every slot below
+    #   snapshot_slot, which must have been applied to s_log_lines and s_sessions
+    # The snapshot only holds the client sessions and the number of chat log
+    #   lines, so the chat log is made durable up to snapshot_slot before it
+    def compact(self, snapshot_slot):
+        assert ( snapshot_slot == self.s_applied_slot )
+
+        self.append_chat_log()
+        self.run_io(self.c_chat_log.flush, self.c_durable)
+
+        self.s_log_line_base = self.log_line_count()
+        self.s_log_lines = []
+        self.s_log_slot_start = self.s_log_slot_start[snapshot_slot - self.s_slots.base_slot:]
+        self.s_slots.compact(snapshot_slot)
+        self.s_in_flight = set(slot for slot in self.s_in_flight if slot >= snapshot_slot)
+        self.s_propose_time = dict((slot, propose_time) for slot, propose_time
+                                   in self.s_propose_time.items() if slot >= snapshot_slot)
+
+        if self.c_wal is None:
+            return
+
+        # The snapshot replaces the log records of the slots below it once it
+        #   is written, which may be offloaded after the chat log
+        self.s_snapshot_written =\
+            self.run_io(u_write_snapshot, snapshot_file_name(self.replica_id),
+                        ['snapshot', snapshot_slot, self.s_log_line_base,
+                         self.s_sessions.to_list()])
+        self.rewrite_wal()
+
+
+    # Cuts the write-ahead log down to the slots after the last snapshot once
+    #   the snapshot file is written
+    def rewrite_wal(self):
+        if self.s_snapshot_written is None or not self.s_snapshot_written.done() or\
+                self.s_wal_written is not None:
+            return
+
+        written, self.s_snapshot_written = self.s_snapshot_written, None
+        # The records stay until a later snapshot is written
+        if written.exception() is not None:
+            self.c_logger.error('snapshot failed error=%s', written.exception())
+            return
+
+        records = [['promise', self.s_leader_propose_no]]
+        for slot, record in self.s_slots.items():
+            if record.value is not None:
+                records.append(['accept', slot, record.value, record.proposer,
+                                record.client_request, record.client_addr])
+        for slot, record in self.s_slots.items():
+            if record.learned:
+                records.append(['learn', slot])
+
+        # The buffered records are part of records
+        self.c_wal.take()
+        self.write_wal(self.c_wal.rewrite, records)
+
+
+    # Runs func(*args) on c_io_executor if there is one, otherwise right away
+    # Returns the future of its result, whose callbacks run on the event loop
+    def run_io(self, func, *args):
+        if self.c_io_executor is not None:
+            return asyncio.get_running_loop().run_in_executor(self.c_io_executor, func, *args)
+
+        future = Future()
+        future.set_result(func(*args))
+        return future
+
+
+    # Whether the lease I granted, to the leader or to myself, still lasts
+    def lease_granted(self):
+        return time.time() < self.s_lease_granted_until
+
+
+    # Whether I am the leader and a majority has granted me a lease which still lasts
+    def lease_valid(self):
+        return self.is_leader() and self.s_lease_propose_no == self.s_leader_propose_no and\
+            time.time() < self.s_lease_expiry
+
+
+    # Asks every replica for a lease, which is renewed before it runs out
+    def request_lease(self):
+        self.s_lease_no += 1
+        self.s_lease_sent = time.time()
+        self.s_lease_grants = set()
+        self.s_lease_renew_deadline = self.s_lease_sent + self.c_lease_duration / 3
+
+        # I grant the lease to myself as well
+        self.s_lease_holder = self.s_leader_propose_no
+        self.s_lease_granted_until = self.s_lease_sent + self.c_lease_duration
+
+        paxos_lease_request(self.c_sender, self.s_leader_propose_no, self.s_lease_no)
+        self.count_lease_grant()
+
+
+    # Takes the lease once the majority, including myself, has granted it
+    def count_lease_grant(self):
+        if len(self.s_lease_grants) + 1 < self.c_majority_num:
+            return
+
+        # Every grant was given after the request was sent, so the lease
+        #   lasts at least as long at the granting replicas
+        self.s_lease_propose_no = self.s_leader_propose_no
+        self.s_lease_expiry = self.s_lease_sent + self.c_lease_duration * (1 - LEASE_DRIFT)
+
+
+    def handle_lease_request(self, message):
+        propose_no = message['proposer']
+
+        # Only the leader I follow gets a lease, unless a client timed out on it
+        if propose_no != self.s_leader_propose_no or self.is_leader() or\
+                propose_no == self.s_lease_withheld:
+            return
+
+        self.s_lease_holder = propose_no
+        self.s_lease_granted_until = time.time() + self.c_lease_duration
+        self.reset_election_timer()
+
+        paxos_lease_grant(self.c_sender, propose_no, message['lease_no'],
+                          u_get_id(propose_no, self.c_replica_num))
+
+
+    def handle_lease_grant(self, message):
+        # Ignore the grants of an old round or an old request
+        if not self.is_leader() or message['proposer'] != self.s_leader_propose_no or\
+                message['lease_no'] != self.s_lease_no:
+            return
+
+        self.s_lease_grants.add(message['replica_id'])
+        self.count_lease_grant()
+
+
+    def handle_prepare(self, message):
+        proposed_no = message['proposer']
+        proposed_slot = message['slot']
+
+        # If the proposal is old, just ignore it
+        if proposed_no < self.s_leader_propose_no:
+            return
+
+        # Nobody else may become leader while the lease I granted lasts
+        if proposed_no != self.s_lease_holder and self.lease_granted():
+            if self.s_deferred_prepare is None or\
+                    proposed_no >= self.s_deferred_prepare['proposer']:
+                self.s_deferred_prepare = message
+            return
+
+        # The compacted slots are chosen, so the leader should install them
+        #   and prepare again from after them
+        # As its chat log is not known, only the last chunk is sent, and a
+        #   leader which is further behind asks for the chunks it is missing
+        if proposed_slot < self.s_slots.base_slot:
+            self.send_snapshot(u_get_id(proposed_no, self.c_replica_num), self.log_line_count())
+            return
+
+        # Update the leader proposal number
+        self.s_leader_propose_no = proposed_no
+        self.log_promise()
+        self.reset_election_timer()
+
+        # Clear the variables that are specific for leaders (in case it was leader)
+        # if s_leader_propose_no (prev) == s_my_propose_no:
+        self.step_down()
+        self.s_slots[proposed_slot].ack_count = 0
+        self.s_slots[proposed_slot].accept_count = 0
+
+        # The accept counts of unchosen slots in the range belong to older rounds
+        for slot, record in self.s_slots.items(proposed_slot):
+            if not record.learned:
+                record.accept_count = 0
+
+        # Send ack_propose message back to the leader, which carries
+        #   every value I have accepted from proposed_slot on
+        paxos_ack_prepare(self.c_sender,
+                          self.s_slots.accepted_since(proposed_slot),
+                          proposed_slot,
+                          self.s_leader_propose_no,
+                          u_get_id(self.s_leader_propose_no, self.c_replica_num))
+
+
+    def handle_ack_prepare(self, message):
+        acked_slots = message['slots']
+        acked_value = message['accepted']
+        acked_propose_no = message['value_proposer']
+        acked_client_request = message['client_request']
+        acked_client_addr = message['client_addr']
+        acked_slot = message['slot']
+        acked_leader_propose_no = message['proposer']
+
+        # If I am not the leader or the round number is old, ignore the message
+        if u_get_id(acked_leader_propose_no, self.c_replica_num) != self.replica_id:
+            return
+
+        # The propose_no may also be one I have given up running with
+        if acked_leader_propose_no != self.s_leader_propose_no:
+            return
+
+        # If this is the remaining  possible ack from previous prepare, or
+        # If the slot is already proposed, ignore further ack_prepare
+        if acked_slot != self.s_next_slot or\
+                (self.s_slots[acked_slot].ack_count == self.c_majority_num):
+            return
+
+        assert ( self.s_leader_state == 'prepare' )
+        assert ( self.s_slots[acked_slot].ack_count > 0 ) 
+
+        # Always retain the most recent value of every slot in the range
+        for idx, slot in enumerate(acked_slots):
+            if slot not in self.t_prepared or acked_propose_no[idx] > self.t_prepared[slot][1]:
+                self.t_prepared[slot] = [acked_value[idx], acked_propose_no[idx],
+                                         acked_client_request[idx], acked_client_addr[idx]]
+
+        # Increment the acknowledge count
+        self.s_slots[acked_slot].ack_count += 1
+        if self.s_slots[acked_slot].ack_count == self.c_majority_num:
+            # The majority has promised every slot from acked_slot on,
+            #   so this single round of prepare establishes the leader
+            # The prepared range ends after the last slot the majority has accepted
+            end_slot = (max(self.t_prepared) + 1) if self.t_prepared else acked_slot
+
+            for slot in range(acked_slot, end_slot):
+                if self.s_slots.is_learned(slot):
+                    continue
+
+                # An empty slot is filled with a no-op, so that the slots after
+                #   it are not held up
+                if slot not in self.t_prepared:
+                    self.propose_slot(slot, [], [], [], [])
+                    continue
 
                 # If the majority contains value, propose that value
-                if t_value is not None:
-                    if tuple(t_client_request) in s_chosen_client_request:
+                value, _, client_request, client_addr = self.t_prepared[slot]
+
+                for request, addr in zip(client_request, client_addr):
+                    if self.s_sessions.applied(request[0], request[1]):
                         # But tell client that message has already been learnt
-                        paxos_ack_client(replica_id, t_client_request[1],
-                                          (t_client_addr[0], t_client_addr[1]), c_my_drop_rate)
-
-                    # First the leader itself should accept the value
-                    s_accepted[s_next_slot] = t_value
-                    s_proposer[s_next_slot] = s_leader_propose_no
-                    s_client_request[s_next_slot] = copy.deepcopy(t_client_request)
-                    s_client_addr[s_next_slot] = copy.deepcopy(t_client_addr)
-
-                    # Increment the s_accept_msg_count
-                    s_accept_msg_count[s_next_slot] = 1
-
-                    # Update last_accepted if necessary
-                    if s_next_slot > s_last_accepted: 
-                        s_last_accepted = s_next_slot
-
-                    paxos_propose(replica_id, t_value, s_leader_propose_no,
-                                  t_client_request, t_client_addr, 
-                                  s_first_unchosen, s_next_slot,
-                                  s_replica_config, c_my_drop_rate)
-
-                    paxos_accept(replica_id,
-                                 s_accepted[acked_slot],
-                                 s_proposer[acked_slot],
-                                 s_client_request[acked_slot],
-                                 s_client_addr[acked_slot],
-                                 acked_slot, s_replica_config, c_my_drop_rate)
-
-                    # Clear the temp variables for future usage
-                    t_value = None
-                    t_propose_no = 0
-                    t_client_request = None
-                    t_client_addr = None
-                    t_no_more_accepted = True
+                        paxos_ack_client(self.c_sender, request[1], (addr[0], addr[1]),
+                                         self.s_sessions.last_slot(request[0]))
 
-                    continue
+                self.propose_slot(slot, value, copy.deepcopy(client_request),
+                                  copy.deepcopy(client_addr), [])
 
-                # Add this slot to slot_buffer_queue
-                s_slot_buffer_queue.append(acked_slot)
-
-                if s_leader_state == 'established':
-                    while s_slot_buffer_queue != []:
-                        if s_request_queue == []:
-                            s_waiting_client = True
-                            break
-
-                        else:
-                            client_message = s_request_queue.pop(0)
-                            value = client_message['value']
-                            propose_no = s_leader_propose_no
-                            client_request = [client_message['client_id'],
-                                              client_message['client_request_no']]
-                            client_addr = [client_message['client_ip'],
-                                           client_message['client_port']]
-
-                            if tuple(client_request) in s_chosen_client_request:
-                                paxos_ack_client(replica_id, client_request[1],
-                                                 (client_addr[0], client_addr[1]), c_my_drop_rate)
-
-                            slot_to_fill = s_slot_buffer_queue.pop(0)
-
-                            # -------------- Skip the skip slot -------------- #
-                            if slot_to_fill in c_my_skip_slot:
-                                continue
-                            # -------------- Skip the skip slot -------------- #
-
-                            # First the leader itself should accept the value
-                            s_accepted[slot_to_fill] = value
-                            s_proposer[slot_to_fill] = propose_no
-                            s_client_request[slot_to_fill] = client_request
-                            s_client_addr[slot_to_fill] = client_addr
-
-                            # Increment the s_accept_msg_count
-                            s_accept_msg_count[slot_to_fill] = 1
-
-                            # Update last_accepted
-                            if slot_to_fill > s_last_accepted: 
-                                s_last_accepted = slot_to_fill
-
-                            paxos_propose(replica_id, value, propose_no, client_request, client_addr,
-                                          s_first_unchosen, slot_to_fill, s_replica_config, c_my_drop_rate)
-
-                            paxos_accept(replica_id,
-                                         s_accepted[slot_to_fill],
-                                         s_proposer[slot_to_fill],
-                                         s_client_request[slot_to_fill],
-                                         s_client_addr[slot_to_fill],
-                                         slot_to_fill,
-                                         s_replica_config,
-                                         c_my_drop_rate)
-
-                            s_waiting_client = False
-
-                    # Clear the temp variables for future usage
-                    t_value = None
-                    t_propose_no = 0
-                    t_client_request = None
-                    t_client_addr = None
-                    t_no_more_accepted = True
-
-                    # If the s_slot_buffer_queue is exhausted, need to enter 'dictated' stage
-                    if s_slot_buffer_queue == []:
-                        s_leader_state = 'dictated'
-
-                        # Now s_next_slot is independent of s_first_unchosen
-                        s_next_slot += 1
-                        while s_next_slot in s_learned:
-                            t_no_more_accepted = True
-                            s_next_slot += 1
-
-                        while s_request_queue != []:
-                            client_message = s_request_queue.pop(0)
-                            value = client_message['value']
-                            propose_no = s_leader_propose_no
-                            client_request = [client_message['client_id'],
-                                              client_message['client_request_no']]
-                            client_addr = [client_message['client_ip'],
-                                           client_message['client_port']]
-
-                            if tuple(client_request) in s_chosen_client_request:
-                                paxos_ack_client(replica_id, client_request[1],
-                                                 (client_addr[0], client_addr[1]), c_my_drop_rate)
-
-                            # -------------- Skip the skip slot -------------- #
-                            if s_next_slot in c_my_skip_slot:
-                                s_next_slot += 1
-                                while s_next_slot in s_learned:
-                                    t_no_more_accepted = True
-                                    s_next_slot += 1
-                                continue
-                            # -------------- Skip the skip slot -------------- #
-
-
-                            # First the leader itself should accept the value
-                            s_accepted[s_next_slot] = value
-                            s_proposer[s_next_slot] = propose_no
-                            s_client_request[s_next_slot] = client_request
-                            s_client_addr[s_next_slot] = client_addr
-
-                            # Increment the s_accept_msg_count
-                            s_accept_msg_count[s_next_slot] = 1
-
-                            # Update last_accepted
-                            if s_next_slot > s_last_accepted: 
-                                s_last_accepted = s_next_slot
-
-                            paxos_propose(replica_id, value, propose_no, client_request, client_addr,
-                                          s_first_unchosen, s_next_slot, s_replica_config, c_my_drop_rate)
-
-                            paxos_accept(replica_id,
-                                         s_accepted[s_next_slot],
-                                         s_proposer[s_next_slot],
-                                         s_client_request[s_next_slot],
-                                         s_client_addr[s_next_slot],
-                                         s_next_slot,
-                                         s_replica_config,
-                                         c_my_drop_rate)
-
-                            # Now s_next_slot is independent of s_first_unchosen
-                            s_next_slot += 1
-                            while s_next_slot in s_learned:
-                                t_no_more_accepted = True
-                                s_next_slot += 1
-
-                        # After exhausting the request queue, have to wait
-                        s_waiting_client = True    
-
-                else: # If the leader state is 'prepare'
-                    assert ( s_leader_state == 'prepare' )
-                    # Just jump to the next slot
-                    s_next_slot += 1
-                    while s_next_slot in s_learned:
-                        t_no_more_accepted = True
-                        s_next_slot += 1
-
-                    # Initialize temp variables with leader's own slot
-                    t_value = s_accepted.get(s_next_slot, None)
-                    t_propose_no = s_proposer.get(s_next_slot, 0)
-                    t_client_request = s_client_request.get(s_next_slot, None)
-                    t_client_addr = s_client_addr.get(s_next_slot, None)
-
-                    # Before sending prepare msg, the leader already has one ack (itself)
-                    s_ack_msg_count[s_next_slot] = 1
-
-                    # Just an initialization for safety
-                    s_leader_state = 'prepare'
-                    s_accept_msg_count[s_next_slot] = 0
-                    s_waiting_client = False
-
-                    paxos_prepare(replica_id,
-                                  s_leader_propose_no,
-                                  s_next_slot,
-                                  s_replica_config,
-                                  c_my_drop_rate)
-
-
-        elif message_type == 'propose':
-            prop_value = message['to_accept']
-            prop_proposed_no = message['proposer']
-            prop_client_request = message['client_request']
-            prop_client_addr = message['client_addr']
-            prop_first_unchosen = message['first_unchosen']
-            prop_slot = message['slot']
-
-            # If this is the decree from old leader, just ignore it
-            if prop_proposed_no < s_leader_propose_no:
-                continue
+            # Clear the temp variables for future usage
+            self.t_prepared = {}
 
-            # It is possible that the replica first receives 'accept' then this 'propose',
-            #   in which case s_accept_msg_count[prop_slot] is at least 2
-            if prop_proposed_no == s_leader_propose_no and\
-                    s_accept_msg_count.get(prop_slot, 0) > 1:
-                continue
+            # Now s_next_slot is independent of s_first_unchosen
+            self.s_leader_state = 'dictated'
+            self.s_next_slot = end_slot
+            while self.s_slots.is_learned(self.s_next_slot):
+                self.s_next_slot += 1
+            self.c_logger.info('leader propose_no=%s next_slot=%s',
+                               self.s_leader_propose_no, self.s_next_slot)
 
-            # Update the leader proposal number
-            s_leader_propose_no = prop_proposed_no
+            if self.c_lease_duration > 0:
+                self.request_lease()
 
-            # Clear the variables that are specific for leaders (in case it was leader)
-            # if s_leader_propose_no (prev) == s_my_propose_no:
-            s_leader_state = 'prepare'
-            s_ack_msg_count[prop_slot] = 0
-
-            # Accept the proposed value
-            s_accepted[prop_slot] = prop_value
-            s_proposer[prop_slot] = prop_proposed_no
-            s_client_request[prop_slot] = copy.deepcopy(prop_client_request)
-            s_client_addr[prop_slot] = copy.deepcopy(prop_client_addr)
-            # Initialize the s_accept_msg_count
-            s_accept_msg_count[prop_slot] = 1
-
-            # Update last_accepted to the most correct value
-            if prop_slot > s_last_accepted: 
-                s_last_accepted = prop_slot
-
-            paxos_accept(replica_id,
-                         s_accepted[prop_slot],
-                         s_proposer[prop_slot],
-                         s_client_request[prop_slot],
-                         s_client_addr[prop_slot],
-                         prop_slot, s_replica_config, c_my_drop_rate)
-
-            # Send help_me_choose based on received first_unchosen
-            if prop_first_unchosen > s_first_unchosen:
-                leader_id = u_get_id(s_leader_propose_no, c_replica_num)
-                paxos_help_me_choose(replica_id, s_first_unchosen, leader_id,
-                                     s_replica_config, c_my_drop_rate)
-
-
-        elif message_type == 'accept':
-            accept_value = message['accepted']
-            accept_propose_no = message['proposer']
-            accept_client_request = message['client_request']
-            accept_client_addr = message['client_addr']
-            accept_slot = message['slot']
-
-            # If I have already chosen in this slot, just ignore the message
-            if accept_slot in s_learned:
-                continue
+            # Propose the queued requests as far as the pipeline window allows
+            self.s_waiting_client = True
+            self.drain_requests()
+
+
+    # Accepts the batch of values in slot myself and proposes it to every other replica
+    # An empty batch is a no-op, which adds no line to the chat log
+    # traces are the trace ids of the client requests, or [] if none is traced
+    def propose_slot(self, slot, value, client_request, client_addr, traces):
+        self.record_traces(traces, 'propose', slot)
+
+        # First the leader itself should accept the value
+        self.s_slots[slot].accept(value, self.s_leader_propose_no, client_request, client_addr)
+        self.log_accept(slot)
+
+        # Increment the accept count
+        self.s_slots[slot].accept_count = 1
+        self.s_in_flight.add(slot)
+        self.s_propose_time[slot] = time.time()
+
+        # Update last_accepted if necessary
+        if slot > self.s_last_accepted:
+            self.s_last_accepted = slot
+
+        paxos_propose(self.c_sender, value, self.s_leader_propose_no,
+                      client_request, client_addr, self.s_first_unchosen, slot, traces)
 
-            # Ignore the old proposal no
-            if accept_propose_no < s_leader_propose_no:
+        paxos_accept(self.c_sender, value, self.s_leader_propose_no,
+                     client_request, client_addr, slot, traces)
+
+
+    # Fills every hole below s_next_slot, i.e. every slot neither chosen nor in
+    #   flight, such as a skipped slot, with a no-op, all in one round
+    # A slot in flight for longer than a heartbeat interval, whose messages may
+    #   all have been lost, is proposed again
+    def fill_holes(self):
+        if not self.is_leader() or self.s_leader_state != 'dictated':
+            return
+
+        now = time.time()
+        for slot in range(self.s_first_unchosen, self.s_next_slot):
+            if self.s_slots.is_learned(slot):
                 continue
-            # If find a newer accept message, clear the count and updates leader
-            elif accept_propose_no > s_leader_propose_no:
-                # Update the leader
-                s_leader_propose_no = accept_propose_no
-                # Even if it originally is leader, it shouldn't be now
-                # if s_leader_propose_no (prev) == s_my_propose_no:
-                s_leader_state = 'prepare'
-                s_ack_msg_count[accept_slot] = 0
-
-                # Accept the new value from newer leader
-                s_accepted[accept_slot] = accept_value
-                s_proposer[accept_slot] = accept_propose_no
-                s_client_request[accept_slot] = accept_client_request
-                s_client_addr[accept_slot] = accept_client_addr
+            if slot not in self.s_in_flight:
+                self.propose_slot(slot, [], [], [], [])
+            elif now - self.s_propose_time.get(slot, 0) >= self.c_heartbeat_interval:
+                self.repropose_slot(slot)
+
+
+    # Proposes the value of a slot in flight again with the same propose_no
+    # The replicas which have accepted it already answer me alone, so the
+    #   accept count starts over from myself
+    def repropose_slot(self, slot):
+        record = self.s_slots[slot]
+        record.accept_count = 1
+
+        paxos_propose(self.c_sender, record.value, self.s_leader_propose_no,
+                      record.client_request, record.client_addr, self.s_first_unchosen,
+                      slot, [], retry=True)
+
+
+    def handle_propose(self, message):
+        prop_value = message['to_accept']
+        prop_proposed_no = message['proposer']
+        prop_client_request = message['client_request']
+        prop_client_addr = message['client_addr']
+        prop_first_unchosen = message['first_unchosen']
+        prop_slot = message['slot']
+        prop_traces = message['traces']
+
+        # If this is the decree from old leader, just ignore it
+        if prop_proposed_no < self.s_leader_propose_no:
+            return
+
+        # The slot has been chosen and compacted
+        if prop_slot < self.s_slots.base_slot:
+            return
+
+        # A slot proposed again after I have accepted it is only answered to the
+        #   leader, which counts from scratch, so no other replica counts my
+        #   accept twice
+        if message['retry'] and prop_proposed_no == self.s_leader_propose_no and\
+                self.s_slots[prop_slot].accept_count > 0 and\
+                self.s_slots[prop_slot].proposer == prop_proposed_no:
+            paxos_accept(self.c_sender,
+                         self.s_slots[prop_slot].value,
+                         self.s_slots[prop_slot].proposer,
+                         self.s_slots[prop_slot].client_request,
+                         self.s_slots[prop_slot].client_addr,
+                         prop_slot,
+                         prop_traces,
+                         u_get_id(prop_proposed_no, self.c_replica_num))
+            return
+
+        # It is possible that the replica first receives 'accept' then this 'propose',
+        #   in which case the accept count of prop_slot is at least 2
+        if prop_proposed_no == self.s_leader_propose_no and\
+                self.s_slots[prop_slot].accept_count > 1:
+            return
+
+        # Update the leader proposal number
+        self.s_leader_propose_no = prop_proposed_no
+        self.reset_election_timer()
+
+        # Clear the variables that are specific for leaders (in case it was leader)
+        # if s_leader_propose_no (prev) == s_my_propose_no:
+        self.step_down()
+        self.s_slots[prop_slot].ack_count = 0
+
+        # Accept the proposed value
+        self.record_traces(prop_traces, 'propose_recv', prop_slot)
+        self.s_slots[prop_slot].accept(prop_value, prop_proposed_no,
+                                       copy.deepcopy(prop_client_request),
+                                       copy.deepcopy(prop_client_addr))
+        self.log_accept(prop_slot)
+        # Initialize the accept count
+        self.s_slots[prop_slot].accept_count = 1
+
+        # Update last_accepted to the most correct value
+        if prop_slot > self.s_last_accepted: 
+            self.s_last_accepted = prop_slot
+
+        paxos_accept(self.c_sender,
+                     self.s_slots[prop_slot].value,
+                     self.s_slots[prop_slot].proposer,
+                     self.s_slots[prop_slot].client_request,
+                     self.s_slots[prop_slot].client_addr,
+                     prop_slot,
+                     prop_traces)
+
+        # Catch up with the leader based on received first_unchosen
+        if prop_first_unchosen > self.s_first_unchosen:
+            self.catch_up(prop_first_unchosen,
+                          u_get_id(self.s_leader_propose_no, self.c_replica_num))
+
+
+    def handle_accept(self, message):
+        accept_value = message['accepted']
+        accept_propose_no = message['proposer']
+        accept_client_request = message['client_request']
+        accept_client_addr = message['client_addr']
+        accept_slot = message['slot']
+        accept_traces = message['traces']
+
+        self.record_traces(accept_traces, 'accept_recv', accept_slot)
+
+        # If I have already chosen in this slot, just ignore the message
+        if self.s_slots.is_learned(accept_slot):
+            return
+
+        # Ignore the old proposal no
+        if accept_propose_no < self.s_leader_propose_no:
+            return
+        # If find a newer accept message, clear the count and updates leader
+        elif accept_propose_no > self.s_leader_propose_no:
+            # Update the leader
+            self.s_leader_propose_no = accept_propose_no
+            # Even if it originally is leader, it shouldn't be now
+            # if s_leader_propose_no (prev) == s_my_propose_no:
+            self.step_down()
+            self.s_slots[accept_slot].ack_count = 0
+
+            # Accept the new value from newer leader
+            self.s_slots[accept_slot].accept(accept_value, accept_propose_no,
+                                             accept_client_request, accept_client_addr)
+            self.log_accept(accept_slot)
+            # This includes myself and the one sends accept to me
+            self.s_slots[accept_slot].accept_count = 2
+
+            # Update last_accepted if necessary
+            if accept_slot > self.s_last_accepted: 
+                self.s_last_accepted = accept_slot
+
+            paxos_accept(self.c_sender,
+                         self.s_slots[accept_slot].value,
+                         self.s_slots[accept_slot].proposer,
+                         self.s_slots[accept_slot].client_request,
+                         self.s_slots[accept_slot].client_addr,
+                         accept_slot,
+                         accept_traces)
+        # If the accept message is just this propose_no:
+        else:
+            # If the acceptor didn't get propose message but get accept message:
+            # It is possible that a replica only received prepare but not propose
+            # The accept count may also have been reset by a view change after a timeout
+            if (self.s_slots[accept_slot].accept_count == 0) or\
+                    (accept_propose_no > self.s_slots[accept_slot].proposer):
+                # This should not happen when I am leader
+                assert ( not self.is_leader() )
+                self.s_slots[accept_slot].accept(accept_value, accept_propose_no,
+                                                 accept_client_request, accept_client_addr)
+                self.log_accept(accept_slot)
                 # This includes myself and the one sends accept to me
-                s_accept_msg_count[accept_slot] = 2
+                self.s_slots[accept_slot].accept_count = 2
 
                 # Update last_accepted if necessary
-                if accept_slot > s_last_accepted: 
-                    s_last_accepted = accept_slot
-
-                paxos_accept(replica_id,
-                             s_accepted[accept_slot],
-                             s_proposer[accept_slot],
-                             s_client_request[accept_slot],
-                             s_client_addr[accept_slot],
-                             accept_slot, s_replica_config, c_my_drop_rate)
-            # If the accept message is just this propose_no:
+                if accept_slot > self.s_last_accepted: 
+                    self.s_last_accepted = accept_slot
+
+                paxos_accept(self.c_sender,
+                             self.s_slots[accept_slot].value,
+                             self.s_slots[accept_slot].proposer,
+                             self.s_slots[accept_slot].client_request,
+                             self.s_slots[accept_slot].client_addr,
+                             accept_slot,
+                             accept_traces)
+                
             else:
-                # If the acceptor didn't get propose message but get accept message:
-                # It is possible that a replica only received prepare but not propose
-                # The first two conditions are not enough since timeout may also lead to view change,
-                #   in which case s_accept_msg_count is not initialized
-                if (accept_slot not in s_accept_msg_count) or\
-                        (s_accept_msg_count[accept_slot] == 0) or\
-                        (accept_propose_no > s_proposer[accept_slot]):
-                    # This should not happen when I am leader
-                    assert ( u_get_id(s_leader_propose_no, c_replica_num) != replica_id ) 
-                    s_accepted[accept_slot] = accept_value
-                    s_proposer[accept_slot] = accept_propose_no
-                    s_client_request[accept_slot] = accept_client_request
-                    s_client_addr[accept_slot] = accept_client_addr
-                    # This includes myself and the one sends accept to me
-                    s_accept_msg_count[accept_slot] = 2
-
-                    # Update last_accepted if necessary
-                    if accept_slot > s_last_accepted: 
-                        s_last_accepted = accept_slot
-
-                    paxos_accept(replica_id,
-                                 s_accepted[accept_slot],
-                                 s_proposer[accept_slot],
-                                 s_client_request[accept_slot],
-                                 s_client_addr[accept_slot],
-                                 accept_slot, s_replica_config, c_my_drop_rate)
-                    
-                else:
-                    assert ( s_accept_msg_count[accept_slot] > 0 )
-                    s_accept_msg_count[accept_slot] += 1
-
-            # If the majority accept arrives, learn the value
-            if s_accept_msg_count[accept_slot] == c_majority_num:    
-                # Learn the accepted value
-                s_learned.add(accept_slot)
-                # Once the client request has been learnt, it should never be executed again
-                s_chosen_client_request.add(tuple(accept_client_request))
-                # Update first_unchosen to the most correct value
-                if s_first_unchosen == accept_slot:
-                    while s_first_unchosen in s_learned:
-                        s_first_unchosen += 1
-
-                paxos_ack_client(replica_id,
-                                 s_client_request[accept_slot][1],
-                                 s_client_addr[accept_slot],
-                                 c_my_drop_rate)
-
-                # If I am the leader, potentially need to process another message
-                if u_get_id(s_leader_propose_no, c_replica_num) == replica_id:
-
-                    # 'dictate' state means no need for prepare
-                    # Now s_next_slot is independent of s_first_unchosen
-                    if s_leader_state == 'dictated':
-                        assert( s_next_slot >= s_first_unchosen )
-                        continue
-
-                    # 'established' state is the final round of 'prepare' state
-                    elif s_leader_state == 'established':
-                        while s_slot_buffer_queue != []:
-                            if s_request_queue == []:
-                                s_waiting_client = True
-                                break
-
-                            else:
-                                client_message = s_request_queue.pop(0)
-                                value = client_message['value']
-                                propose_no = s_leader_propose_no
-                                client_request = [client_message['client_id'],
-                                                  client_message['client_request_no']]
-                                client_addr = [client_message['client_ip'],
-                                               client_message['client_port']]
-
-                                if tuple(client_request) in s_chosen_client_request:
-                                    paxos_ack_client(replica_id, client_request[1],
-                                                     (client_addr[0], client_addr[1]), c_my_drop_rate)
-
-                                slot_to_fill = s_slot_buffer_queue.pop(0)
-
-                                # -------------- Skip the skip slot -------------- #
-                                if slot_to_fill in c_my_skip_slot:
-                                    continue
-                                # -------------- Skip the skip slot -------------- #
-
-                                # First the leader itself should accept the value
-                                s_accepted[slot_to_fill] = value
-                                s_proposer[slot_to_fill] = propose_no
-                                s_client_request[slot_to_fill] = client_request
-                                s_client_addr[slot_to_fill] = client_addr
-
-                                # Increment the s_accept_msg_count
-                                s_accept_msg_count[slot_to_fill] = 1
-
-                                # Update last_accepted
-                                if slot_to_fill > s_last_accepted: 
-                                    s_last_accepted = slot_to_fill
-
-                                paxos_propose(replica_id, value, propose_no, client_request, client_addr,
-                                              s_first_unchosen, slot_to_fill, s_replica_config, c_my_drop_rate)
-
-                                paxos_accept(replica_id,
-                                             s_accepted[slot_to_fill],
-                                             s_proposer[slot_to_fill],
-                                             s_client_request[slot_to_fill],
-                                             s_client_addr[slot_to_fill],
-                                             slot_to_fill,
-                                             s_replica_config,
-                                             c_my_drop_rate)
-
-                                s_waiting_client = False
-
-                        # If the s_slot_buffer_queue is exhausted, need to enter 'dictated' stage
-                        if s_slot_buffer_queue == []:
-                            s_leader_state = 'dictated'
-                            # Now s_next_slot is independent of s_first_unchosen
-                            s_next_slot += 1
-                            while s_next_slot in s_learned:
-                                t_no_more_accepted = True
-                                s_next_slot += 1
-
-                            while s_request_queue != []:
-                                client_message = s_request_queue.pop(0)
-                                value = client_message['value']
-                                propose_no = s_leader_propose_no
-                                client_request = [client_message['client_id'],
-                                                  client_message['client_request_no']]
-                                client_addr = [client_message['client_ip'],
-                                               client_message['client_port']]
-
-                                if tuple(client_request) in s_chosen_client_request:
-                                    paxos_ack_client(replica_id, client_request[1],
-                                                     (client_addr[0], client_addr[1]), c_my_drop_rate)
-
-                                # -------------- Skip the skip slot -------------- #
-                                if s_next_slot in c_my_skip_slot:
-                                    s_next_slot += 1
-                                    while s_next_slot in s_learned:
-                                        t_no_more_accepted = True
-                                        s_next_slot += 1
-                                    continue
-                                # -------------- Skip the skip slot -------------- #
-
-                                # First the leader itself should accept the value
-                                s_accepted[s_next_slot] = value
-                                s_proposer[s_next_slot] = propose_no
-                                s_client_request[s_next_slot] = client_request
-                                s_client_addr[s_next_slot] = client_addr
-
-                                # Increment the s_accept_msg_count
-                                s_accept_msg_count[s_next_slot] = 1
-
-                                # Update last_accepted
-                                if s_next_slot > s_last_accepted: 
-                                    s_last_accepted = s_next_slot
-
-                                paxos_propose(replica_id, value, propose_no, client_request, client_addr,
-                                              s_first_unchosen, s_next_slot, s_replica_config, c_my_drop_rate)
-
-                                paxos_accept(replica_id,
-                                             s_accepted[s_next_slot],
-                                             s_proposer[s_next_slot],
-                                             s_client_request[s_next_slot],
-                                             s_client_addr[s_next_slot],
-                                             s_next_slot,
-                                             s_replica_config,
-                                             c_my_drop_rate)
-
-                                # Now s_next_slot is independent of s_first_unchosen
-                                s_next_slot += 1
-                                while s_next_slot in s_learned:
-                                    t_no_more_accepted = True
-                                    s_next_slot += 1
-
-                            # After exhausting the request queue, have to wait
-                            s_waiting_client = True    
-
-                    else: # if s_leader_state == 'prepare'
-                        # The feature of skip_slot means that s_next_slot is independent of s_first_unchosen
-                        assert ( s_next_slot != s_first_unchosen )
-                        s_next_slot = s_first_unchosen if (s_next_slot <= s_first_unchosen) else (s_next_slot + 1)
-
-                        # Initialize temp variables with leader's own slot
-                        t_value = s_accepted.get(s_next_slot, None)
-                        t_propose_no = s_proposer.get(s_next_slot, 0)
-                        t_client_request = s_client_request.get(s_next_slot, None)
-                        t_client_addr = s_client_addr.get(s_next_slot, None)
-
-                        # Before sending prepare msg, the leader already has one ack (itself)
-                        s_ack_msg_count[s_next_slot] = 1
-
-                        # Just an initialization for safety
-                        s_leader_state = 'prepare'
-                        s_accept_msg_count[s_next_slot] = 0
-                        s_waiting_client = False
-
-                        paxos_prepare(replica_id,
-                                      s_leader_propose_no,
-                                      s_next_slot,
-                                      s_replica_config,
-                                      c_my_drop_rate)
-
-                # If I am not the leader, just follow first_unchosen
+                assert ( self.s_slots[accept_slot].accept_count > 0 )
+                self.s_slots[accept_slot].accept_count += 1
+
+        # If the majority accept arrives, learn the value
+        if self.s_slots[accept_slot].accept_count == self.c_majority_num:    
+            # Learn the accepted value
+            self.s_slots[accept_slot].learned = True
+            self.log_learn(accept_slot)
+            self.s_in_flight.discard(accept_slot)
+            propose_time = self.s_propose_time.pop(accept_slot, None)
+            if propose_time is not None:
+                self.c_metrics.observe('paxos_commit_latency_seconds',
+                                       time.time() - propose_time)
+            # Update first_unchosen to the most correct value
+            if self.s_first_unchosen == accept_slot:
+                while self.s_slots.is_learned(self.s_first_unchosen):
+                    self.s_first_unchosen += 1
+
+            self.record_traces(accept_traces, 'chosen', accept_slot)
+
+            # Every request packed in the slot gets its own ack
+            traces = accept_traces
+            if len(traces) != len(self.s_slots[accept_slot].client_request):
+                traces = [0] * len(self.s_slots[accept_slot].client_request)
+            for request, addr, trace_id in zip(self.s_slots[accept_slot].client_request,
+                                               self.s_slots[accept_slot].client_addr,
+                                               traces):
+                paxos_ack_client(self.c_sender, request[1], addr, accept_slot, trace_id)
+
+            # If I am the leader, potentially need to process another message
+            if u_get_id(self.s_leader_propose_no, self.c_replica_num) == self.replica_id:
+
+                # 'dictate' state means no need for prepare
+                # Now s_next_slot is independent of s_first_unchosen
+                if self.s_leader_state == 'dictated':
+                    assert( self.s_next_slot >= self.s_first_unchosen )
+
+                    # The chosen slot opens up the pipeline window for queued requests
+                    self.propose_queued()
+                    return
+
+                # In 'prepare' state nothing is to be done, the majority of
+                #   ack_prepare re-proposes the whole prepared range at once
+
+            # If I am not the leader, just follow first_unchosen
+            else:
+                # The feature of skip_slot means that s_next_slot is independent of s_first_unchosen
+                self.s_next_slot = self.s_first_unchosen\
+                    if (self.s_next_slot <= self.s_first_unchosen) else (self.s_next_slot + 1)
+
+
+    def handle_client_request(self, message):
+        client_id = message['client_id']
+        client_ip = message['client_ip']
+        client_port = message['client_port']
+        client_request_no = message['client_request_no']
+        client_think_propose_no = message['propose_no']
+        trace_id = message.get('trace_id', 0)
+
+        if trace_id:
+            self.record_traces([trace_id], 'request')
+
+        if self.s_sessions.applied(client_id, client_request_no):
+            # But tell client that message has already been learnt
+            paxos_ack_client(self.c_sender, client_request_no, (client_ip, client_port),
+                             self.s_sessions.last_slot(client_id), trace_id)
+            return
+
+        # If the client-believed leader is older, tell it the correct leader
+        if client_think_propose_no < self.s_leader_propose_no:
+            paxos_tell_client_new_leader(self.c_sender, self.s_leader_propose_no,
+                                         client_ip, client_port)
+            return
+
+        # The lease I granted keeps the current leader
+        elif client_think_propose_no > self.s_leader_propose_no and self.lease_granted():
+            paxos_tell_client_new_leader(self.c_sender, self.s_leader_propose_no,
+                                         client_ip, client_port)
+            return
+
+        # If the client-believed leader is newer, I become the new leader
+        elif client_think_propose_no > self.s_leader_propose_no:
+            assert ( u_get_id(client_think_propose_no, self.c_replica_num) ==\
+                     self.replica_id )
+
+            self.become_leader(client_think_propose_no)
+
+        # If too many are waiting for the pipeline window, tell the client to
+        #   send the request again later, so that it does not time out and
+        #   replace a leader which is only busy
+        if self.c_queue_limit > 0 and len(self.s_request_queue) >= self.c_queue_limit and\
+                (client_id, client_request_no) not in self.s_request_queue:
+            paxos_tell_client_busy(self.c_sender, client_request_no, client_ip, client_port)
+            return
+
+        # Queue the client request message, a resend of a queued one is merged
+        if not self.s_request_queue.push(message):
+            return
+
+        self.drain_requests()
+
+
+    # Proposes queued client requests if the leader is waiting for them
+    # A leader still preparing keeps them queued until it is established
+    def drain_requests(self):
+        if not self.is_leader() or self.s_leader_state != 'dictated':
+            self.s_batch_deadline = None
+            return
+
+        # Hold back a partial batch until it fills up or has lingered long enough
+        if self.c_batch_linger > 0 and len(self.s_request_queue) < self.c_batch_size:
+            if self.s_batch_deadline is None:
+                self.s_batch_deadline = time.time() + self.c_batch_linger
+            if time.time() < self.s_batch_deadline:
+                return
+
+        self.s_batch_deadline = None
+
+        # If a job is already waiting for client message
+        if self.s_waiting_client == True:
+            self.propose_queued()
+
+
+    # Packs the queued client requests into slots from s_next_slot on and
+    #   proposes them, until the queue is empty or the pipeline window is full
+    # Only the established leader proposes, under its own propose_no
+    def propose_queued(self):
+        if not self.is_leader() or self.s_leader_state != 'dictated':
+            return
+
+        while len(self.s_request_queue) > 0 and\
+                u_window_open(self.s_in_flight, self.c_pipeline_window):
+            # -------------- Skip the skip slot -------------- #
+            if self.s_next_slot in self.c_my_skip_slot:
+                self.s_next_slot += 1
+                while self.s_slots.is_learned(self.s_next_slot):
+                    self.s_next_slot += 1
+                continue
+            # -------------- Skip the skip slot -------------- #
+
+            # Pack as many queued requests as the batch allows into one slot
+            value, client_request, client_addr, traces = self.s_request_queue.pop_batch(
+                self.c_batch_size, self.c_batch_bytes)
+
+            for request, addr in zip(client_request, client_addr):
+                if self.s_sessions.applied(request[0], request[1]):
+                    paxos_ack_client(self.c_sender, request[1], (addr[0], addr[1]),
+                                     self.s_sessions.last_slot(request[0]))
+
+            self.propose_slot(self.s_next_slot, value, client_request, client_addr, traces)
+
+            self.s_next_slot += 1
+            while self.s_slots.is_learned(self.s_next_slot):
+                self.s_next_slot += 1
+
+
+    def handle_client_timeout(self, message):
+        client_ip = message['client_ip']
+        client_port = message['client_port']
+        client_think_propose_no = message['propose_no']
+
+        # While the lease I granted lasts, the current leader stays, but its
+        #   lease is not renewed so that the next timeout can replace it
+        if client_think_propose_no >= self.s_leader_propose_no and self.lease_granted():
+            self.s_lease_withheld = self.s_leader_propose_no
+
+        # Client is newer, meaning I should listen to the client
+        elif client_think_propose_no >= self.s_leader_propose_no:
+            # If I happened to be the new leader
+            if u_get_id(client_think_propose_no + 1, self.c_replica_num) == self.replica_id:
+                self.become_leader(client_think_propose_no + 1)
+            else:
+                self.s_leader_propose_no = client_think_propose_no + 1
+                self.log_promise()
+                self.step_down()
+
+        # If I am newer, meaning client missed something, just tell it mine
+        # Do nothing in this case
+
+        paxos_tell_client_new_leader(self.c_sender, self.s_leader_propose_no,
+                                     client_ip, client_port)
+
+
+    def handle_print_log(self, message):
+        self.append_chat_log()
+
+
+    # Applies the chosen slots from s_applied_slot to end_slot in order, the
+    #   requests which are not duplicates become chat log lines
+    def apply_chosen(self, end_slot):
+        if end_slot <= self.s_applied_slot:
+            return
+
+        accepted, _, client_request, _ = self.s_slots.read_range(self.s_applied_slot, end_slot)
+        for idx, (values, requests) in enumerate(zip(accepted, client_request)):
+            self.s_log_slot_start.append(self.log_line_count())
+            for value, request in zip(values, requests):
+                if self.s_sessions.apply(request[0], request[1], self.s_applied_slot + idx):
+                    self.s_log_lines.append(value + '\n')
+
+        self.s_applied_slot = end_slot
+
+
+    # The number of chat log lines of every slot below s_applied_slot
+    def log_line_count(self):
+        return self.s_log_line_base + len(self.s_log_lines)
+
+
+    # Appends the lines applied since the last call to the chat log
+    def append_chat_log(self):
+        if self.s_applied_slot <= self.s_log_high_water:
+            return
+
+        # Only writing the lines may be offloaded
+        lines = self.s_log_lines[self.s_log_written - self.s_log_line_base:]
+        self.s_log_high_water = self.s_applied_slot
+        self.s_log_written = self.log_line_count()
+        self.run_io(self.c_chat_log.append, lines, self.s_log_high_water)
+
+        if self.c_log_flush_interval == 0:
+            self.run_io(self.c_chat_log.flush)
+        elif self.s_log_flush_deadline is None:
+            self.s_log_flush_deadline = time.time() + self.c_log_flush_interval
+
+
+    # Records hop of every traced client request in traces, see paxos_trace
+    def record_traces(self, traces, hop, slot=-1):
+        if self.c_traces is not None and traces:
+            self.c_traces.record_all(traces, hop, slot)
+
+
+    # Sends a chunk of the hops recorded of the trace asked for, or of every
+    #   trace if 0, which are taken when the first chunk is asked for
+    def handle_trace_dump(self, message):
+        start = message['start']
+        if start == 0:
+            self.s_trace_dump = self.c_traces.dump(message['trace_id'])\
+                if self.c_traces is not None else []
+
+        paxos_trace_events(self.c_sender, start, len(self.s_trace_dump),
+                           self.s_trace_dump[start:start + TRACE_CHUNK],
+                           (message['client_ip'], message['client_port']))
+
+
+    def handle_client_read(self, message):
+        client_ip = message['client_ip']
+        client_port = message['client_port']
+        client_think_propose_no = message['propose_no']
+
+        # If the client-believed leader is older, tell it the correct leader
+        if client_think_propose_no < self.s_leader_propose_no:
+            paxos_tell_client_new_leader(self.c_sender, self.s_leader_propose_no,
+                                         client_ip, client_port)
+            return
+
+        # Otherwise the client times out and looks for the leader
+        if not self.is_leader():
+            return
+
+        # Drop the read if too many are waiting, the client will resend it
+        if self.c_queue_limit > 0 and len(self.s_pending_reads) >= self.c_queue_limit:
+            return
+
+        self.s_pending_reads.append([None, message])
+
+
+    # Any replica answers from the slots it has applied, as long as they
+    #   include every slot below the min_slot of the client
+    def handle_follower_read(self, message):
+        if message['min_slot'] <= self.s_applied_slot:
+            self.reply_read(message)
+            return
+
+        # Drop the read if too many are waiting, the client will resend it
+        if self.c_queue_limit > 0 and len(self.s_waiting_reads) >= self.c_queue_limit:
+            return
+
+        self.s_waiting_reads.append(message)
+
+
+    # Answers the follower reads whose min_slot has been applied, and the
+    #   pending reads at the leader without a round of Paxos
+    # While my lease lasts no other leader can choose anything, so every chosen
+    #   value is in a slot I have proposed. A read is answered once every slot
+    #   proposed before the lease covered it has been applied
+    # Without leases, see read_through_slot
+    def serve_reads(self):
+        if self.s_waiting_reads != []:
+            waiting_reads = self.s_waiting_reads
+            self.s_waiting_reads = []
+            for message in waiting_reads:
+                if message['min_slot'] <= self.s_applied_slot:
+                    self.reply_read(message)
                 else:
-                    # The feature of skip_slot means that s_next_slot is independent of s_first_unchosen
-                    s_next_slot = s_first_unchosen if (s_next_slot <= s_first_unchosen) else (s_next_slot + 1)
+                    self.s_waiting_reads.append(message)
+
+        if len(self.s_pending_reads) == 0:
+            return
+
+        # The reads are resent by the clients to the new leader
+        if not self.is_leader():
+            self.s_pending_reads.clear()
+            return
 
+        if self.s_leader_state != 'dictated':
+            return
+
+        if self.c_lease_duration == 0:
+            self.read_through_slot()
+        elif self.lease_valid():
+            for read in self.s_pending_reads:
+                if read[0] is None:
+                    read[0] = self.s_next_slot
+        else:
+            return
 
-        elif message_type == 'client_request':
-            client_id = message['client_id']
-            client_ip = message['client_ip']
-            client_port = message['client_port']
-            client_request_no = message['client_request_no']
-            client_think_propose_no = message['propose_no']
+        # The read indexes never decrease along the list
+        while self.s_pending_reads and self.s_pending_reads[0][0] <= self.s_applied_slot:
+            _, message = self.s_pending_reads.popleft()
+            self.reply_read(message)
+
+
+    # Proposes a no-op for the pending reads which have no slot yet, which are
+    #   answered once it has been applied
+    # A majority accepting the no-op in my propose_no after the reads arrived
+    #   means no newer leader had chosen anything by then, so every value
+    #   chosen before the reads is in a slot below the no-op
+    def read_through_slot(self):
+        if self.s_pending_reads[-1][0] is not None:
+            return
+
+        while self.s_next_slot in self.c_my_skip_slot or\
+                self.s_slots.is_learned(self.s_next_slot):
+            self.s_next_slot += 1
+
+        read_slot = self.s_next_slot
+        self.propose_slot(read_slot, [], [], [], [])
+        self.s_next_slot += 1
+
+        for read in self.s_pending_reads:
+            if read[0] is None:
+                read[0] = read_slot + 1
+
+
+    # Sends the client the messages chosen from its start_slot up to s_applied_slot
+    # Reads from a slot compacted into a snapshot start at the snapshot, as
+    #   only the slots after it are indexed, which the reply tells the client
+    def reply_read(self, message):
+        start_slot = max(message['start_slot'], self.s_slots.base_slot)
+        start_line = self.s_log_slot_start[start_slot - self.s_slots.base_slot]\
+            if start_slot < self.s_applied_slot else self.log_line_count()
+
+        values = [line[:-1] for line in self.s_log_lines[start_line - self.s_log_line_base:]]
+        paxos_read_reply(self.c_sender, message['read_no'], start_slot, self.s_applied_slot,
+                         values, (message['client_ip'], message['client_port']))
+
+
+    # Catches up with a replica whose first unchosen slot is target, starting
+    #   with helper_id if I am not catching up already
+    def catch_up(self, target, helper_id):
+        self.s_catchup_target = max(self.s_catchup_target, target)
+
+        if self.s_catchup_helper is None:
+            self.s_catchup_helper = helper_id
+            self.request_chunk()
+
+
+    # Asks the helper for the chunks of chosen slots from my s_first_unchosen on
+    # Chunks which have been lost are simply asked for again, from where my
+    #   s_first_unchosen got stuck
+    def request_chunk(self):
+        if self.s_first_unchosen >= self.s_catchup_target:
+            self.s_catchup_helper = None
+            self.s_catchup_deadline = None
+            return
+
+        self.ask_chunks(self.s_first_unchosen)
+
+
+    # Asks the helper for CATCHUP_WINDOW chunks from start_slot on
+    def ask_chunks(self, start_slot):
+        paxos_help_me_choose(self.c_sender, start_slot, self.next_install_line(),
+                             self.s_catchup_helper)
+        self.s_catchup_asked = start_slot + self.c_catchup_chunk * CATCHUP_WINDOW
+        self.s_catchup_deadline = time.time() + CATCHUP_RETRY
+
+
+    # The chat log line the next chunk of a snapshot starts at, which follows
+    #   the lines staged as long as my chat log has not grown since
+    def next_install_line(self):
+        if self.s_install_lines is not None and\
+                self.s_install_lines[0] == self.log_line_count():
+            return self.s_install_lines[1]
+        return self.log_line_count()
+
+
+    # Takes up to slots from the rate limit of catch-up, returns the number taken
+    def take_catchup_tokens(self, slots):
+        if self.c_catchup_rate == 0:
+            return slots
+
+        now = time.time()
+        # At most the chunks of one request can be saved up
+        self.s_catchup_tokens = min(self.s_catchup_tokens +
+                                    (now - self.s_catchup_refill) * self.c_catchup_rate,
+                                    self.c_catchup_chunk * CATCHUP_WINDOW)
+        self.s_catchup_refill = now
+
+        slots = min(slots, int(self.s_catchup_tokens))
+        self.s_catchup_tokens -= slots
+        return slots
+
+
+    def handle_help_me_choose(self, message):
+        # Indeed, it does not matter whether I am leader right now
+        sender_id = message['replica_id']
+        sender_first_unchosen = message['first_unchosen']
+
+        # I can only help with the slots I have chosen
+        if sender_first_unchosen >= self.s_first_unchosen:
+            return
+
+        # The compacted slots can only be sent as a snapshot, a chunk at a time,
+        #   after which the sender asks for the rest
+        if sender_first_unchosen < self.s_slots.base_slot:
+            self.send_snapshot(sender_id, message['line_count'])
+            return
+
+        # Send up to CATCHUP_WINDOW chunks after the ones still waiting for the
+        #   rate limit, unless the sender asks for slots before them again
+        end_slot = min(self.s_first_unchosen,
+                       sender_first_unchosen + self.c_catchup_chunk * CATCHUP_WINDOW)
+        deferred = self.s_deferred_help.get(sender_id, None)
+        if deferred is not None and deferred[0] <= sender_first_unchosen <= deferred[1]:
+            deferred[1] = max(deferred[1], end_slot)
+            return
+
+        self.s_deferred_help.pop(sender_id, None)
+        self.send_chunks(sender_id, sender_first_unchosen, end_slot)
+
+
+    # Sends the chosen slots from start_slot to end_slot in chunks as far as the
+    #   rate limit allows, the rest waits until it allows another chunk
+    def send_chunks(self, receiver_id, start_slot, end_slot):
+        sent_end = start_slot + self.take_catchup_tokens(end_slot - start_slot)
+        for chunk_start in range(start_slot, sent_end, self.c_catchup_chunk):
+            chunk_end = min(chunk_start + self.c_catchup_chunk, sent_end)
+            accepted, proposer, client_request, client_addr =\
+                self.s_slots.read_range(chunk_start, chunk_end)
+            paxos_you_can_choose(self.c_sender, chunk_start, chunk_end,
+                                 accepted, proposer, client_request, client_addr, receiver_id)
+
+        if sent_end < end_slot:
+            self.s_deferred_help[receiver_id] = [sent_end, end_slot]
+            if self.s_deferred_help_deadline is None:
+                slots = min(self.c_catchup_chunk, end_slot - sent_end)
+                self.s_deferred_help_deadline = time.time() +\
+                    max(slots - self.s_catchup_tokens, 0) / self.c_catchup_rate
+
+
+    # Sends the chunk from start_line on of a snapshot of the slots applied so
+    #   far, which is never older than the compacted slots
+    # The chat log lines of the compacted slots are read from the chat log, and
+    #   the last chunk comes with the client sessions
+    def send_snapshot(self, receiver_id, start_line):
+        line_count = self.log_line_count()
+        start_line = min(max(start_line, 0), line_count)
+
+        if start_line < self.s_log_line_base:
+            lines = self.c_chat_log.read_lines(start_line, self.s_log_line_base - start_line,
+                                               SNAPSHOT_CHUNK)
+            # Not flushed yet, the receiver asks again after its retry timeout
+            if lines == []:
+                return
+        else:
+            lines = []
+            size = 0
+            for line in self.s_log_lines[start_line - self.s_log_line_base:]:
+                if lines != [] and size >= SNAPSHOT_CHUNK:
+                    break
+                lines.append(line)
+                size += len(line)
+
+        sessions = self.s_sessions.to_list() if start_line + len(lines) == line_count else []
+        paxos_install_snapshot(self.c_sender, self.s_applied_slot, line_count, start_line,
+                               lines, sessions, receiver_id)
+
+
+    def handle_you_can_choose(self, message):
+        # The given range of slots must have been chosen by the other side
+        start_slot = message['start_slot']
+        end_slot = message['end_slot']
+        accepted = message['accepted']
+        proposer = message['proposer']
+        client_request = message['client_request']
+        client_addr = message['client_addr']
+
+        first_unchosen = self.s_first_unchosen
+
+        # Before learn, accept the values
+        self.s_slots.write_range(start_slot, accepted, proposer, client_request, client_addr)
+
+        for idx in range(max(start_slot, self.s_slots.base_slot), end_slot):
+            self.log_accept(idx)
+            # Learn the value
+            self.s_slots[idx].accept_count = self.c_majority_num
+            self.s_slots[idx].learned = True
+            self.log_learn(idx)
+            self.s_in_flight.discard(idx)
+            self.s_propose_time.pop(idx, None)
+
+        # Update s_last_accepted
+        if (end_slot - 1) > self.s_last_accepted:
+            self.s_last_accepted = (end_slot - 1)
+
+        # Update s_first_unchosen, the chunks may arrive out of order
+        while self.s_slots.is_learned(self.s_first_unchosen):
+            self.s_first_unchosen += 1
+
+        # Update s_next_slot
+        self.s_next_slot = self.s_first_unchosen\
+            if (self.s_next_slot <= self.s_first_unchosen) else self.s_next_slot
+
+        if self.s_catchup_helper is None or self.s_first_unchosen <= first_unchosen:
+            return
+
+        # Half of the chunks asked for have arrived, so ask for the next ones
+        #   while the rest arrives
+        if self.s_first_unchosen >= self.s_catchup_target:
+            self.request_chunk()
+        elif self.s_catchup_asked < self.s_catchup_target and\
+                self.s_catchup_asked - self.s_first_unchosen <=\
+                self.c_catchup_chunk * CATCHUP_WINDOW // 2:
+            self.ask_chunks(max(self.s_catchup_asked, self.s_first_unchosen))
+        else:
+            self.s_catchup_deadline = time.time() + CATCHUP_RETRY
+
+
+    def handle_install_snapshot(self, message):
+        # Every slot below snapshot_slot has been chosen by the other side
+        snapshot_slot = message['snapshot_slot']
+        line_count = message['line_count']
+        start_line = message['start_line']
+        lines = message['lines']
+        sessions = message['sessions']
+
+        # I already know every slot in the snapshot
+        if snapshot_slot <= self.s_first_unchosen:
+            return
+
+        # The lines I have applied are a prefix of the snapshot, so the chunks
+        #   are staged one after another from where my chat log ends
+        # Any other chunk makes me ask for the right one
+        if start_line != self.next_install_line():
+            self.catch_up(snapshot_slot, message['replica_id'])
+            return
+
+        if self.s_install_lines is None or self.s_install_lines[0] != self.log_line_count():
+            self.s_install_lines = [start_line, start_line]
+        self.run_io(self.c_chat_log.stage, lines,
+                    self.s_install_lines[1] == self.s_install_lines[0])
+        self.s_install_lines[1] += len(lines)
+
+        # Ask for the next chunk, from the same replica
+        if self.s_install_lines[1] < line_count:
+            self.s_catchup_target = max(self.s_catchup_target, snapshot_slot)
+            self.s_catchup_helper = message['replica_id']
+            self.request_chunk()
+            return
+
+        # My own lines go before the staged ones
+        self.append_chat_log()
+        self.run_io(self.c_chat_log.install_staged, snapshot_slot)
+        self.s_install_lines = None
+
+        self.s_log_line_base = line_count
+        self.s_log_lines = []
+        self.s_log_slot_start = array('q')
+        self.s_log_high_water = snapshot_slot
+        self.s_log_written = line_count
+        self.s_sessions = ClientSessions.from_list(sessions, self.c_session_expiry)
+        self.s_applied_slot = snapshot_slot
+
+        # Update s_last_accepted and s_first_unchosen
+        if (snapshot_slot - 1) > self.s_last_accepted:
+            self.s_last_accepted = (snapshot_slot - 1)
+
+        self.s_first_unchosen = snapshot_slot
+        while self.s_slots.is_learned(self.s_first_unchosen):
+            self.s_first_unchosen += 1
+
+        self.compact(snapshot_slot)
+
+        # A leader still preparing the compacted slots prepares again after them
+        if self.is_leader() and self.s_leader_state == 'prepare' and\
+                self.s_next_slot < self.s_first_unchosen:
+            self.s_next_slot = self.s_first_unchosen
+            self.prepare()
+
+        # Update s_next_slot
+        self.s_next_slot = self.s_first_unchosen\
+            if (self.s_next_slot <= self.s_first_unchosen) else self.s_next_slot
+
+        # Ask for the chosen slots after the snapshot
+        if self.s_catchup_helper is not None:
+            self.request_chunk()
+
+
+# The write-ahead log file of replica_id
+def wal_file_name(replica_id):
+    base_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'wal')
+    return os.path.join(base_dir, 'replica_{}.wal'.format(replica_id))
+
+
+# The snapshot file of replica_id
+def snapshot_file_name(replica_id):
+    base_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'wal')
+    return os.path.join(base_dir, 'replica_{}.snap'.format(replica_id))
+
+
+# The chat log file of replica_id
+def log_file_name(replica_id):
+    base_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'log')
+    return os.path.join(base_dir, 'replica_{}.log'.format(replica_id))
+
+
+# The profile files of replica_id without their .prof and .txt suffixes
+def profile_file_prefix(replica_id):
+    base_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'profile')
+    return os.path.join(base_dir, 'replica_{}'.format(replica_id))
+
+
+# The append-only chat log of a replica
+# The high-water mark, i.e. the first slot not written yet, is kept in a file
+#   next to it together with the number of lines, and only moves forward once
+#   the lines before it are flushed
+# The lines of the slots compacted into a snapshot are only kept here, and are
+#   read back a chunk at a time to send the snapshot to lagging replicas
+class ChatLog(object):
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.high_water_file_name = file_name + '.hwm'
+        # The lines of a snapshot being installed are staged in a file of their own
+        self.staged_file_name = file_name + '.staged'
+        self.file_handle = None
+
+        # The high-water mark and number of lines written, not necessarily flushed
+        self.high_water = 0
+        self.line_count = 0
+        if os.path.isfile(self.high_water_file_name) and os.path.isfile(file_name):
+            with open(self.high_water_file_name, 'r') as high_water_handle:
+                self.high_water, self.line_count =\
+                    [int(field) for field in high_water_handle.read().split()]
+
+        # The number of lines staged
+        self.staged_count = 0
+        # The line number and file offset the last read_lines ended at
+        self.read_cursor = (0, 0)
+
+    # Buffers lines, which end the chat log up to slot high_water
+    def append(self, lines, high_water):
+        if self.file_handle is None:
+            base_dir = os.path.dirname(self.file_name)
+            # The replicas of one config may create it at the same time
+            os.makedirs(base_dir, exist_ok=True)
+            self.file_handle = open(self.file_name, 'a')
+
+        self.file_handle.writelines(lines)
+        self.high_water = high_water
+        self.line_count += len(lines)
+
+    # Flushes the buffered lines, and makes them durable as well if sync
+    def flush(self, sync=False):
+        if self.file_handle is None:
+            return
+
+        self.file_handle.flush()
+        if sync:
+            os.fsync(self.file_handle.fileno())
+
+        # Replace the high-water mark file at once
+        temp_file_name = self.high_water_file_name + '.tmp'
+        with open(temp_file_name, 'w') as high_water_handle:
+            high_water_handle.write('{} {}'.format(self.high_water, self.line_count))
+            if sync:
+                high_water_handle.flush()
+                os.fsync(high_water_handle.fileno())
+        os.replace(temp_file_name, self.high_water_file_name)
+
+    # Writes the chat log again after its first line_start lines, which are kept
+    def rewrite(self, line_start, lines, high_water):
+        if self.file_handle is not None:
+            self.file_handle.close()
+            self.file_handle = None
+
+        self.line_count = 0
+        self.read_cursor = (0, 0)
+        if os.path.isfile(self.file_name):
+            with open(self.file_name, 'r+b') as file_handle:
+                offset = 0
+                while self.line_count < line_start:
+                    line = file_handle.readline()
+                    if not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
+                    self.line_count += 1
+                file_handle.truncate(offset)
+
+        self.append(lines, high_water)
+        self.flush()
+
+    # Returns up to count lines from line start_line on, as far as they are
+    #   flushed, stopping once they hold max_bytes unless there is only one
+    # Reading on from where the last call ended does not read the lines before
+    def read_lines(self, start_line, count, max_bytes):
+        lines = []
+        if not os.path.isfile(self.file_name):
+            return lines
+
+        line_no, offset = self.read_cursor
+        if start_line < line_no:
+            line_no, offset = 0, 0
+
+        size = 0
+        with open(self.file_name, 'rb') as file_handle:
+            file_handle.seek(offset)
+            while line_no < start_line + count and (lines == [] or size < max_bytes):
+                line = file_handle.readline()
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                line_no += 1
+                if line_no > start_line:
+                    lines.append(line.decode('utf-8'))
+                    size += len(line)
+
+        self.read_cursor = (line_no, offset)
+        return lines
+
+    # Stages lines of a snapshot being installed, after the ones staged before
+    #   unless reset
+    def stage(self, lines, reset):
+        with open(self.staged_file_name, 'w' if reset else 'a') as staged_handle:
+            staged_handle.writelines(lines)
+        self.staged_count = len(lines) if reset else self.staged_count + len(lines)
+
+    # Appends the staged lines, which end the chat log up to slot high_water
+    def install_staged(self, high_water):
+        self.append([], high_water)
+        if os.path.isfile(self.staged_file_name):
+            with open(self.staged_file_name, 'r') as staged_handle:
+                shutil.copyfileobj(staged_handle, self.file_handle)
+            os.remove(self.staged_file_name)
+
+        self.line_count += self.staged_count
+        self.staged_count = 0
+        self.flush()
+
+
+# wal_snapshot and wal_records are the snapshot and records replayed from the
+#   write-ahead log of the replica
+def handle_replica(replica_id, replica_config_list, wal_snapshot, wal_records):
+    replica = Replica(replica_id, replica_config_list)
+    replica.recover(wal_snapshot, wal_records)
 
-            if (client_id, client_request_no) in s_chosen_client_request:
-                # But tell client that message has already been learnt
-                paxos_ack_client(replica_id, client_request_no,
-                                 (client_ip, client_port), c_my_drop_rate)
+    # Build the socket to receive external message
+    # UDP socket also has buffer to store incoming messages
+    my_socket = u_bind_socket(replica.c_my_ip, replica.c_my_port)
+
+    # Reassembles the messages which do not fit in one datagram
+    assembler = FrameAssembler()
+
+    if replica.is_leader():
+        # TODO: This is to ensure every other process is up (not safe)
+        time.sleep(LEADER_STARTUP)
+
+    try:
+        replica.start(my_socket)
+
+        # This basically constantly fetched the next message in the socket
+        #   buffer and take action according to the message type
+        while True:
+            # Only block until the next timer of the replica is due
+            # A socket which is never idle does not time out, so the timers
+            #   which are due already fire here
+            deadline = replica.next_deadline()
+            if deadline is not None and time.time() >= deadline:
+                replica.handle_timeout()
                 continue
 
-            # If the client-believed leader is older, tell it the correct leader
-            if client_think_propose_no < s_leader_propose_no:
-                paxos_tell_client_new_leader(replica_id, s_leader_propose_no,
-                                             client_ip, client_port,
-                                             c_my_drop_rate)
+            my_socket.settimeout(None if deadline is None else\
+                                 max(deadline - time.time(), 0.001))
+
+            try:
+                # This is a blocking call
+                data, sender_addr = my_socket.recvfrom(RECV_BUFFER)
+
+            except socket.timeout:
+                replica.handle_timeout()
                 continue
 
-            # If the client-believed leader is newer, I become the new leader
-            elif client_think_propose_no > s_leader_propose_no:
-                assert ( u_get_id(client_think_propose_no, c_replica_num) ==\
-                         replica_id )
-
-                # Change s_next_slot back to s_first_unchosen
-                s_next_slot = s_first_unchosen
-
-                # Initialize temp variables with leader's own slot
-                t_value = s_accepted.get(s_next_slot, None)
-                t_propose_no = s_proposer.get(s_next_slot, 0)
-                t_client_request = s_client_request.get(s_next_slot, None)
-                t_client_addr = s_client_addr.get(s_next_slot, None)
-
-                # Before sending prepare msg, the leader already has one ack (itself)
-                s_ack_msg_count[s_next_slot] = 1
-
-                # Update own view of leader
-                s_leader_propose_no = client_think_propose_no
-                # Just an initialization for safety
-                s_leader_state = 'prepare'
-                s_accept_msg_count[s_next_slot] = 0
-                s_waiting_client = False
-
-                # Empty the request queue
-                del s_request_queue[:]
-                del s_slot_buffer_queue[:]
-
-                paxos_prepare(replica_id, s_leader_propose_no, s_next_slot,
-                              s_replica_config, c_my_drop_rate)
-
-            # Append the client request message to queue
-            s_request_queue.append(message)
-
-            # If a job is already waiting for client message
-            while (s_waiting_client == True) and (s_request_queue != []):
-                if s_leader_state == 'established':
-                    while s_slot_buffer_queue != []:
-                        if s_request_queue == []:
-                            s_waiting_client = True
-                            break
-
-                        else:
-                            client_message = s_request_queue.pop(0)
-                            value = client_message['value']
-                            propose_no = s_leader_propose_no
-                            client_request = [client_message['client_id'],
-                                              client_message['client_request_no']]
-                            client_addr = [client_message['client_ip'],
-                                           client_message['client_port']]
-
-                            if tuple(client_request) in s_chosen_client_request:
-                                paxos_ack_client(replica_id, client_request[1],
-                                                 (client_addr[0], client_addr[1]), c_my_drop_rate)
-
-                            slot_to_fill = s_slot_buffer_queue.pop(0)
-
-                            # -------------- Skip the skip slot -------------- #
-                            if slot_to_fill in c_my_skip_slot:
-                                continue
-                            # -------------- Skip the skip slot -------------- #
-
-                            # First the leader itself should accept the value
-                            s_accepted[slot_to_fill] = value
-                            s_proposer[slot_to_fill] = propose_no
-                            s_client_request[slot_to_fill] = client_request
-                            s_client_addr[slot_to_fill] = client_addr
-
-                            # Increment the s_accept_msg_count
-                            s_accept_msg_count[slot_to_fill] = 1
-
-                            # Update last_accepted
-                            if slot_to_fill > s_last_accepted: 
-                                s_last_accepted = slot_to_fill
-
-                            paxos_propose(replica_id, value, propose_no, client_request, client_addr,
-                                          s_first_unchosen, slot_to_fill, s_replica_config, c_my_drop_rate)
-
-                            paxos_accept(replica_id,
-                                         s_accepted[slot_to_fill],
-                                         s_proposer[slot_to_fill],
-                                         s_client_request[slot_to_fill],
-                                         s_client_addr[slot_to_fill],
-                                         slot_to_fill,
-                                         s_replica_config,
-                                         c_my_drop_rate)
-
-                            s_waiting_client = False
-
-                    # If the s_slot_buffer_queue is exhausted, need to enter 'dictated' stage
-                    if s_slot_buffer_queue == []:
-                        s_leader_state = 'dictated'
-
-                        # Now s_next_slot is independent of s_first_unchosen
-                        s_next_slot += 1
-                        while s_next_slot in s_learned:
-                            t_no_more_accepted = True
-                            s_next_slot += 1
-
-                        while s_request_queue != []:
-                            client_message = s_request_queue.pop(0)
-                            value = client_message['value']
-                            propose_no = s_leader_propose_no
-                            client_request = [client_message['client_id'],
-                                              client_message['client_request_no']]
-                            client_addr = [client_message['client_ip'],
-                                           client_message['client_port']]
-
-                            if tuple(client_request) in s_chosen_client_request:
-                                paxos_ack_client(replica_id, client_request[1],
-                                                 (client_addr[0], client_addr[1]), c_my_drop_rate)
-
-                            # -------------- Skip the skip slot -------------- #
-                            if s_next_slot in c_my_skip_slot:
-                                s_next_slot += 1
-                                while s_next_slot in s_learned:
-                                    t_no_more_accepted = True
-                                    s_next_slot += 1
-                                continue
-                            # -------------- Skip the skip slot -------------- #
-
-                            # First the leader itself should accept the value
-                            s_accepted[s_next_slot] = value
-                            s_proposer[s_next_slot] = propose_no
-                            s_client_request[s_next_slot] = client_request
-                            s_client_addr[s_next_slot] = client_addr
-
-                            # Increment the s_accept_msg_count
-                            s_accept_msg_count[s_next_slot] = 1
-
-                            # Update last_accepted
-                            if s_next_slot > s_last_accepted: 
-                                s_last_accepted = s_next_slot
-
-                            paxos_propose(replica_id, value, propose_no, client_request, client_addr,
-                                          s_first_unchosen, s_next_slot, s_replica_config, c_my_drop_rate)
-
-                            paxos_accept(replica_id,
-                                         s_accepted[s_next_slot],
-                                         s_proposer[s_next_slot],
-                                         s_client_request[s_next_slot],
-                                         s_client_addr[s_next_slot],
-                                         s_next_slot,
-                                         s_replica_config,
-                                         c_my_drop_rate)
-
-                            # Now s_next_slot is independent of s_first_unchosen
-                            s_next_slot += 1
-                            while s_next_slot in s_learned:
-                                t_no_more_accepted = True
-                                s_next_slot += 1
-
-                        # After exhausting the request queue, have to wait
-                        s_waiting_client = True    
-
-                elif s_leader_state == 'dictated':
-                    client_message = s_request_queue.pop(0)
-                    value = client_message['value']
-                    propose_no = s_leader_propose_no
-                    client_request = [client_message['client_id'],
-                                      client_message['client_request_no']]
-                    client_addr = [client_message['client_ip'],
-                                   client_message['client_port']]
-
-                    if tuple(client_request) in s_chosen_client_request:
-                        paxos_ack_client(replica_id, client_request[1],
-                                         (client_addr[0], client_addr[1]), c_my_drop_rate)
-
-                    # -------------- Skip the skip slot -------------- #
-                    if s_next_slot in c_my_skip_slot:
-                        s_next_slot += 1
-                        while s_next_slot in s_learned:
-                            t_no_more_accepted = True
-                            s_next_slot += 1
-                        continue
-                    # -------------- Skip the skip slot -------------- #
-
-                    # First the leader itself should accept the value
-                    s_accepted[s_next_slot] = value
-                    s_proposer[s_next_slot] = propose_no
-                    s_client_request[s_next_slot] = client_request
-                    s_client_addr[s_next_slot] = client_addr
-
-                    # Initialize the s_accept_msg_count
-                    s_accept_msg_count[s_next_slot] = 1
-
-                    # Update last_accepted
-                    if s_next_slot > s_last_accepted: 
-                        s_last_accepted = s_next_slot
-
-                    paxos_propose(replica_id, value, propose_no, client_request, 
-                                  client_addr, s_first_unchosen, s_next_slot,
-                                  s_replica_config, c_my_drop_rate)
-
-                    paxos_accept(replica_id,
-                                 s_accepted[s_next_slot],
-                                 s_proposer[s_next_slot], 
-                                 s_client_request[s_next_slot],
-                                 s_client_addr[s_next_slot],
-                                 s_next_slot, s_replica_config, c_my_drop_rate)
-
-                    s_next_slot += 1
-                    while s_next_slot in s_learned:
-                        t_no_more_accepted = True
-                        s_next_slot += 1
+            # Frames of a large message only yield it once all have arrived
+            data = assembler.feed(data, sender_addr)
+            if data is None:
+                continue
 
-                else:
-                    # Other state is not expected
-                    print('invalid state {}'.format(s_leader_state))
-                    sys.exit(1)
-
-
-        elif message_type == 'client_timeout':
-            client_ip = message['client_ip']
-            client_port = message['client_port']
-            client_think_propose_no = message['propose_no']
-
-            # Client is newer, meaning I should listen to the client
-            if client_think_propose_no >= s_leader_propose_no:
-                s_leader_propose_no = client_think_propose_no + 1
-
-                # If I happened to be the new leader
-                if u_get_id(s_leader_propose_no, c_replica_num) == replica_id:
-                    # Change s_next_slot back to s_first_unchosen
-                    s_next_slot = s_first_unchosen
-
-                    # Initialize temp variables with leader's own slot
-                    t_value = s_accepted.get(s_next_slot, None)
-                    t_propose_no = s_proposer.get(s_next_slot, 0)
-                    t_client_request = s_client_request.get(s_next_slot, None)
-                    t_client_addr = s_client_addr.get(s_next_slot, None)
-
-                    # Before sending prepare msg, the leader already has one ack (itself)
-                    s_ack_msg_count[s_next_slot] = 1
-
-                    # Just an initialization for safety
-                    s_leader_state = 'prepare'
-                    s_accept_msg_count[s_next_slot] = 0
-                    s_waiting_client = False
-
-                    # Empty the request queue
-                    del s_request_queue[:]
-                    del s_slot_buffer_queue[:]
-
-                    paxos_prepare(replica_id, s_leader_propose_no,
-                                  s_next_slot, s_replica_config, c_my_drop_rate)
-
-            # If I am newer, meaning client missed something, just tell it mine
-            # Do nothing in this case
-
-            paxos_tell_client_new_leader(replica_id, s_leader_propose_no,
-                                         client_ip, client_port, c_my_drop_rate)
-
-
-        elif message_type == 'print_log':
-            base_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'log')
-            if not os.path.isdir(base_dir):
-                os.makedirs(base_dir)
-
-            log_file_name = os.path.join(base_dir, 'replica_{}.log'.format(replica_id))
-            check_dup_set = set()
-            with open(log_file_name, 'w') as log_file_handle:
-                for i in range(s_first_unchosen):
-                    if tuple(s_client_request[i]) not in check_dup_set:
-                        log_file_handle.write(s_accepted[i] + '\n')
-                    check_dup_set.add(tuple(s_client_request[i]))
-
-
-        elif message_type == 'help_me_choose':
-            # Indeed, it does not matter whether I am leader right now
-            sender_id = message['replica_id']
-            sender_first_unchosen = message['first_unchosen']
-
-            assert ( sender_first_unchosen < s_first_unchosen )
-            for i in range(sender_first_unchosen, s_first_unchosen):
-                assert ( i in s_learned )
-
-            receiver_ip = s_replica_config[sender_id]['ip']
-            receiver_port = s_replica_config[sender_id]['port']
-
-            paxos_you_can_choose(replica_id, sender_first_unchosen,
-                                 s_first_unchosen, s_accepted, s_proposer,
-                                 s_client_request, s_client_addr,
-                                 receiver_ip, receiver_port, c_my_drop_rate)            
-
-
-        elif message_type == 'you_can_choose':
-            # The given range of slots must have been chosen by the other side
-            start_slot = message['start_slot']
-            end_slot = message['end_slot']
-            accepted = message['accepted']
-            proposer = message['proposer']
-            client_request = message['client_request']
-            client_addr = message['client_addr']
-
-            for idx in range(start_slot, end_slot):
-                ref_idx = idx - start_slot
-                # Before learn, accept the value
-                s_accepted[idx] = accepted[ref_idx]
-                s_proposer[idx] = proposer[ref_idx]
-                s_client_request[idx] = copy.deepcopy(client_request[ref_idx])
-                s_client_addr[idx] = copy.deepcopy(client_addr[ref_idx])
-                # Learn the value
-                s_accept_msg_count[idx] = c_majority_num
-                s_learned.add(idx)
-                s_chosen_client_request.add(tuple(client_request[ref_idx]))
-
-            # Update s_last_accepted
-            if (end_slot - 1) > s_last_accepted:
-                s_last_accepted = (end_slot - 1)
-
-            # Update s_first_unchosen
-            s_first_unchosen = end_slot
-            while s_first_unchosen in s_learned:
-                s_first_unchosen += 1
-
-            # Update s_next_slot
-            s_next_slot = s_first_unchosen if (s_next_slot <= s_first_unchosen) else s_next_slot
+            replica.handle(u_decode_message(data))
+    finally:
+        replica.stop()
+        my_socket.close()
+
+
+# Feeds the datagrams received by the asyncio loop to the replica
+class ReplicaProtocol(asyncio.DatagramProtocol):
+    def __init__(self, replica):
+        self.replica = replica
+        # Reassembles the messages which do not fit in one datagram
+        self.assembler = FrameAssembler()
+        # The scheduled call of replica.handle_timeout and its deadline
+        self.timer = None
+        self.timer_deadline = None
+
+    def datagram_received(self, data, addr):
+        # Frames of a large message only yield it once all have arrived
+        data = self.assembler.feed(data, addr)
+        if data is None:
+            return
+
+        self.replica.handle(u_decode_message(data))
+        self.schedule_timer()
+
+    # Keeps one timer scheduled for the next deadline of the replica
+    def schedule_timer(self):
+        deadline = self.replica.next_deadline()
+        if deadline == self.timer_deadline:
+            return
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        self.timer_deadline = deadline
+        if deadline is not None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(max(deadline - time.time(), 0),
+                                         self.fire_timer)
+
+    def fire_timer(self):
+        self.timer = None
+        self.timer_deadline = None
+        self.replica.handle_timeout()
+        self.schedule_timer()
+
+
+async def serve_replica(replica_id, replica_config_list, wal_snapshot, wal_records):
+    loop = asyncio.get_running_loop()
+    replica = Replica(replica_id, replica_config_list)
+    replica.recover(wal_snapshot, wal_records)
+
+    # Log files are written by a worker thread instead of the event loop
+    # One worker keeps the writes in order
+    replica.c_io_executor = ThreadPoolExecutor(max_workers=1)
+
+    my_socket = u_bind_socket(replica.c_my_ip, replica.c_my_port)
+
+    # Nothing may be handled before start, the socket buffers it meanwhile
+    if replica.is_leader():
+        # TODO: This is to ensure every other process is up (not safe)
+        await asyncio.sleep(LEADER_STARTUP)
+
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: ReplicaProtocol(replica), sock=my_socket)
+
+    try:
+        replica.start(transport)
+        replica.c_timers_changed = protocol.schedule_timer
+        protocol.schedule_timer()
+
+        # Serve until the process is killed
+        await loop.create_future()
+    finally:
+        replica.stop()
+        transport.close()
 
-        else:
-            print('Replica {} received an erroneous message {}'.\
-                format(replica_id))
-            
 
-    my_socket.close()
+# The same replica as handle_replica, driven by an asyncio event loop
+def handle_replica_async(replica_id, replica_config_list, wal_snapshot, wal_records):
+    asyncio.run(serve_replica(replica_id, replica_config_list, wal_snapshot, wal_records))
 
 
 @click.command()
 @click.argument('config_file')
 @click.option('--replica_id', '-i', type=int,
               help='specify replica_id in manual mode')
-def main(config_file, replica_id):
+@click.option('--use_asyncio', '-a', is_flag=True,
+              help='run replicas on an asyncio event loop')
+@click.option('--profile', '-pr', is_flag=True,
+              help='profile the time and allocations of replicas into profile/')
+@click.option('--profile_top', '-pt', type=int, default=25,
+              help='number of functions and allocations in the profile reports')
+def main(config_file, replica_id, use_asyncio, profile, profile_top):
     # Extract configuration data from specified config file
     config_str = ''
     with open(config_file, 'r') as config_handle:
@@ -1077,25 +2125,46 @@ def main(config_file, replica_id):
     # Depending on the mode, we do differnt things
     mode = config_data['mode']
 
+    # Both targets run the same Replica, only the event loop differs
+    target = handle_replica_async if use_asyncio else handle_replica
+
+    # Replays the snapshot and write-ahead log of a durable replica restarting
+    #   after a crash
+    def replay(replica_id):
+        if not replica_config_list[replica_id].get('durable', False):
+            return None, []
+        return (u_read_snapshot(snapshot_file_name(replica_id)),
+                u_replay_wal(wal_file_name(replica_id)))
+
+    # Profiled replicas write their profiles on SIGUSR1 and when they stop
+    def spawn(replica_id):
+        args = (replica_id, replica_config_list) + replay(replica_id)
+        if profile:
+            args = (profile_file_prefix(replica_id), profile_top, target) + args
+        p = Process(target=u_run_profiled if profile else target, args=args)
+        p.start()
+
     if mode == 'script':
         # Spew out replica_num subprocesses
         for replica_id in range(replica_num):
-            p = Process(target=handle_replica,
-                        args=(replica_id, replica_config_list))
-            p.start()
+            spawn(replica_id)
 
     elif mode == 'manual':
         if replica_id is None:
             print('In manual mode, need to specify replica_id by -i id')
             sys.exit(1)
-        p = Process(target=handle_replica,
-                    args=(replica_id, replica_config_list))
-        p.start()
+        spawn(replica_id)
 
     else:
         print('Mode can only be either script or manual')
         sys.exit(1)
 
+    # Signalling the whole process group reaches the replicas, and this process
+    #   waits for them to finish writing their profiles
+    if profile:
+        for signum in (signal.SIGUSR1, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_IGN)
+
 
 if __name__ == '__main__':
     main()
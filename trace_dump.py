@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+'''
+    Rebuilds the timelines of traced client requests from the hops recorded
+    by every replica of a replica_config.json, see paxos_trace.
+
+    The slowest requests are printed first, each hop with the milliseconds
+    since the first hop of its request, e.g.
+
+        trace 1234 took 1012.345 ms
+              0.000 ms  replica 0  request
+              0.210 ms  replica 0  propose      slot 7
+              ...
+           1003.120 ms  replica 1  request
+
+    where a second request hop at the leader shows that the client resent
+    the message after its timeout.
+'''
+
+import json
+import click
+from paxos_trace import u_collect_traces, u_timelines, u_slowest_traces,\
+                        u_relative_timeline
+
+
+def to_ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+@click.command()
+@click.argument('config_file')
+@click.option('--trace', '-t', 'trace_id', type=int, default=0,
+              help='Specify a trace id to show only that request by --trace id')
+@click.option('--slowest', '-n', type=int, default=10,
+              help='Specify the number of slowest requests shown by --slowest n')
+@click.option('--ip', default='localhost',
+              help='Specify the ip the replicas send their hops to by --ip ip')
+@click.option('--port', '-p', type=int, default=9500,
+              help='Specify the port the replicas send their hops to by --port n')
+@click.option('--timeout', '-w', type=float, default=0.5,
+              help='Specify the seconds to wait for every chunk of hops by --timeout t')
+@click.option('--json', '-j', 'use_json', is_flag=True,
+              help='Set this flag to print the timelines as JSON')
+def main(config_file, trace_id, slowest, ip, port, timeout, use_json):
+    """Print the timelines of the traced requests of the replicas of CONFIG_FILE"""
+    with open(config_file, 'r') as config_handle:
+        config_data = json.loads(config_handle.read())
+
+    # { replica_id : { 'ip' : '', 'port' : '' } }
+    replica_config = {}
+    for raw_config in config_data['replica_list']:
+        replica_config[raw_config['id']] = {
+            'ip' : raw_config['ip'],
+            'port' : raw_config['port']
+        }
+
+    events, missing = u_collect_traces(replica_config, ip, port, trace_id, timeout)
+    timelines = u_timelines(events)
+
+    traces = []
+    for latency, slow_id in u_slowest_traces(timelines, slowest):
+        traces.append({
+            'trace_id' : slow_id,
+            'latency_ms' : to_ms(latency),
+            'timeline' : u_relative_timeline(timelines[slow_id])
+        })
+
+    if use_json:
+        print(json.dumps({ 'missing_replicas' : missing, 'traces' : traces }, indent=4))
+        return
+
+    for replica_id in missing:
+        print('replica {} did not reply'.format(replica_id))
+
+    for trace in traces:
+        latency = 'was not chosen' if trace['latency_ms'] is None else\
+            'took {} ms'.format(trace['latency_ms'])
+        print('trace {} {}'.format(trace['trace_id'], latency))
+        for offset, source, hop, slot in trace['timeline']:
+            print('    {:10.3f} ms  {:<10}  {:<12} {}'.format(
+                offset, source, hop, 'slot {}'.format(slot) if slot >= 0 else ''))
+
+
+if __name__ == '__main__':
+    main()